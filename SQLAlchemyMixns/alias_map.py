@@ -0,0 +1,196 @@
+from threading import Lock, RLock
+from time import monotonic
+from sqlalchemy import inspect
+from sqlalchemy.orm.exc import NoResultFound
+from .chunked_loader import load_chunked
+
+
+class _ModelAliases:
+    """Состояние карты алиасов одной модели"""
+
+    def __init__(self, model, version_field):
+        mapper = inspect(model)
+        self.pk_attr = getattr(model, mapper.get_property_by_column(mapper.primary_key[0]).key)
+        self.version_attr = getattr(model, version_field) if version_field else None
+        self.pks = dict()
+        self.aliases = dict()
+        self.version = None
+        self.loaded_at = None
+
+
+class AliasMap:
+    """
+    Карта alias -> pk модели AliasMixin в памяти. Загружается одним запросом при первом обращении (или warmup),
+    затем обновляется не чаще refresh_interval: по колонке версии/времени изменения только измененные строки,
+    без нее - полностью. Алиасы, которых нет в карте, ищутся в БД и добавляются в карту.
+    Подключается атрибутом класса модели: alias_map = AliasMap(version_field='updated', refresh_interval=60)
+    """
+
+    def __init__(self, version_field=None, refresh_interval=60):
+        """
+        :param version_field: <str> колонка, растущая при изменении строки (версия, время изменения)
+        :param refresh_interval: <float> период обновления карты в секундах, None - без обновления
+        """
+        self.version_field = version_field
+        self.refresh_interval = refresh_interval
+        self._models = dict()
+        # _lock защищает только состояние в памяти, запросы к БД выполняются без него
+        self._lock = RLock()
+        # загрузка карты модели: одна на модель, поиск по алиасам во время обновления использует прежнюю карту
+        self._load_locks = dict()
+
+    def warmup(self, model, session):
+        """
+        Загрузка всей карты алиасов модели одним запросом
+        :param model: класс модели
+        :param session: сессия
+        """
+        state = _ModelAliases(model, self.version_field)
+        # новая карта еще никому не видна, поэтому заполняется без блокировки
+        self._apply(state, *self._fetch(model, session, state))
+        with self._lock:
+            self._models[model] = state
+
+    def refresh(self, model, session):
+        """Обновление карты: измененные после последней загрузки строки или вся карта, если нет version_field"""
+        with self._lock:
+            state = self._models.get(model)
+        if state is None or state.version_attr is None:
+            self.warmup(model, session)
+            return
+        rows, version = self._fetch(model, session, state, incremental=True)
+        with self._lock:
+            self._apply(state, rows, version)
+
+    def resolve(self, model, session, aliases):
+        """
+        Первичные ключи по алиасам. Неизвестные карте алиасы ищутся в БД одним запросом
+        :param aliases: [<str>, ...]
+        :return: {<alias>: <pk>} только для найденных алиасов
+        """
+        return self._resolve(model, session, aliases)[1]
+
+    def item(self, model, session, alias):
+        """
+        Объект по алиасу: pk из карты, объект из сессии или по первичному ключу
+        :return: <SQLAlchemy>
+        """
+        pk = self.resolve(model, session, (alias,)).get(alias)
+        if pk is None:
+            raise NoResultFound('No row was found for alias "{}"'.format(alias))
+        item = session.get(model, pk)
+        if item is None or item.alias != alias:
+            # карта устарела: алиас удален или передан другой строке
+            self.forget(model, pk=pk, alias=alias)
+            return session.query(model).filter(model.alias == alias).one()
+        return item
+
+    def items(self, model, session, aliases):
+        """
+        Объекты по списку алиасов: pk из карты, объекты одним запросом по первичному ключу
+        :return: [<SQLAlchemy>, ...]
+        """
+        state, pks = self._resolve(model, session, aliases)
+        result = load_chunked(session.query(model), state.pk_attr, list(pks.values()))
+        stale = [item for item in result if pks.get(item.alias) is None]
+        if stale or len(result) != len(set(pks.values())):
+            # карта устарела: повторяем выборку по алиасам
+            for pk in pks.values():
+                self.forget(model, pk=pk)
+            return session.query(model).filter(model.alias.in_(aliases)).all()
+        return result
+
+    def forget(self, model, pk=None, alias=None):
+        """Удаление записи из карты по pk и/или алиасу (например, после изменения или удаления объекта)"""
+        with self._lock:
+            state = self._models.get(model)
+            if state is None:
+                return
+            old_alias = state.aliases.pop(pk, None) if pk is not None else None
+            for key in (old_alias, alias):
+                if key is not None:
+                    old_pk = state.pks.pop(key, None)
+                    if old_pk is not None and old_pk != pk:
+                        state.aliases.pop(old_pk, None)
+
+    def clear(self, model=None):
+        """Сброс карты модели (или всех моделей), следующее обращение загрузит ее заново"""
+        with self._lock:
+            if model is None:
+                self._models.clear()
+            else:
+                self._models.pop(model, None)
+
+    def _resolve(self, model, session, aliases):
+        """resolve, который возвращает также карту модели: (<_ModelAliases>, {<alias>: <pk>})"""
+        state = self._state(model, session)
+        with self._lock:
+            result = {alias: state.pks[alias] for alias in aliases if alias in state.pks}
+        missing = [alias for alias in aliases if alias not in result]
+        if missing:
+            rows = session.query(state.pk_attr, model.alias).filter(model.alias.in_(missing)).all()
+            with self._lock:
+                for pk, alias in rows:
+                    self._set(state, alias, pk)
+                    result[alias] = pk
+        return state, result
+
+    def _state(self, model, session):
+        """
+        Карта модели: при первом обращении загружается (остальные потоки ждут загрузки этой модели), при истекшем
+        refresh_interval обновляется одним потоком, остальные потоки используют прежнюю карту
+        """
+        with self._lock:
+            state = self._models.get(model)
+            load_lock = self._load_locks.setdefault(model, Lock())
+        if state is None:
+            with load_lock:
+                with self._lock:
+                    state = self._models.get(model)
+                if state is None:
+                    self.warmup(model, session)
+        elif self._expired(state) and load_lock.acquire(blocking=False):
+            try:
+                if self._expired(state):
+                    self.refresh(model, session)
+            finally:
+                load_lock.release()
+        with self._lock:
+            return self._models.get(model, state)
+
+    def _expired(self, state):
+        return self.refresh_interval is not None and monotonic() - state.loaded_at >= self.refresh_interval
+
+    def _fetch(self, model, session, state, incremental=False):
+        """
+        Запрос строк карты
+        :return: ([(<pk>, <alias>, <version>), ...], <новая версия>)
+        """
+        columns = [state.pk_attr, model.alias]
+        if state.version_attr is not None:
+            columns.append(state.version_attr)
+        query = session.query(*columns).filter(model.alias != None)
+        if incremental and state.version is not None:
+            # >= : строки с той же версией, записанные после прошлой загрузки, тоже попадут в выборку
+            query = query.filter(state.version_attr >= state.version)
+        rows = query.all()
+        version = state.version
+        if state.version_attr is not None:
+            for row in rows:
+                if row[2] is not None and (version is None or row[2] > version):
+                    version = row[2]
+        return rows, version
+
+    def _apply(self, state, rows, version):
+        for row in rows:
+            self._set(state, row[1], row[0])
+        state.version = version
+        state.loaded_at = monotonic()
+
+    @staticmethod
+    def _set(state, alias, pk):
+        old_alias = state.aliases.get(pk)
+        if old_alias is not None and old_alias != alias:
+            state.pks.pop(old_alias, None)
+        state.pks[alias] = pk
+        state.aliases[pk] = alias
@@ -1,21 +1,37 @@
 from pyoreol import DBSession
+from .instrumentation import instrumented
 
 
 class AliasMixin:
     """Добавляет методы выборки по столбцам алиасам. Алиасы должны быть уникальными"""
 
+    # IdentityCache для aliased_item, по умолчанию кеш не используется
+    identity_cache = None
+    # AliasMap для aliased_item и aliased_list, по умолчанию алиасы ищутся запросом к БД
+    alias_map = None
+
     @classmethod
+    @instrumented()
     def aliased_list(cls, aliases):
         """
         Выборка элементов по алиасу
         :param aliases: [<str>, ...]
         :return: [<SQLAlchemy>, ...]
         """
+        if aliases and cls.alias_map is not None:
+            return cls.alias_map.items(cls, DBSession, aliases)
         query = DBSession.query(cls).filter(cls.alias != None)
         if aliases:
             query = query.filter(cls.alias.in_(aliases))
         return query.all()
 
     @classmethod
+    @instrumented(single_row=True)
     def aliased_item(cls, alias):
-        return DBSession.query(cls).filter(cls.alias == alias).one()
+        if cls.alias_map is not None:
+            load = lambda: cls.alias_map.item(cls, DBSession, alias)
+        else:
+            load = lambda: DBSession.query(cls).filter(cls.alias == alias).one()
+        if cls.identity_cache is not None:
+            return cls.identity_cache.get(cls, 'alias', alias, load, DBSession)
+        return load()
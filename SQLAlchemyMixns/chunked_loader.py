@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from sqlalchemy import bindparam
+
+IN_STRATEGY = 'in'
+VALUES_STRATEGY = 'values'
+
+
+def unique_keys(keys):
+    """
+    Ключи без None и повторов в исходном порядке
+    :param keys: [<pk>, ...]
+    :return: [<pk>, ...]
+    """
+    return [key for key in OrderedDict.fromkeys(keys) if key is not None]
+
+
+def sort_key(value):
+    """Ключ сортировки, при котором None оказываются в конце (как NULLS LAST)"""
+    return value is None, value
+
+
+def _chunk_query(query, column, strategy):
+    """
+    Запрос, выбирающий одну часть ключей. Текст запроса не зависит от количества ключей в части,
+    поэтому план запроса переиспользуется
+    :return: функция, принимающая список ключей и возвращающая список объектов
+    """
+    if strategy == IN_STRATEGY:
+        chunk_query = query.filter(column.in_(bindparam('chunk_keys', expanding=True)))
+        return lambda chunk: chunk_query.params(chunk_keys=chunk).all()
+    if strategy == VALUES_STRATEGY:
+        # values() есть в SQLAlchemy начиная с 1.4
+        from sqlalchemy import column as sa_column, values
+
+        def load(chunk):
+            keys = values(sa_column('key', column.type), name='chunk_keys').data([(key,) for key in chunk])
+            return query.join(keys, column == keys.c.key).all()
+        return load
+    raise ValueError('Unknown strategy "{}"'.format(strategy))
+
+
+def load_chunked(query, column, keys, chunk_size=1000, order_by=None, as_dict=False, strategy=IN_STRATEGY):
+    """
+    Загрузка объектов по большому списку ключей частями по chunk_size. Ключи дедуплицируются, результат
+    упорядочен как входной список (или по order_by), ключи, которых нет в БД, пропускаются
+    :param query: запрос по модели
+    :param column: колонка ключа модели (cls.id, cls.guid)
+    :param keys: [<pk>, ...]
+    :param chunk_size: <int> количество ключей в одном запросе
+    :param order_by: <str> поле по которому будет проведена сортировка
+    :param as_dict: <bool> вернуть {<pk>: <SQLAlchemy>} вместо списка
+    :param strategy: 'in' - IN с expanding параметром, 'values' - JOIN с VALUES (PostgreSQL, не SQLite)
+    :return: [<SQLAlchemy>, ...] или OrderedDict {<pk>: <SQLAlchemy>}
+    """
+    keys = unique_keys(keys)
+    load = _chunk_query(query, column, strategy)
+    attr = column.key
+    found = dict()
+    for i in range(0, len(keys), chunk_size):
+        for item in load(keys[i:i + chunk_size]):
+            found[getattr(item, attr)] = item
+
+    result = OrderedDict()
+    found_by_str = None
+    for key in keys:
+        item = found.get(key)
+        if item is None:
+            # ключи могли прийти строками, а из БД вернуться объектами (UUID) или наоборот
+            if found_by_str is None:
+                found_by_str = {str(k): v for k, v in found.items()}
+            item = found_by_str.get(str(key))
+            if item is None:
+                continue
+        result[key] = item
+
+    if order_by:
+        result = OrderedDict(sorted(result.items(), key=lambda pair: sort_key(getattr(pair[1], order_by))))
+    if as_dict:
+        return result
+    return list(result.values())
@@ -1,19 +1,28 @@
 from pyoreol import DBSession
+from .chunked_loader import load_chunked
+from . import keyset
+from .instrumentation import instrumented
 
 
 class GuidPK:
     """Миксин, добавляет методы get_item и get_list для классов с PK UUID типа"""
 
+    # IdentityCache для get_item, по умолчанию кеш не используется
+    identity_cache = None
+
     @classmethod
-    def get_list(cls, guids=None):
+    @instrumented()
+    def get_list(cls, guids=None, as_dict=False, chunk_size=1000):
         """
-        Получение списка элементов
+        Получение списка элементов. Список guids загружается частями по chunk_size, без повторов и в порядке guids
         :param guids: [<UUID>, ...]
+        :param as_dict: <bool> вернуть {<guid>: <SQLAlchemy>} (только вместе с guids)
+        :param chunk_size: <int> количество ключей в одном запросе
         :return: [<SQLAlchemy>, ...]
         """
         query = DBSession.query(cls)
         if guids:
-            query = query.cls.filter(cls.guid.in_(guids))
+            return load_chunked(query, cls.guid, guids, chunk_size, as_dict=as_dict)
         return query.all()
 
     @classmethod
@@ -24,14 +33,64 @@ class GuidPK:
         """
         query = DBSession.query(cls)
         if guids:
-            query = query.cls.filter(cls.guid.in_(guids))
+            query = query.filter(cls.guid.in_(guids))
         return query
 
     @classmethod
+    @instrumented(single_row=True)
     def get_item(cls, guid):
         """
         Получение объекта
         :param guid: <UUID>
         :return: <SQLAlchemy>
         """
+        if cls.identity_cache is not None:
+            return cls.identity_cache.get(cls, 'guid', guid,
+                                          lambda: DBSession.query(cls).filter(cls.guid == guid).one(), DBSession)
         return DBSession.query(cls).filter(cls.guid == guid).one()
+
+    @classmethod
+    def iter_pages(cls, page_size=1000, order_by=None, query=None):
+        """
+        Обход таблицы страницами без OFFSET (keyset пагинация по полю order_by и guid)
+        :param page_size: <int> размер страницы
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :return: генератор списков [<SQLAlchemy>, ...]
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'guid', order_by)
+        return keyset.iter_pages(query, cls, order, page_size)
+
+    @classmethod
+    def iter_rows(cls, page_size=1000, order_by=None, query=None, yield_per=None):
+        """
+        Потоковый обход таблицы по одной строке: запросы страницами без OFFSET, строки страницы читаются
+        по мере обхода
+        :param page_size: <int> размер страницы (одного запроса)
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :param yield_per: <int> чтение строк страницы пачками этого размера
+        :return: генератор <SQLAlchemy>
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'guid', order_by)
+        return keyset.iter_rows(query, cls, order, page_size, yield_per=yield_per)
+
+    @classmethod
+    @instrumented()
+    def page_after(cls, cursor=None, page_size=100, order_by=None, query=None):
+        """
+        Страница после курсора (keyset пагинация по полю order_by и guid)
+        :param cursor: <str> курсор из предыдущего вызова, None - первая страница
+        :param page_size: <int> размер страницы
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :return: ([<SQLAlchemy>, ...], <str> курсор следующей страницы или None)
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'guid', order_by)
+        return keyset.page_after(query, cls, order, cursor, page_size)
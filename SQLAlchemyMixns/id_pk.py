@@ -1,29 +1,88 @@
 from pyoreol import DBSession
+from .chunked_loader import load_chunked
+from . import keyset
+from .instrumentation import instrumented
 
 
 class IdPK:
     """Миксин, добавляет методы get_item и get_list для классов с PK int типа"""
-    
+
+    # IdentityCache для get_item, по умолчанию кеш не используется
+    identity_cache = None
+
     @classmethod
-    def get_list(cls, ids=None, order_by=None):
+    @instrumented()
+    def get_list(cls, ids=None, order_by=None, as_dict=False, chunk_size=1000):
         """
-        Получение списка элементов
+        Получение списка элементов. Список ids загружается частями по chunk_size, без повторов и в порядке ids
         :param ids: [<int>, ...]
         :param order_by: <str> поле по которому будет проведена сортировка
+        :param as_dict: <bool> вернуть {<id>: <SQLAlchemy>} (только вместе с ids)
+        :param chunk_size: <int> количество ключей в одном запросе
         :return: [<SQLAlchemy>, ...]
         """
         query = DBSession.query(cls)
         if ids:
-            query = query.filter(cls.id.in_(ids))
+            return load_chunked(query, cls.id, ids, chunk_size, order_by=order_by, as_dict=as_dict)
         if order_by:
             query = query.order_by(getattr(cls, order_by))
         return query.all()
     
     @classmethod
+    @instrumented(single_row=True)
     def get_item(cls, id):
         """
         Получение объекта
         :param id: <int>
         :return: <SQLAlchemy>
         """
+        if cls.identity_cache is not None:
+            return cls.identity_cache.get(cls, 'id', id, lambda: DBSession.query(cls).filter(cls.id == id).one(),
+                                          DBSession)
         return DBSession.query(cls).filter(cls.id == id).one()
+
+    @classmethod
+    def iter_pages(cls, page_size=1000, order_by=None, query=None):
+        """
+        Обход таблицы страницами без OFFSET (keyset пагинация по полю order_by и id)
+        :param page_size: <int> размер страницы
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :return: генератор списков [<SQLAlchemy>, ...]
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'id', order_by)
+        return keyset.iter_pages(query, cls, order, page_size)
+
+    @classmethod
+    def iter_rows(cls, page_size=1000, order_by=None, query=None, yield_per=None):
+        """
+        Потоковый обход таблицы по одной строке: запросы страницами без OFFSET, строки страницы читаются
+        по мере обхода
+        :param page_size: <int> размер страницы (одного запроса)
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :param yield_per: <int> чтение строк страницы пачками этого размера
+        :return: генератор <SQLAlchemy>
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'id', order_by)
+        return keyset.iter_rows(query, cls, order, page_size, yield_per=yield_per)
+
+    @classmethod
+    @instrumented()
+    def page_after(cls, cursor=None, page_size=100, order_by=None, query=None):
+        """
+        Страница после курсора (keyset пагинация по полю order_by и id)
+        :param cursor: <str> курсор из предыдущего вызова, None - первая страница
+        :param page_size: <int> размер страницы
+        :param order_by: <str> поле по которому будет проведена сортировка, '-' в начале - по убыванию
+        :param query: запрос с фильтрами, по умолчанию вся таблица
+        :return: ([<SQLAlchemy>, ...], <str> курсор следующей страницы или None)
+        """
+        if query is None:
+            query = DBSession.query(cls)
+        order = keyset.keyset_order(cls, 'id', order_by)
+        return keyset.page_after(query, cls, order, cursor, page_size)
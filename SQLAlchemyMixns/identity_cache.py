@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, make_transient_to_detached, scoped_session
+from sqlalchemy.orm.attributes import set_committed_value
+
+# ключ session.info: {<IdentityCache>: [<pk или модель>, ...]} - записи, измененные в текущей транзакции сессии
+_PENDING_KEY = 'identity_cache_pending'
+
+
+def detached_copy(item):
+    """
+    Отсоединенная от сессии копия загруженного объекта: копируются только колонки, связи остаются незагруженными
+    :param item: <SQLAlchemy>
+    :return: <SQLAlchemy>
+    """
+    state = inspect(item)
+    mapper = state.mapper
+    copy = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        if attr.key in state.dict:
+            set_committed_value(copy, attr.key, state.dict[attr.key])
+    make_transient_to_detached(copy)
+    return copy
+
+
+def primary_key(item):
+    """Первичный ключ объекта в виде кортежа"""
+    return tuple(inspect(item).mapper.primary_key_from_instance(item))
+
+
+def _real_session(session):
+    return session() if isinstance(session, scoped_session) else session
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _release_pending(session):
+    """Конец транзакции: записи, измененные в ней, сбрасываются еще раз и снова могут попадать в кеш"""
+    pending = session.info.pop(_PENDING_KEY, None)
+    if pending:
+        for cache, keys in pending.items():
+            cache._release(keys)
+
+
+@event.listens_for(Session, 'after_transaction_end')
+def _release_pending_on_end(session, transaction):
+    # rollback без обращений к БД не вызывает after_rollback
+    if transaction.parent is None:
+        _release_pending(session)
+
+
+class IdentityCache:
+    """
+    Кеш объектов модели для get_item/aliased_item с вытеснением по размеру (LRU) и по времени жизни (ttl).
+    Подключается атрибутом класса модели: identity_cache = IdentityCache(maxsize=500, ttl=300).
+    В кеше хранятся отсоединенные копии объектов, в сессию возвращается merge(load=False) копии, поэтому один
+    объект кеша можно безопасно отдавать разным сессиям и потокам. Записи сбрасываются в save/update/remove,
+    bulk_update и bulk_delete модели и еще раз после commit/rollback транзакции, в которой объект изменен;
+    до конца этой транзакции объект в кеш не попадает. Кеш не заполняется из сессии, в которой есть
+    несохраненные (new/dirty/deleted) или измененные в текущей транзакции объекты
+    """
+
+    def __init__(self, maxsize=1000, ttl=None):
+        """
+        :param maxsize: <int> максимальное количество объектов
+        :param ttl: <float> время жизни записи в секундах, None - без ограничения
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._keys_by_pk = dict()
+        # pk и модели, измененные в незавершенных транзакциях: {<pk или модель>: <количество транзакций>}
+        self._pending = dict()
+        # номер сброса после конца транзакции: объект, загруженный до сброса, в кеш не сохраняется
+        self._generation = 0
+        self._lock = RLock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, model, field, value, loader, session):
+        """
+        Объект из кеша или из БД через loader
+        :param model: класс модели
+        :param field: <str> поле, по которому ищется объект (id, guid, alias)
+        :param value: значение поля
+        :param loader: функция без аргументов, загружающая объект из БД
+        :param session: сессия, к которой присоединяется объект из кеша
+        :return: <SQLAlchemy>
+        """
+        key = (model, field, value)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                expires, pk, snapshot = entry
+                if expires is None or expires > monotonic():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                else:
+                    self._pop(key)
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            generation = self._generation
+        if entry is not None:
+            return self._attach(snapshot, session)
+
+        item = loader()
+        if self._can_fill(session):
+            self.put(key, item, generation)
+        return item
+
+    def put(self, key, item, generation=None):
+        """
+        Сохранение отсоединенной копии объекта под ключом key. Объект, измененный в незавершенной транзакции,
+        не сохраняется
+        :param generation: <int> значение _generation до загрузки объекта: если с тех пор завершилась транзакция
+        с изменениями, объект мог устареть и не сохраняется
+        """
+        snapshot = detached_copy(item)
+        pk = (type(item), primary_key(item))
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if pk in self._pending or pk[0] in self._pending or \
+                    generation is not None and generation != self._generation:
+                return
+            self._pop(key)
+            self._items[key] = (expires, pk, snapshot)
+            self._keys_by_pk.setdefault(pk, set()).add(key)
+            while len(self._items) > self.maxsize:
+                self._pop(next(iter(self._items)))
+                self.evictions += 1
+
+    def invalidate(self, item, session=None):
+        """
+        Удаление из кеша всех записей объекта (по первичному ключу, под любыми полями поиска)
+        :param session: сессия, в транзакции которой изменен объект: до ее commit/rollback объект в кеш не попадает
+        """
+        pk = (type(item), primary_key(item))
+        with self._lock:
+            self._discard(pk)
+            if session is not None:
+                self._defer(session, pk)
+
+    def invalidate_model(self, model, session=None):
+        """
+        Удаление из кеша всех объектов модели
+        :param session: сессия, в транзакции которой изменены объекты модели
+        """
+        with self._lock:
+            self._discard_model(model)
+            if session is not None:
+                self._defer(session, model)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._keys_by_pk.clear()
+
+    def stats(self):
+        """
+        Счетчики кеша
+        :return: {'hits': <int>, 'misses': <int>, 'evictions': <int>, 'size': <int>, 'hit_ratio': <float>}
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._items), 'hit_ratio': self.hits / total if total else 0.0}
+
+    def _discard(self, pk):
+        for key in self._keys_by_pk.pop(pk, ()):
+            self._items.pop(key, None)
+
+    def _discard_model(self, model):
+        for key in [key for key in self._items if key[0] is model]:
+            self._pop(key)
+
+    def _defer(self, session, pending_key):
+        """Запрет заполнения кеша записью pending_key до конца транзакции сессии"""
+        keys = _real_session(session).info.setdefault(_PENDING_KEY, dict()).setdefault(self, list())
+        keys.append(pending_key)
+        self._pending[pending_key] = self._pending.get(pending_key, 0) + 1
+
+    def _release(self, pending_keys):
+        """Конец транзакции, в которой изменены pending_keys"""
+        with self._lock:
+            self._generation += 1
+            for pending_key in pending_keys:
+                if isinstance(pending_key, tuple):
+                    self._discard(pending_key)
+                else:
+                    self._discard_model(pending_key)
+                count = self._pending.get(pending_key, 0) - 1
+                if count > 0:
+                    self._pending[pending_key] = count
+                else:
+                    self._pending.pop(pending_key, None)
+
+    @staticmethod
+    def _can_fill(session):
+        """Сессия видит только закоммиченные данные: нет несохраненных объектов и изменений через миксины"""
+        session = _real_session(session)
+        return not (session.new or session.dirty or session.deleted or session.info.get(_PENDING_KEY))
+
+    def _pop(self, key):
+        entry = self._items.pop(key, None)
+        if entry is not None:
+            keys = self._keys_by_pk.get(entry[1])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_pk[entry[1]]
+
+    @staticmethod
+    def _attach(snapshot, session):
+        """Объект сессии для копии из кеша без запроса к БД. Уже загруженный в сессию объект не перезаписывается"""
+        existing = session.identity_map.get(inspect(snapshot).key)
+        if existing is not None:
+            return existing
+        return session.merge(snapshot, load=False)
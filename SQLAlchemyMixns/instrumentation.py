@@ -0,0 +1,189 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# верхние границы корзин гистограммы времени выполнения, секунды
+HISTOGRAM_BOUNDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_current_method = ContextVar('instrumented_method', default=None)
+_current_scope = ContextVar('instrumented_scope', default=None)
+
+
+class RequestScope:
+    """Статистика одного запроса (обработки API вызова): количество SQL запросов и одиночных выборок по методам"""
+
+    def __init__(self, threshold):
+        """
+        :param threshold: <int> количество одиночных выборок одного метода, после которого он считается N+1
+        """
+        self.threshold = threshold
+        self.queries = 0
+        self.lookups = dict()
+
+    @property
+    def n_plus_one(self):
+        """
+        Методы, вызванные для одиночной выборки threshold и более раз
+        :return: {'Model.method': <int>, ...}
+        """
+        return {key: count for key, count in self.lookups.items() if count >= self.threshold}
+
+
+class Instrumentation:
+    """
+    Метрики методов миксинов: количество вызовов, ошибок и SQL запросов, гистограмма времени выполнения по
+    модели и методу, кандидаты в N+1 (повторные одиночные выборки в пределах request_scope).
+    По умолчанию выключено, включается enable()
+    """
+
+    def __init__(self, bounds=HISTOGRAM_BOUNDS, n_plus_one_threshold=5):
+        """
+        :param bounds: верхние границы корзин гистограммы в секундах
+        :param n_plus_one_threshold: <int> порог одиночных выборок одного метода в запросе для N+1
+        """
+        self.bounds = tuple(bounds)
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.enabled = False
+        self._engine = None
+        self._lock = Lock()
+        self.reset()
+
+    def enable(self, engine=Engine):
+        """
+        Включение сбора метрик
+        :param engine: движок, SQL запросы которого считаются (по умолчанию все движки)
+        """
+        if self._engine is None:
+            event.listen(engine, 'before_cursor_execute', self._on_query)
+            self._engine = engine
+        self.enabled = True
+
+    def disable(self):
+        if self._engine is not None:
+            event.remove(self._engine, 'before_cursor_execute', self._on_query)
+            self._engine = None
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._methods = dict()
+            self._n_plus_one = dict()
+            self._queries = 0
+
+    @contextmanager
+    def request_scope(self):
+        """
+        Область одного запроса для поиска N+1:
+            with metrics.request_scope() as scope:
+                ...
+            scope.n_plus_one
+        :return: <RequestScope>
+        """
+        scope = RequestScope(self.n_plus_one_threshold)
+        token = _current_scope.set(scope)
+        try:
+            yield scope
+        finally:
+            _current_scope.reset(token)
+
+    def record(self, key, elapsed, error=False, single_row=False):
+        """
+        Учет вызова метода
+        :param key: <str> 'Model.method'
+        :param elapsed: <float> время выполнения в секундах
+        :param error: <bool> метод завершился исключением
+        :param single_row: <bool> выборка одной строки (учитывается для N+1)
+        """
+        with self._lock:
+            stats = self._stats(key)
+            stats['count'] += 1
+            stats['total'] += elapsed
+            if elapsed > stats['max']:
+                stats['max'] = elapsed
+            if error:
+                stats['errors'] += 1
+            stats['buckets'][bisect_left(self.bounds, elapsed)] += 1
+            if single_row:
+                scope = _current_scope.get()
+                if scope is not None:
+                    count = scope.lookups[key] = scope.lookups.get(key, 0) + 1
+                    if count == scope.threshold:
+                        self._n_plus_one[key] = self._n_plus_one.get(key, 0) + 1
+
+    def snapshot(self):
+        """
+        Копия накопленных метрик
+        :return: {'queries': <int>, 'methods': {'Model.method': {...}}, 'n_plus_one': {'Model.method': <int>}}
+        """
+        labels = ['<={}'.format(bound) for bound in self.bounds] + ['+Inf']
+        with self._lock:
+            methods = dict()
+            for key, stats in self._methods.items():
+                methods[key] = {
+                    'count': stats['count'],
+                    'errors': stats['errors'],
+                    'queries': stats['queries'],
+                    'total': stats['total'],
+                    'max': stats['max'],
+                    'avg': stats['total'] / stats['count'] if stats['count'] else 0.0,
+                    'histogram': dict(zip(labels, stats['buckets'])),
+                }
+            return {'queries': self._queries, 'methods': methods, 'n_plus_one': dict(self._n_plus_one)}
+
+    def _stats(self, key):
+        stats = self._methods.get(key)
+        if stats is None:
+            stats = self._methods[key] = {'count': 0, 'errors': 0, 'queries': 0, 'total': 0.0, 'max': 0.0,
+                                          'buckets': [0] * (len(self.bounds) + 1)}
+        return stats
+
+    def _on_query(self, conn, cursor, statement, parameters, context, executemany):
+        if not self.enabled:
+            return
+        key = _current_method.get()
+        with self._lock:
+            self._queries += 1
+            if key is not None:
+                self._stats(key)['queries'] += 1
+        scope = _current_scope.get()
+        if scope is not None:
+            scope.queries += 1
+
+
+metrics = Instrumentation()
+
+
+def instrumented(single_row=False):
+    """
+    Декоратор метода миксина: время выполнения и SQL запросы учитываются в metrics под ключом 'Model.method'.
+    Ставится под @classmethod. При выключенных метриках только вызывает метод
+    :param single_row: <bool> метод выбирает одну строку (get_item, aliased_item)
+    """
+    def decorator(func):
+        name = func.__name__
+
+        @wraps(func)
+        def wrapper(owner, *args, **kwargs):
+            if not metrics.enabled:
+                return func(owner, *args, **kwargs)
+            model = owner if isinstance(owner, type) else type(owner)
+            key = '{}.{}'.format(model.__name__, name)
+            token = _current_method.set(key)
+            error = False
+            start = perf_counter()
+            try:
+                return func(owner, *args, **kwargs)
+            except Exception:
+                error = True
+                raise
+            finally:
+                elapsed = perf_counter() - start
+                _current_method.reset(token)
+                metrics.record(key, elapsed, error, single_row)
+        return wrapper
+    return decorator
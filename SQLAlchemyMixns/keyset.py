@@ -0,0 +1,165 @@
+import base64
+import datetime
+import decimal
+import json
+import uuid
+from sqlalchemy import and_, or_
+
+# теги типов значений в курсоре: json не различает эти типы
+_ENCODERS = (
+    (datetime.datetime, 'dt', datetime.datetime.isoformat),
+    (datetime.date, 'd', datetime.date.isoformat),
+    (uuid.UUID, 'u', str),
+    (decimal.Decimal, 'n', str),
+)
+_DECODERS = {
+    'dt': datetime.datetime.fromisoformat,
+    'd': datetime.date.fromisoformat,
+    'u': uuid.UUID,
+    'n': decimal.Decimal,
+}
+
+
+def _encode_value(value):
+    for value_type, tag, encoder in _ENCODERS:
+        if isinstance(value, value_type):
+            return [tag, encoder(value)]
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return _DECODERS[value[0]](value[1])
+    return value
+
+
+def encode_cursor(order, values):
+    """
+    Непрозрачный курсор страницы: порядок сортировки и значения ключей последней строки
+    :param order: [<str>, ...] поля сортировки ('-' в начале - по убыванию)
+    :param values: [<value>, ...] значения полей последней строки
+    :return: <str>
+    """
+    data = json.dumps({'o': order, 'v': [_encode_value(v) for v in values]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, order):
+    """
+    Значения ключей из курсора
+    :param cursor: <str> результат encode_cursor
+    :param order: [<str>, ...] ожидаемый порядок сортировки
+    :return: [<value>, ...]
+    """
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8'))
+        values = [_decode_value(v) for v in data['v']]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Invalid cursor')
+    if data.get('o') != order or len(values) != len(order):
+        raise ValueError('Cursor does not match order "{}"'.format(','.join(order)))
+    return values
+
+
+def keyset_order(model, pk_field, order_by=None):
+    """
+    Порядок сортировки для постраничной выборки: поле order_by и первичный ключ для однозначности.
+    Колонка order_by не должна содержать NULL
+    :param model: класс модели
+    :param pk_field: <str> первичный ключ (id, guid)
+    :param order_by: <str> поле сортировки, '-' в начале - по убыванию
+    :return: [<str>, ...]
+    """
+    order = []
+    if order_by and order_by.lstrip('-') != pk_field:
+        order.append(order_by)
+    if order_by and order_by.startswith('-'):
+        order.append('-' + pk_field)
+    else:
+        order.append(pk_field)
+    for field in order:
+        getattr(model, field.lstrip('-'))
+    return order
+
+
+def _seek_filter(model, order, values):
+    """
+    Условие "строго после строки со значениями values" для порядка order:
+    (a > x) OR (a = x AND b > y) ...
+    """
+    clauses = []
+    equals = []
+    for field, value in zip(order, values):
+        attr = getattr(model, field.lstrip('-'))
+        after = attr < value if field.startswith('-') else attr > value
+        clauses.append(and_(*(equals + [after])))
+        equals.append(attr == value)
+    return or_(*clauses)
+
+
+def _order_clauses(model, order):
+    return [getattr(model, field[1:]).desc() if field.startswith('-') else getattr(model, field)
+            for field in order]
+
+
+def _page_query(query, model, order, cursor, limit):
+    if cursor is not None:
+        query = query.filter(_seek_filter(model, order, decode_cursor(cursor, order)))
+    return query.order_by(*_order_clauses(model, order)).limit(limit)
+
+
+def _row_cursor(order, row):
+    return encode_cursor(order, [getattr(row, field.lstrip('-')) for field in order])
+
+
+def page_after(query, model, order, cursor=None, page_size=100):
+    """
+    Страница строк после курсора (keyset/seek пагинация): время выборки не зависит от номера страницы
+    :param query: запрос по модели
+    :param model: класс модели
+    :param order: результат keyset_order
+    :param cursor: <str> курсор предыдущей страницы, None - первая страница
+    :param page_size: <int> размер страницы
+    :return: ([<SQLAlchemy>, ...], <str> курсор следующей страницы или None)
+    """
+    items = _page_query(query, model, order, cursor, page_size + 1).all()
+    if len(items) <= page_size:
+        return items, None
+    items.pop()
+    return items, _row_cursor(order, items[-1])
+
+
+def iter_pages(query, model, order, page_size=1000, cursor=None):
+    """
+    Последовательный обход всех строк запроса страницами по page_size
+    :return: генератор списков [<SQLAlchemy>, ...]
+    """
+    while True:
+        items, cursor = page_after(query, model, order, cursor, page_size)
+        if items:
+            yield items
+        if cursor is None:
+            return
+
+
+def iter_rows(query, model, order, page_size=1000, cursor=None, yield_per=None):
+    """
+    Потоковый обход всех строк запроса: строки отдаются по одной по мере чтения, страница целиком в памяти
+    не собирается. Курсор следующей страницы считается по последней отданной строке
+    :param page_size: <int> размер страницы (одного запроса)
+    :param cursor: <str> курсор, после которого начинается обход
+    :param yield_per: <int> чтение строк страницы пачками этого размера
+    :return: генератор <SQLAlchemy>
+    """
+    while True:
+        page = _page_query(query, model, order, cursor, page_size)
+        if yield_per:
+            page = page.yield_per(yield_per)
+        count = 0
+        for row in page:
+            count += 1
+            if count == page_size:
+                cursor = _row_cursor(order, row)
+            yield row
+        if count < page_size:
+            return
@@ -1,5 +1,30 @@
-import datetime
-from my_libs.utils import datetime2str
+from time import perf_counter
+from sqlalchemy import bindparam, inspect
+from sqlalchemy.orm import object_session
+from my_libs.utils import RowSerializer
+from .instrumentation import instrumented
+
+
+class BulkStats:
+    """Результат массовой операции: количество строк, время выполнения и идентификаторы вставленных строк"""
+
+    def __init__(self, rows=0, elapsed=0.0, ids=None):
+        """
+        :param rows: <int> количество обработанных строк
+        :param elapsed: <float> время выполнения в секундах
+        :param ids: [<pk>, ...] идентификаторы вставленных строк в порядке входных данных (если доступен RETURNING)
+        """
+        self.rows = rows
+        self.elapsed = elapsed
+        self.ids = ids
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __repr__(self):
+        return '<BulkStats rows={} elapsed={:.3f}s rows/s={:.0f}>'.format(self.rows, self.elapsed,
+                                                                          self.rows_per_second)
 
 
 class GeneralMethodMixin:
@@ -17,42 +42,37 @@ class GeneralMethodMixin:
         :param b: список колонок, которые не должны добавляться в словарь
         :return: словарь
         """
-        d = dict()
-        if not b:
-            b = list()
-
-        for c in self.__table__.columns:
-            if c.name not in b:
-                value = getattr(self, c.name)
-                if isinstance(value, datetime.datetime):
-                    value = datetime2str(date_time=value)
-                elif isinstance(value, datetime.timedelta):
-                    value = str(value)
-                d[c.name] = value
-
-        if add_prop:
-            for k in add_prop:
-                try:
-                    value = getattr(self, k)
-                    if isinstance(value, datetime.datetime):
-                        value = datetime2str(date_time=value)
-                    elif isinstance(value, datetime.timedelta):
-                        value = str(value)
-                    d[k] = value
-                except AttributeError:
-                    if strict_mode:
-                        raise AttributeError('Аттрибут %s неопределен' % k)
-        return d
+        return RowSerializer.for_class(type(self), b, add_prop, strict_mode)(self)
+
+    @classmethod
+    def dicts(cls, query=None, b=None, batch_size=1000):
+        """
+        Потоковая выгрузка строк в словари без создания объектов ORM: выбираются только колонки таблицы, строки
+        читаются через yield_per и преобразуются пачками так же, как в row2dict
+        :param query: запрос по модели (фильтры, сортировка), по умолчанию вся таблица
+        :param b: список колонок, которые не должны добавляться в словарь
+        :param batch_size: <int> размер пачки
+        :return: генератор словарей
+        """
+        serializer = RowSerializer.for_class(cls, b)
+        columns = [cls.__table__.columns[name] for name in serializer.names]
+        if query is None:
+            if cls.dbsession is None:
+                raise AttributeError('Session not exist')
+            query = cls.dbsession.query(*columns)
+        else:
+            query = query.with_entities(*columns)
+        return serializer.iter_rows(query.yield_per(batch_size), batch_size)
 
     @classmethod
+    @instrumented()
     def create(cls, data, exclude=('id',), flush=False):
         """Создание объекта"""
-        columns = {c.name for c in cls.__table__.columns if c.name not in exclude}
-        result = {k: v for k, v in data.items() if k in columns}
-        item = cls(**result)
+        item = cls(**cls._column_values(data, cls._columns(exclude)))
         item.save(flush=flush)
         return item
 
+    @instrumented()
     def save(self, dbsession=None, flush=False):
         """Сохранение элемента в базе данных. :param dbsession(deprecated) - Объект сессии. :param flush - булевой
          параметр, отвечащий за моментальный сброс в БД"""
@@ -62,20 +82,17 @@ class GeneralMethodMixin:
             self.dbsession.add(self)
             if flush:
                 self.dbsession.flush()
+        self._invalidate_cache()
         return self
 
+    @instrumented()
     def update(self, data, exclude=('id',)):
         """Обновление данных объекта"""
-        for column in self.__table__.columns:
-            if column.name in exclude:
-                continue
-            if column.name in data:
-                data_value = data.get(column.name)
-                if column.nullable is False and data_value is None:
-                    raise ValueError('Field "{}" is not nullable'.format(column.name))
-                else:
-                    setattr(self, column.name, data_value)
+        for name, value in self._column_values(data, self._columns(exclude), check_nullable=True).items():
+            setattr(self, name, value)
+        self._invalidate_cache()
 
+    @instrumented()
     def remove(self, dbsession=None, flush=False):
         """Удаление элемента из базы данных. :param dbsession - Объект сессии(deprecated). :param flush - булевой
          параметр, отвечащий за моментальный сброс в БД"""
@@ -85,3 +102,158 @@ class GeneralMethodMixin:
             self.dbsession.delete(self)
             if flush:
                 self.dbsession.flush()
+        self._invalidate_cache()
+
+    def _invalidate_cache(self):
+        """
+        Сброс объекта в identity_cache и alias_map модели (IdPK, GuidPK, AliasMixin), если они подключены.
+        Записи identity_cache сбрасываются еще раз после commit/rollback сессии объекта
+        """
+        cache = getattr(self, 'identity_cache', None)
+        if cache is not None:
+            cache.invalidate(self, object_session(self))
+        alias_map = getattr(self, 'alias_map', None)
+        if alias_map is not None:
+            pk = inspect(self).identity
+            alias_map.forget(type(self), pk=pk[0] if pk else None, alias=getattr(self, 'alias', None))
+
+    @classmethod
+    def _invalidate_model_cache(cls, session=None):
+        cache = getattr(cls, 'identity_cache', None)
+        if cache is not None:
+            cache.invalidate_model(cls, session)
+        alias_map = getattr(cls, 'alias_map', None)
+        if alias_map is not None:
+            alias_map.clear(cls)
+
+    @classmethod
+    def _columns(cls, exclude=()):
+        """Колонки таблицы без исключенных: [(<имя>, <not nullable>), ...]"""
+        return [(c.name, c.nullable is False) for c in cls.__table__.columns if c.name not in exclude]
+
+    @staticmethod
+    def _column_values(data, columns, check_nullable=False):
+        """
+        Значения колонок из словаря data
+        :param columns: результат _columns
+        :param check_nullable: <bool> ошибка, если not nullable колонке передан None
+        :return: <dict>
+        """
+        result = {}
+        for name, not_nullable in columns:
+            if name in data:
+                value = data[name]
+                if check_nullable and not_nullable and value is None:
+                    raise ValueError('Field "{}" is not nullable'.format(name))
+                result[name] = value
+        return result
+
+    @classmethod
+    def _bulk_batches(cls, rows, columns, batch_size, extra=()):
+        """
+        Разбивка строк на пачки с одинаковым набором колонок: executemany требует одинаковых ключей у всех строк
+        :param extra: имена полей, которые переносятся в пачку без проверки (ключ для bulk_update)
+        :return: генератор ([<индекс строки>, ...], [<dict>, ...])
+        """
+        groups = dict()
+        for index, row in enumerate(rows):
+            values = cls._column_values(row, columns, check_nullable=True)
+            for name in extra:
+                values['_' + name] = row[name]
+            keys = tuple(values)
+            indexes, group = groups.setdefault(keys, ([], []))
+            indexes.append(index)
+            group.append(values)
+            if len(group) >= batch_size:
+                yield groups.pop(keys)
+        for batch in groups.values():
+            yield batch
+
+    @classmethod
+    def _bulk_session(cls):
+        if cls.dbsession is None:
+            raise AttributeError('Session not exist')
+        return cls.dbsession
+
+    @classmethod
+    @instrumented()
+    def bulk_create(cls, rows, exclude=('id',), batch_size=1000):
+        """
+        Массовая вставка строк пачками через executemany, без создания объектов ORM. Колонки отбираются как в
+        create, not nullable колонки проверяются как в update. Если диалект поддерживает RETURNING для executemany,
+        возвращаются идентификаторы вставленных строк
+        :param rows: [<dict>, ...]
+        :param exclude: колонки, которые не вставляются
+        :param batch_size: <int> размер пачки
+        :return: <BulkStats>
+        """
+        session = cls._bulk_session()
+        table = cls.__table__
+        columns = cls._columns(exclude)
+        dialect = session.get_bind(mapper=cls).dialect
+        returning = getattr(dialect, 'insert_executemany_returning', False) and len(table.primary_key.columns) > 0
+        statement = table.insert()
+        if returning:
+            statement = statement.returning(*table.primary_key.columns, sort_by_parameter_order=True)
+        single_pk = len(table.primary_key.columns) == 1
+        ids = dict() if returning else None
+        count = 0
+        start = perf_counter()
+        for indexes, batch in cls._bulk_batches(rows, columns, batch_size):
+            result = session.execute(statement, batch, bind_arguments={'mapper': cls})
+            count += len(batch)
+            if returning:
+                for index, pk in zip(indexes, result):
+                    ids[index] = pk[0] if single_pk else tuple(pk)
+        if ids is not None:
+            ids = [ids[index] for index in range(len(ids))]
+        return BulkStats(count, perf_counter() - start, ids)
+
+    @classmethod
+    @instrumented()
+    def bulk_update(cls, rows, key='id', exclude=('id',), batch_size=1000):
+        """
+        Массовое обновление строк по ключевой колонке пачками через executemany (UPDATE ... WHERE key = ...).
+        Обновляются только колонки, переданные в строке; проверки как в update
+        :param rows: [<dict>, ...] в каждой строке должно быть значение ключевой колонки
+        :param key: <str> ключевая колонка
+        :param exclude: колонки, которые не обновляются
+        :param batch_size: <int> размер пачки
+        :return: <BulkStats> rows - количество обновленных строк
+        """
+        session = cls._bulk_session()
+        table = cls.__table__
+        columns = cls._columns(set(exclude) | {key})
+        statement = table.update().where(table.columns[key] == bindparam('_' + key))
+        count = 0
+        start = perf_counter()
+        for _, batch in cls._bulk_batches(rows, columns, batch_size, extra=(key,)):
+            if len(batch[0]) == 1:
+                continue
+            result = session.execute(statement, batch, bind_arguments={'mapper': cls})
+            count += result.rowcount if result.rowcount >= 0 else len(batch)
+        cls._invalidate_model_cache(session)
+        return BulkStats(count, perf_counter() - start)
+
+    @classmethod
+    @instrumented()
+    def bulk_delete(cls, ids, key='id', batch_size=1000):
+        """
+        Массовое удаление строк по значениям ключевой колонки пачками (DELETE ... WHERE key IN (...))
+        :param ids: [<pk>, ...]
+        :param key: <str> ключевая колонка
+        :param batch_size: <int> размер пачки
+        :return: <BulkStats> rows - количество удаленных строк
+        """
+        session = cls._bulk_session()
+        statement = cls.__table__.delete()
+        column = cls.__table__.columns[key]
+        ids = list(ids)
+        count = 0
+        start = perf_counter()
+        for i in range(0, len(ids), batch_size):
+            chunk = ids[i:i + batch_size]
+            result = session.execute(statement.where(column.in_(chunk)), bind_arguments={'mapper': cls})
+            count += result.rowcount if result.rowcount >= 0 else len(chunk)
+        cls._invalidate_model_cache(session)
+        return BulkStats(count, perf_counter() - start)
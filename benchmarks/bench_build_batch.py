@@ -0,0 +1,23 @@
+"""Документов в секунду у build_batch по количеству процессов. Запуск: python benchmarks/bench_build_batch.py"""
+import os
+from time import perf_counter
+
+from my_libs.pdf_creator import build_batch
+
+
+def benchmark_build_batch(count=200):
+    """Документов в секунду у build_batch в зависимости от количества процессов"""
+    spec = {'header': {'document_header_1': 'Акт', 'content': ['Утверждаю', 'Директор']},
+            'tables': [{'content': [[str(i), 'Позиция', '1'] for i in range(50)], 'headers': [['№', 'Имя', 'Кол']]}],
+            'bottom': {'content': ['Итого'], 'sign': 'Подпись'}}
+    workers = 1
+    while workers <= (os.cpu_count() or 1):
+        start = perf_counter()
+        for _ in build_batch((spec for _ in range(count)), workers=workers):
+            pass
+        print('build_batch workers={}: {:.1f} док/с'.format(workers, count / (perf_counter() - start)))
+        workers *= 2
+
+
+if __name__ == '__main__':
+    benchmark_build_batch()
@@ -0,0 +1,20 @@
+"""Строк в секунду у add_table и add_large_table. Запуск: python benchmarks/bench_large_table.py"""
+from time import perf_counter
+
+from my_libs.pdf_creator import PdfCreator
+
+
+def benchmark_large_table(rows=5000):
+    """Строк в секунду при верстке большой таблицы: add_table и add_large_table"""
+    content = [[str(i), 'Позиция {}'.format(i % 100), '{:.2f}'.format(i * 1.5)] for i in range(rows)]
+    headers = [['№', 'Наименование', 'Сумма']]
+    for name in ('add_table', 'add_large_table'):
+        creator = PdfCreator()
+        start = perf_counter()
+        getattr(creator, name)(content, headers=headers, colWidths=[60, 250, 100])
+        creator.build()
+        print('{}: {:.0f} строк/с'.format(name, rows / (perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    benchmark_large_table()
@@ -0,0 +1,28 @@
+"""Время создания PdfCreator с общим реестром шрифтов и стилей. Запуск: python benchmarks/bench_pdf_styles.py"""
+from time import perf_counter
+
+from my_libs import pdf_creator
+from my_libs.pdf_creator import PdfCreator, PStyle, prewarm
+
+
+def benchmark_pdf_creator(count=200):
+    """
+    Время создания PdfCreator без pstyles: с разбором TTF и сборкой стилей на каждый документ (как раньше)
+    и с общим реестром шрифтов и стилей
+    """
+    start = perf_counter()
+    for _ in range(count):
+        pdf_creator._registered_fonts.clear()
+        PdfCreator(pstyles=PStyle())
+    before = (perf_counter() - start) / count
+
+    prewarm()
+    start = perf_counter()
+    for _ in range(count):
+        PdfCreator()
+    after = (perf_counter() - start) / count
+    print('PdfCreator(): {:.3f} ms -> {:.3f} ms на документ'.format(before * 1000, after * 1000))
+
+
+if __name__ == '__main__':
+    benchmark_pdf_creator()
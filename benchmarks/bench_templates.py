@@ -0,0 +1,31 @@
+"""Подготовка шапки и "низа": add_header/add_bottom и шаблоны. Запуск: python benchmarks/bench_templates.py"""
+from time import perf_counter
+
+from my_libs.pdf_creator import PdfCreator
+
+
+def benchmark_templates(count=1000):
+    """Время подготовки шапки и "низа" документа: add_header/add_bottom и заполнение шаблонов"""
+    header = dict(content=['Утверждаю', 'Директор'], sign='Подпись', header_title='Утверждено',
+                  document_header_2='о приемке работ')
+    start = perf_counter()
+    for i in range(count):
+        creator = PdfCreator()
+        creator.add_header('Акт №{}'.format(i), timestamp='01.01.2020', **header)
+        creator.add_bottom(['Сдал', 'Принял'], sign='Подпись')
+    before = (perf_counter() - start) / count
+
+    creator = PdfCreator()
+    header_template = creator.header_template('Акт №{number}', timestamp='{date}', **header)
+    bottom_template = creator.bottom_template(['Сдал', 'Принял'], sign='Подпись')
+    start = perf_counter()
+    for i in range(count):
+        creator = PdfCreator()
+        creator.add_template(header_template, number=i, date='01.01.2020')
+        creator.add_template(bottom_template)
+    after = (perf_counter() - start) / count
+    print('шапка и низ: {:.3f} ms -> {:.3f} ms на документ'.format(before * 1000, after * 1000))
+
+
+if __name__ == '__main__':
+    benchmark_templates()
@@ -0,0 +1,47 @@
+"""Сравнение gis_tree_constructor и рекурсивного gis_tree_constructor_old: python benchmarks/bench_trees.py"""
+import random
+import time
+
+from my_libs.trees import gis_tree_constructor, gis_tree_constructor_old
+
+
+class Element:
+    def __init__(self, id, parent_id):
+        self.id = id
+        self.parent_id = parent_id
+        self.text = 'element %s' % id
+        self.tag = id % 10
+        self.factors_count = id % 3
+
+    def row2dict(self, add_prop=None):
+        d = dict(id=self.id, parent_id=self.parent_id)
+        for k in add_prop or ():
+            d[k] = getattr(self, k)
+        return d
+
+
+def benchmark_gis_tree_constructor(sizes=(1000, 10000, 100000), old_limit=10000):
+    """
+    Сравнение gis_tree_constructor и gis_tree_constructor_old на случайном дереве.
+    Старая версия квадратична, поэтому для размеров больше old_limit не запускается.
+    """
+    print('%10s %12s %12s' % ('nodes', 'old, s', 'new, s'))
+    for size in sizes:
+        source = [Element(i, random.randint(0, i - 1) or None) for i in range(1, size + 1)]
+
+        start = time.perf_counter()
+        new_result = gis_tree_constructor(source, del_epmty_children=True)
+        new_time = time.perf_counter() - start
+
+        old_time = None
+        if size <= old_limit:
+            start = time.perf_counter()
+            old_result = gis_tree_constructor_old(source, del_epmty_children=True)
+            old_time = time.perf_counter() - start
+            assert old_result == new_result
+
+        print('%10s %12s %12.4f' % (size, '-' if old_time is None else '%.4f' % old_time, new_time))
+
+
+if __name__ == '__main__':
+    benchmark_gis_tree_constructor()
@@ -1,12 +1,71 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from copy import copy
 from io import BytesIO
+from itertools import chain, islice
 import os
+from string import Formatter
+import traceback
+from tempfile import SpooledTemporaryFile
+from threading import Lock
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.units import mm
 from reportlab.pdfbase import pdfmetrics, ttfonts
-from reportlab.platypus import Spacer, SimpleDocTemplate, Paragraph, Table
+from reportlab.platypus import Spacer, SimpleDocTemplate, Paragraph, Table, Flowable, TableStyle
 
 DEFAULT_SPACER = Spacer(0, 24)
+DEFAULT_FONTS = ('TimesNewRomanRegular.ttf', 'TimesNewRomanBold.ttf', 'TimesNewRomanItalic.ttf')
+
+# шрифты, зарегистрированные в reportlab этим процессом
+_registered_fonts = set()
+_fonts_lock = Lock()
+
+
+def register_font(font_name, path=None):
+    """
+    Регистрирует TTF шрифт в reportlab один раз на процесс, повторные вызовы не читают файл шрифта
+    :param font_name: <str> имя файла шрифта
+    :param path: <str> каталог шрифта, по умолчанию каталог модуля
+    :return: <str> имя шрифта
+    """
+    name = font_name.split('.')[0]
+    if name in _registered_fonts:
+        return name
+    with _fonts_lock:
+        if name not in _registered_fonts:
+            if path is None:
+                path = os.path.dirname(__file__)
+            pdfmetrics.registerFont(ttfonts.TTFont(name, path+'/'+font_name))
+            _registered_fonts.add(name)
+    return name
+
+
+def prewarm():
+    """
+    Регистрация шрифтов и создание общего набора стилей заранее, например при старте воркера
+    :return: <PStyle>
+    """
+    return PStyle.default()
+
+
+class _FrozenParagraphStyle(ParagraphStyle):
+    """Стиль общего набора PStyle.default(): изменять можно только копию из PStyle.copy()"""
+
+    def __setattr__(self, key, value):
+        raise AttributeError('Стиль общего набора нельзя изменять, используйте PStyle.default().copy()')
+
+
+def _freeze_style(style):
+    object.__setattr__(style, '__class__', _FrozenParagraphStyle)
+    return style
+
+
+def _thaw_style(style):
+    """Изменяемая поверхностная копия стиля"""
+    new = ParagraphStyle.__new__(ParagraphStyle)
+    new.__dict__.update(style.__dict__)
+    return new
 
 
 class PStyle:
@@ -14,13 +73,18 @@ class PStyle:
     Класс задает стиль параграфов
     """
 
-    def __init__(self):
+    _default = None
+    _default_lock = Lock()
+
+    def __init__(self, frozen=False):
+        """
+        :param frozen: <bool> запретить изменение набора стилей (общий набор PStyle.default())
+        """
         self.path = os.path.dirname(__file__)
         self.fonts = set()
 
-        self.font_register('TimesNewRomanRegular.ttf')\
-            .font_register('TimesNewRomanBold.ttf')\
-            .font_register('TimesNewRomanItalic.ttf')
+        for font_name in DEFAULT_FONTS:
+            self.font_register(font_name)
 
         self.add_style('TimesNewRomanRegular', 'default_regular_center', alignment=1)\
             .add_style('TimesNewRomanRegular', 'default_regular')\
@@ -29,6 +93,45 @@ class PStyle:
             .add_style('TimesNewRomanBold', 'default_bold_center', alignment=1)\
             .add_style('TimesNewRomanBold', 'default_bold_right', alignment=2)\
             .add_style('TimesNewRomanItalic', 'default_italic')
+        if frozen:
+            for value in self.__dict__.values():
+                if isinstance(value, ParagraphStyle):
+                    _freeze_style(value)
+        self._frozen = frozen
+
+    def __setattr__(self, key, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Общий набор стилей нельзя изменять, используйте PStyle.default().copy()')
+        super().__setattr__(key, value)
+
+    @classmethod
+    def default(cls):
+        """
+        Общий для процесса неизменяемый набор стилей по умолчанию (сам набор и его стили). Создается один раз,
+        потокобезопасно
+        :return: <PStyle>
+        """
+        if cls._default is None:
+            with cls._default_lock:
+                if cls._default is None:
+                    cls._default = cls(frozen=True)
+        return cls._default
+
+    def copy(self):
+        """
+        Изменяемая копия набора стилей без повторной регистрации шрифтов: стили копируются поверхностно,
+        поэтому копия дешевая и изменения в ней не затрагивают исходный набор
+        :return: <PStyle>
+        """
+        new = object.__new__(type(self))
+        for key, value in self.__dict__.items():
+            if isinstance(value, ParagraphStyle):
+                value = _thaw_style(value)
+            elif isinstance(value, set):
+                value = copy(value)
+            object.__setattr__(new, key, value)
+        object.__setattr__(new, '_frozen', False)
+        return new
 
     def font_register(self, font_name, path=None, add_style=False):
         """
@@ -38,10 +141,12 @@ class PStyle:
         name = font_name.split('.')[0]
         if name in self.fonts:
             return self
+        if getattr(self, '_frozen', False):
+            raise AttributeError('Общий набор стилей нельзя изменять, используйте PStyle.default().copy()')
 
         if path is None:
             path = self.path
-        pdfmetrics.registerFont(ttfonts.TTFont(name, path+'/'+font_name))
+        register_font(font_name, path)
         self.fonts.add(name)
 
         if add_style:
@@ -71,6 +176,223 @@ class PStyle:
         return self
 
 
+def _chunk_commands(commands, headers, offset, rows):
+    """
+    Команды TableStyle для порции таблицы. Неотрицательные номера строк относятся ко всей таблице (заголовки и
+    все строки), строки данных сдвигаются на offset, команды для строк вне порции отбрасываются. Отрицательные
+    номера строк отсчитываются от конца порции
+    :param commands: [<команда>, ...]
+    :param headers: <int> количество строк заголовка (повторяются в каждой порции)
+    :param offset: <int> количество строк данных перед порцией
+    :param rows: <int> количество строк данных в порции
+    :return: [<команда>, ...]
+    """
+    if not offset:
+        return commands
+    last = headers + rows - 1
+    result = list()
+    for command in commands:
+        (start_col, start_row), (end_col, end_row) = command[1], command[2]
+        if start_row >= headers:
+            start_row = max(start_row - offset, headers)
+            if start_row > last:
+                continue
+        if end_row >= headers:
+            end_row -= offset
+            if end_row < headers:
+                if start_row >= headers or not headers:
+                    continue
+                end_row = headers - 1
+        result.append((command[0], (start_col, start_row), (end_col, end_row)) + tuple(command[3:]))
+    return result
+
+
+class LazyTable(Flowable):
+    """
+    Большая таблица, которая собирается в Table постранично при верстке: в памяти только строки текущей
+    страницы и следующей порции, заголовки повторяются на каждой странице. Строки могут приходить итератором.
+    Страницы разбиваются Table.split по реальной высоте строк, поэтому таблица занимает столько же страниц,
+    сколько Table с теми же ячейками и repeatRows=len(headers)
+    """
+
+    def __init__(self, rows, headers=None, convert=None, style=None, chunk_rows=200, **table_args):
+        """
+        :param rows: строки таблицы, список или итератор
+        :param headers: строки заголовка (уже готовые ячейки)
+        :param convert: функция преобразования строки в ячейки Table
+        :param style: список команд TableStyle или TableStyle. Неотрицательные номера строк относятся ко всей
+        таблице, отрицательные - к концу части таблицы на странице
+        :param chunk_rows: <int> сколько строк материализуется за раз, должно быть больше строк на странице
+        :param table_args: аргументы Table
+        """
+        Flowable.__init__(self)
+        # выравнивание как у Table: внутренняя таблица рисуется в (0, 0), сдвиг делает drawOn этого flowable
+        self.hAlign = table_args.get('hAlign', 'CENTER')
+        self.headers = list(headers or ())
+        self.convert = convert
+        self.style = style.getCommands() if isinstance(style, TableStyle) else style
+        self.chunk_rows = chunk_rows
+        self.table_args = table_args
+        self._rows = iter(rows)
+        self._buffer = list()
+        # количество строк, сверстанных предыдущими частями таблицы
+        self._offset = 0
+        self._table = None
+
+    def _take(self, count):
+        """Первые count строк (преобразованные), которые еще не сверстаны"""
+        missing = count - len(self._buffer)
+        if missing > 0:
+            rows = islice(self._rows, missing)
+            self._buffer.extend(map(self.convert, rows) if self.convert else rows)
+        return self._buffer[:count]
+
+    def _make_table(self, rows):
+        style = self.style
+        if style:
+            style = _chunk_commands(style, len(self.headers), self._offset, len(rows))
+        return Table(self.headers + rows, style=style, repeatRows=len(self.headers), **self.table_args)
+
+    def _rest(self, consumed):
+        """Продолжение таблицы после consumed строк с тем же итератором строк"""
+        # следующая страница обычно вмещает столько же строк: порция чуть больше сверстанной
+        chunk_rows = consumed + consumed // 4 + 1
+        rest = LazyTable((), self.headers, self.convert, self.style, chunk_rows, **self.table_args)
+        rest._rows = self._rows
+        rest._buffer = self._buffer[consumed:]
+        rest._offset = self._offset + consumed
+        return rest
+
+    def wrap(self, availWidth, availHeight):
+        rows = self._take(self.chunk_rows + 1)
+        if len(rows) > self.chunk_rows:
+            # строк больше, чем порция: размер заранее не известен, верстка пойдет через split
+            self._table = None
+            return availWidth, availHeight + 1
+        if not rows and not self.headers:
+            self._table = None
+            return 0, 0
+        self._table = self._make_table(rows)
+        return self._table.wrap(availWidth, availHeight)
+
+    def split(self, availWidth, availHeight):
+        size = self.chunk_rows
+        while True:
+            rows = self._take(size)
+            parts = self._make_table(rows).split(availWidth, availHeight)
+            if not parts:
+                return []
+            if len(parts) > 1 or len(rows) < size:
+                break
+            # порция целиком поместилась на странице: берем больше строк, чтобы не разрывать страницу
+            size *= 2
+        consumed = len(parts[0]._cellvalues) - len(self.headers) if len(parts) > 1 else len(rows)
+        if consumed >= len(self._buffer) and not self._take(consumed + 1)[consumed:]:
+            return [parts[0]]
+        return [parts[0], self._rest(consumed)]
+
+    def draw(self):
+        if self._table is not None:
+            self._table.drawOn(self.canv, 0, 0)
+
+
+def _build_parts(parts):
+    return [build(*args, **kwargs) for build, args, kwargs in parts]
+
+
+def _template_fields(value):
+    """Имена полей {name} в строках value (строка, список, кортеж, словарь)"""
+    if isinstance(value, str):
+        return {name for _, name, _, _ in Formatter().parse(value) if name}
+    if isinstance(value, (list, tuple)):
+        return set().union(*map(_template_fields, value)) if value else set()
+    if isinstance(value, dict):
+        return _template_fields(list(value.values()))
+    return set()
+
+
+def _fill_fields(value, fields):
+    """Копия value с подставленными в строки значениями полей"""
+    if isinstance(value, str):
+        return value.format_map(fields)
+    if isinstance(value, list):
+        return [_fill_fields(v, fields) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_fill_fields(v, fields) for v in value)
+    if isinstance(value, dict):
+        return {k: _fill_fields(v, fields) for k, v in value.items()}
+    return value
+
+
+class CachedFlowable(Flowable):
+    """
+    Обертка над готовым flowable, которая запоминает результат wrap: при повторном использовании в документах
+    с тем же размером фрейма верстка (перенос строк, расчет таблицы) не повторяется
+    """
+
+    def __init__(self, flowable):
+        Flowable.__init__(self)
+        self.flowable = flowable
+        self.hAlign = getattr(flowable, 'hAlign', 'LEFT')
+        self._wrapped_width = None
+
+    def wrap(self, availWidth, availHeight):
+        # размер параграфов, таблиц и отступов зависит только от ширины
+        if availWidth != self._wrapped_width:
+            self.width, self.height = self.flowable.wrap(availWidth, availHeight)
+            self._wrapped_width = availWidth
+        return self.width, self.height
+
+    def split(self, availWidth, availHeight):
+        self._wrapped_width = None
+        return self.flowable.split(availWidth, availHeight)
+
+    def getSpaceBefore(self):
+        return self.flowable.getSpaceBefore()
+
+    def getSpaceAfter(self):
+        return self.flowable.getSpaceAfter()
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self.flowable.drawOn(canvas, x, y, _sW)
+
+
+class LayoutTemplate:
+    """
+    Шаблон шапки или "низа" документа (PdfCreator.header_template, PdfCreator.bottom_template).
+    Части без полей {name} создаются один раз и переиспользуются в каждом документе вместе с размерами,
+    при заполнении создаются только части с полями. Шаблон не предназначен для одновременного использования
+    из нескольких потоков
+    """
+
+    def __init__(self, parts):
+        """
+        :param parts: [(<функция>, <args>, <kwargs>), ...] части в порядке вывода
+        """
+        self.parts = list()
+        self.fields = set()
+        for build, args, kwargs in parts:
+            fields = _template_fields(args) | _template_fields(kwargs)
+            if fields:
+                self.parts.append((None, build, args, kwargs))
+                self.fields |= fields
+            else:
+                self.parts.append((CachedFlowable(build(*args, **kwargs)), build, args, kwargs))
+
+    def fill(self, **fields):
+        """
+        Flowable шаблона с подставленными значениями полей
+        :param fields: значения полей {name}
+        :return: [<Flowable>, ...]
+        """
+        content = list()
+        for flowable, build, args, kwargs in self.parts:
+            if flowable is None:
+                flowable = build(*_fill_fields(args, fields), **_fill_fields(kwargs, fields))
+            content.append(flowable)
+        return content
+
+
 class PdfCreator:
 
     def __init__(self, pstyles=None, album_orientation=False, **kwargs):
@@ -87,7 +409,8 @@ class PdfCreator:
                                      **kwargs
                                      )
         if pstyles is None:
-            pstyles = PStyle()
+            # своя копия общего набора: стили документа можно менять и дополнять через add_style
+            pstyles = PStyle.default().copy()
         self.pstyles = pstyles
         self.content = list()
 
@@ -102,6 +425,37 @@ class PdfCreator:
         self.doc.build(self.content)
         return self.buf.getvalue()
 
+    def build_to(self, target):
+        """
+        Формирование документа с записью сразу в файл или файловый объект (сокет, ответ веб-сервера),
+        без буфера self.buf и копии getvalue()
+        :param target: <str> путь к файлу или объект с методом write
+        :return: target
+        """
+        self.doc.filename = target
+        try:
+            self.doc.build(self.content)
+        finally:
+            self.doc.filename = self.buf
+        return target
+
+    def iter_build(self, chunk_size=64 * 1024, max_size=1024 * 1024):
+        """
+        Формирование документа и выдача его частями для потоковой отдачи. Документ записывается во временный
+        файл, который до max_size байт хранится в памяти, а больше - на диске
+        :param chunk_size: <int> размер части в байтах
+        :param max_size: <int> размер документа, до которого временный файл не пишется на диск
+        :return: генератор <bytes>
+        """
+        with SpooledTemporaryFile(max_size=max_size) as tmp:
+            self.build_to(tmp)
+            tmp.seek(0)
+            while True:
+                chunk = tmp.read(chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
     def add_header(self, document_header_1, content, document_header_2=None, document_header_2_style=None,
                    content_style=None, sign=None, sign_style=None, header_style=None, document_header_1_style=None,
                    header_title=None, add_header=True, timestamp=None):
@@ -119,6 +473,21 @@ class PdfCreator:
         :param add_header: <bool> автоматически добавляет заголовок в контент всего документа
         :return: возвращает все содержимое заголовка [ ... ]
         """
+        header_content = _build_parts(self._header_parts(document_header_1, content, document_header_2,
+                                                         document_header_2_style, content_style, sign, sign_style,
+                                                         header_style, document_header_1_style, header_title,
+                                                         timestamp))
+        if add_header:
+            self.content.extend(header_content)
+
+        return header_content
+
+    def _header_parts(self, document_header_1, content, document_header_2=None, document_header_2_style=None,
+                      content_style=None, sign=None, sign_style=None, header_style=None,
+                      document_header_1_style=None, header_title=None, timestamp=None):
+        """
+        Части шапки документа без создания flowable: [(<функция>, <args>, <kwargs>), ...]
+        """
         header_content = list()
 
         if content_style is None:
@@ -134,40 +503,63 @@ class PdfCreator:
 
         # шапка
         table_content = [['', c, ''] for c in content]
-        header_content.append(self.add_table(table_content,
-                                             header_style=header_style,
-                                             content_style=content_style,
-                                             headers=header_title,
-                                             colWidths=[250, 170, 80],
-                                             add_table=False))
+        header_content.append((self.add_table, (table_content,),
+                               dict(header_style=header_style,
+                                    content_style=content_style,
+                                    headers=header_title,
+                                    colWidths=[250, 170, 80],
+                                    add_table=False)))
 
         # подпись утверждающего
         if sign:
             if sign_style is None:
                 sign_style = self.pstyles.default_regular_right
-            header_content.append(Paragraph(sign, sign_style))
+            header_content.append((Paragraph, (sign, sign_style), {}))
 
         # добавление даты утверждения
         if timestamp:
             table_content = [['', timestamp, '']]
-            header_content.append(self.add_table(table_content,
-                                                 content_style=content_style,
-                                                 colWidths=[250, 170, 80],
-                                                 add_table=False))
+            header_content.append((self.add_table, (table_content,),
+                                   dict(content_style=content_style,
+                                        colWidths=[250, 170, 80],
+                                        add_table=False)))
 
-        header_content.append(Spacer(0, 20))
-        header_content.append(Paragraph(document_header_1, document_header_1_style))
+        header_content.append((Spacer, (0, 20), {}))
+        header_content.append((Paragraph, (document_header_1, document_header_1_style), {}))
 
         if document_header_2:
             if document_header_2_style is None:
                 document_header_2_style = self.pstyles.default_regular_center
-            header_content.append(Paragraph(document_header_2, document_header_2_style))
-        header_content.append(Spacer(0, 20))
+            header_content.append((Paragraph, (document_header_2, document_header_2_style), {}))
+        header_content.append((Spacer, (0, 20), {}))
+        return header_content
 
-        if add_header:
-            self.content.extend(header_content)
+    def header_template(self, document_header_1, content, **kwargs):
+        """
+        Шаблон шапки документа: аргументы как у add_header, в строках можно использовать поля {name}.
+        Части без полей создаются один раз, их размеры кешируются, при заполнении создаются только части с полями
+        :return: <LayoutTemplate>
+        """
+        kwargs.pop('add_header', None)
+        return LayoutTemplate(self._header_parts(document_header_1, content, **kwargs))
 
-        return header_content
+    def bottom_template(self, content, content_style=None, sign=None, sign_style=None):
+        """
+        Шаблон "низа" документа: аргументы как у add_bottom, в строках можно использовать поля {name}
+        :return: <LayoutTemplate>
+        """
+        return LayoutTemplate(self._bottom_parts(content, content_style, sign, sign_style))
+
+    def add_template(self, template, **fields):
+        """
+        Добавляет в документ заполненный шаблон шапки или "низа"
+        :param template: <LayoutTemplate>
+        :param fields: значения полей шаблона
+        :return: [<Flowable>, ...]
+        """
+        content = template.fill(**fields)
+        self.content.extend(content)
+        return content
 
     def add_bottom(self, content, content_style=None, sign=None, sign_style=None, add_bottom=True):
         """
@@ -177,18 +569,24 @@ class PdfCreator:
         :param add_bottom: <bool>
         :return:
         """
+        bottom_content = _build_parts(self._bottom_parts(content, content_style, sign, sign_style))
+        if add_bottom:
+            self.content.extend(bottom_content)
+        return bottom_content
+
+    def _bottom_parts(self, content, content_style=None, sign=None, sign_style=None):
+        """
+        Части "низа" документа без создания flowable: [(<функция>, <args>, <kwargs>), ...]
+        """
         if content_style is None:
             content_style = self.pstyles.default_regular
 
-        bottom_content = [Paragraph(c, content_style) for c in content]
+        bottom_content = [(Paragraph, (c, content_style), {}) for c in content]
 
         if sign:
             if sign_style is None:
                 sign_style = self.pstyles.default_regular_right
-            bottom_content.append(Paragraph(sign, sign_style))
-
-        if add_bottom:
-            self.content.extend(bottom_content)
+            bottom_content.append((Paragraph, (sign, sign_style), {}))
         return bottom_content
 
     def add_table(self, content, headers=None, header_style=None, content_style=None, add_table=True, style=None, **table_args):
@@ -217,6 +615,70 @@ class PdfCreator:
             self.content.append(Spacer(0, 20))
         return table
 
+    def add_large_table(self, content, headers=None, header_style=None, content_style=None, add_table=True,
+                        style=None, chunk_rows=200, plain_text_length=30, **table_args):
+        """
+        Таблица для большого количества строк (LazyTable). Простые ячейки (без разметки и переносов, помещающиеся
+        в колонку) выводятся строками со шрифтом из TableStyle, остальные - Paragraph, которые кешируются для
+        повторяющихся значений. Таблица верстается постранично, заголовки повторяются на каждой странице, поэтому
+        при заданных colWidths страниц столько же, сколько у add_table(..., repeatRows=len(headers))
+        :param content: строки таблицы, список или итератор [<str>, ...]
+        :param headers: заголовки таблицы
+        :param header_style: стиль заголовков таблицы
+        :param content_style: стиль контента
+        :param style: список команд TableStyle, добавляется к стилю шрифта. Номера строк - как в add_table,
+        отрицательные отсчитываются от конца части таблицы на странице
+        :param chunk_rows: <int> сколько строк материализуется за раз
+        :param plain_text_length: <int> максимальная длина простой ячейки, если не заданы colWidths
+        :param table_args: аргументы Table
+        :return: <LazyTable>
+        """
+        if header_style is None:
+            header_style = self.pstyles.default_regular_center
+        if content_style is None:
+            content_style = self.pstyles.default_regular_center
+        header_rows = [[Paragraph(p, header_style) for p in row] for row in headers or ()]
+
+        alignment = {0: 'LEFT', 1: 'CENTER', 2: 'RIGHT'}.get(content_style.alignment, 'LEFT')
+        commands = [('FONTNAME', (0, len(header_rows)), (-1, -1), content_style.fontName),
+                    ('FONTSIZE', (0, len(header_rows)), (-1, -1), content_style.fontSize),
+                    ('LEADING', (0, len(header_rows)), (-1, -1), content_style.leading),
+                    ('ALIGN', (0, len(header_rows)), (-1, -1), alignment)]
+        if style is not None:
+            commands.extend(style.getCommands() if isinstance(style, TableStyle) else style)
+
+        col_widths = table_args.get('colWidths')
+        paragraphs = dict()
+
+        def convert_cell(column, value):
+            if not isinstance(value, str):
+                return value if value is None else str(value)
+            if '<' not in value and '&' not in value and '\n' not in value:
+                if col_widths and col_widths[column] is not None:
+                    # 12 - отступы ячейки по умолчанию (LEFTPADDING + RIGHTPADDING)
+                    fits = pdfmetrics.stringWidth(value, content_style.fontName,
+                                                  content_style.fontSize) <= col_widths[column] - 12
+                else:
+                    fits = len(value) <= plain_text_length
+                if fits:
+                    return value
+            key = (column, value)
+            paragraph = paragraphs.get(key)
+            if paragraph is None:
+                paragraph = Paragraph(value, content_style)
+                if len(paragraphs) < 10000:
+                    paragraphs[key] = paragraph
+            return paragraph
+
+        def convert(row):
+            return [convert_cell(column, value) for column, value in enumerate(row)]
+
+        table = LazyTable(content, header_rows, convert, commands, chunk_rows, **table_args)
+        if add_table:
+            self.content.append(table)
+            self.content.append(Spacer(0, 20))
+        return table
+
     def add_line(self, row, style=None):
         """
         Задает каждой ячейке строки определенный стиль
@@ -226,4 +688,130 @@ class PdfCreator:
         """
         if style is None:
             style = self.pstyles.default_regular
-        return [Paragraph(cell, style) for cell in row]
\ No newline at end of file
+        return [Paragraph(cell, style) for cell in row]
+
+
+class BatchResult:
+    """Результат формирования одного документа пакета build_batch"""
+
+    def __init__(self, index, data=None, path=None, error=None):
+        """
+        :param index: <int> номер документа во входном списке
+        :param data: <bytes> документ, если в спецификации не указан filename
+        :param path: <str> путь к записанному файлу
+        :param error: <str> traceback ошибки формирования документа
+        """
+        self.index = index
+        self.data = data
+        self.path = path
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def render_document(spec, index=0, output_dir=None):
+    """
+    Формирование одного документа по спецификации. Ошибка не выбрасывается, а возвращается в BatchResult.error
+    :param spec: <dict> {'creator': {...}, 'header': {...}, 'tables': [{...}, ...], 'bottom': {...},
+        'filename': <str>} - аргументы PdfCreator, add_header, add_table и add_bottom; все ключи необязательные
+    :param index: <int> номер документа
+    :param output_dir: <str> каталог для файлов filename
+    :return: <BatchResult>
+    """
+    try:
+        creator = PdfCreator(**spec.get('creator', {}))
+        if spec.get('header'):
+            creator.add_header(**spec['header'])
+        for table in spec.get('tables', ()):
+            creator.add_table(**table)
+        if spec.get('bottom'):
+            creator.add_bottom(**spec['bottom'])
+        filename = spec.get('filename')
+        if filename:
+            path = os.path.join(output_dir, filename) if output_dir else filename
+            creator.build_to(path)
+            return BatchResult(index, path=path)
+        return BatchResult(index, data=creator.build())
+    except Exception:
+        return BatchResult(index, error=traceback.format_exc())
+
+
+def build_batch(specs, workers=None, output_dir=None, max_pending=None, progress=None):
+    """
+    Параллельное формирование пакета документов в пуле процессов. Шрифты и стили регистрируются в каждом процессе
+    один раз при старте, спецификации читаются по мере освобождения мест, поэтому в памяти не больше max_pending
+    документов. Ошибка в документе, в передаче его между процессами или аварийное завершение процесса пула
+    не прерывает пакет: документ возвращается с BatchResult.error, при аварии пул пересоздается
+    :param specs: итерируемый набор спецификаций (см. render_document)
+    :param workers: <int> количество процессов, по умолчанию количество ядер; 1 - без пула, в текущем процессе
+    :param output_dir: <str> каталог для документов с filename
+    :param max_pending: <int> максимум документов в работе, по умолчанию workers * 2
+    :param progress: функция progress(<количество готовых>, <количество ошибок>)
+    :return: генератор <BatchResult> в порядке готовности
+    """
+    done_count = failed = 0
+
+    def report(result):
+        nonlocal done_count, failed
+        done_count += 1
+        if not result.ok:
+            failed += 1
+        if progress is not None:
+            progress(done_count, failed)
+        return result
+
+    if workers == 1:
+        prewarm()
+        for index, spec in enumerate(specs):
+            yield report(render_document(spec, index, output_dir))
+        return
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    specs = enumerate(specs)
+    retry = ()
+    while True:
+        submitted = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=prewarm) as pool:
+            pending = dict()
+            for index, spec in chain(retry, specs):
+                try:
+                    future = pool.submit(render_document, spec, index, output_dir)
+                except BrokenProcessPool:
+                    # процесс пула завершился аварийно (нехватка памяти, kill): документы в работе получат
+                    # ошибку, остальные формируются в новом пуле
+                    retry = ((index, spec),)
+                    break
+                pending[future] = index
+                submitted += 1
+                if len(pending) >= max_pending:
+                    done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                    for future in done:
+                        yield report(_batch_result(future, pending.pop(future)))
+            else:
+                retry = ()
+            while pending:
+                done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    yield report(_batch_result(future, pending.pop(future)))
+        if not retry:
+            return
+        if not submitted:
+            # новый пул не принимает задачи: оставшиеся документы завершаются ошибкой
+            error = 'BrokenProcessPool: process pool can not be started\n'
+            for index, spec in chain(retry, specs):
+                yield report(BatchResult(index, error=error))
+            return
+
+
+def _batch_result(future, index):
+    """
+    Результат задачи пула. Ошибки передачи спецификации или результата между процессами и аварийное завершение
+    процесса возвращаются в BatchResult.error, как ошибки формирования документа
+    """
+    try:
+        return future.result()
+    except Exception:
+        return BatchResult(index, error=traceback.format_exc())
@@ -0,0 +1,51 @@
+import os
+import sys
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# библиотека устанавливается в приложения пакетом my_libs
+if 'my_libs' not in sys.modules:
+    package = types.ModuleType('my_libs')
+    package.__path__ = [ROOT]
+    sys.modules['my_libs'] = package
+    # __init__ пакета миксинов собирает классы приложения (saconverter), в тестах модули миксинов импортируются
+    # напрямую
+    mixins = types.ModuleType('my_libs.SQLAlchemyMixns')
+    mixins.__path__ = [os.path.join(ROOT, 'SQLAlchemyMixns')]
+    sys.modules['my_libs.SQLAlchemyMixns'] = mixins
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+def _session_module():
+    """Модуль pyoreol приложения: миксины берут из него DBSession. В тестах - scoped_session на SQLite"""
+    try:
+        from sqlalchemy.orm import scoped_session, sessionmaker
+    except ImportError:
+        return
+    try:
+        import pyoreol  # noqa: F401
+    except ImportError:
+        module = types.ModuleType('pyoreol')
+        module.DBSession = scoped_session(sessionmaker())
+        sys.modules['pyoreol'] = module
+
+
+_session_module()
+
+
+@pytest.fixture
+def dbsession(tmp_path):
+    """DBSession приложения, связанная с новой базой SQLite"""
+    from sqlalchemy import create_engine
+    from pyoreol import DBSession
+
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'test.sqlite'))
+    DBSession.remove()
+    DBSession.configure(bind=engine)
+    yield DBSession
+    DBSession.remove()
+    engine.dispose()
@@ -0,0 +1,99 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer, String, event
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from my_libs.SQLAlchemyMixns.alias_map import AliasMap
+from my_libs.SQLAlchemyMixns.alias_mixin import AliasMixin
+
+Base = declarative_base()
+
+
+class Tag(AliasMixin, Base):
+    __tablename__ = 'tags'
+    id = Column(Integer, primary_key=True)
+    alias = Column(String, unique=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+@pytest.fixture
+def tags(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    dbsession.add_all([Tag(id=i, alias='a%s' % i, version=1) for i in range(1, 11)])
+    dbsession.commit()
+    Tag.alias_map = AliasMap(version_field='version', refresh_interval=None)
+    yield dbsession
+    Tag.alias_map = None
+
+
+def test_resolve_and_items(tags):
+    assert Tag.alias_map.resolve(Tag, tags, ['a1', 'a5', 'missing']) == {'a1': 1, 'a5': 5}
+    assert Tag.aliased_item('a3').id == 3
+    assert [tag.id for tag in Tag.aliased_list(['a2', 'a7'])] == [2, 7]
+
+
+def test_new_alias_is_found_in_db(tags):
+    Tag.alias_map.warmup(Tag, tags)
+    tags.add(Tag(id=11, alias='a11', version=2))
+    tags.commit()
+    assert Tag.aliased_item('a11').id == 11
+
+
+def test_stale_alias_is_reloaded(tags):
+    Tag.alias_map.warmup(Tag, tags)
+    tags.get(Tag, 1).alias = 'renamed'
+    tags.get(Tag, 2).alias = 'a1'
+    tags.commit()
+    assert Tag.aliased_item('a1').id == 2
+    assert [tag.id for tag in Tag.aliased_list(['a1'])] == [2]
+
+
+def test_incremental_refresh(tags):
+    Tag.alias_map.warmup(Tag, tags)
+    tag = tags.get(Tag, 4)
+    tag.alias, tag.version = 'moved', 2
+    tags.commit()
+    Tag.alias_map.refresh(Tag, tags)
+    assert Tag.alias_map.resolve(Tag, tags, ['moved']) == {'moved': 4}
+
+
+def test_slow_refresh_does_not_block_lookups(tags):
+    alias_map = Tag.alias_map
+    alias_map.warmup(Tag, tags)
+    alias_map.refresh_interval = 0
+    engine = tags.get_bind()
+    started = threading.Event()
+    release = threading.Event()
+    refreshing = threading.local()
+
+    def slow_query(conn, cursor, statement, parameters, context, executemany):
+        if getattr(refreshing, 'value', False):
+            started.set()
+            release.wait(5)
+
+    event.listen(engine, 'before_cursor_execute', slow_query)
+
+    def refresh():
+        refreshing.value = True
+        session = sessionmaker(bind=engine)()
+        alias_map.resolve(Tag, session, ['a1'])
+        session.close()
+
+    thread = threading.Thread(target=refresh)
+    thread.start()
+    try:
+        assert started.wait(5)
+        session = sessionmaker(bind=engine)()
+        start = time.monotonic()
+        assert alias_map.resolve(Tag, session, ['a2']) == {'a2': 2}
+        assert time.monotonic() - start < 1
+        session.close()
+    finally:
+        release.set()
+        thread.join()
+        event.remove(engine, 'before_cursor_execute', slow_query)
@@ -0,0 +1,78 @@
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, scoped_session, sessionmaker
+
+from my_libs.SQLAlchemyMixns.main_mixin import BulkStats, GeneralMethodMixin
+
+Base = declarative_base()
+
+
+class Record(GeneralMethodMixin, Base):
+    __tablename__ = 'records'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    note = Column(String)
+
+
+@pytest.fixture
+def records(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    Record.dbsession = dbsession
+    yield dbsession
+    Record.dbsession = None
+
+
+def names(dbsession):
+    return {r.id: (r.name, r.note) for r in dbsession.query(Record)}
+
+
+def test_bulk_create_batches_and_ids(records):
+    # разные наборы колонок попадают в разные пачки, id возвращаются в порядке входных строк
+    rows = [dict(name='n%s' % i, note='x') if i % 3 else dict(name='n%s' % i) for i in range(25)]
+    stats = Record.bulk_create(rows, batch_size=4)
+    assert isinstance(stats, BulkStats)
+    assert stats.rows == 25
+    assert len(stats.ids) == 25
+    stored = names(records)
+    assert [stored[pk][0] for pk in stats.ids] == ['n%s' % i for i in range(25)]
+    assert stored[stats.ids[3]] == ('n3', None) and stored[stats.ids[4]] == ('n4', 'x')
+
+
+def test_bulk_create_checks_not_nullable(records):
+    with pytest.raises(ValueError):
+        Record.bulk_create([dict(name=None)])
+
+
+def test_bulk_update(records):
+    ids = Record.bulk_create([dict(name='n%s' % i) for i in range(10)]).ids
+    stats = Record.bulk_update([dict(id=pk, note='u%s' % pk) for pk in ids[:7]] + [dict(id=ids[7])],
+                               batch_size=3)
+    assert stats.rows == 7
+    stored = names(records)
+    assert [stored[pk][1] for pk in ids] == ['u%s' % pk for pk in ids[:7]] + [None] * 3
+
+
+def test_bulk_delete(records):
+    ids = Record.bulk_create([dict(name='n%s' % i) for i in range(10)]).ids
+    stats = Record.bulk_delete(ids[:6] + [-1], batch_size=4)
+    assert stats.rows == 6
+    assert sorted(names(records)) == sorted(ids[6:])
+
+
+def test_bulk_uses_model_bind(tmp_path):
+    engine = create_engine('sqlite:///{}'.format(tmp_path / 'model.sqlite'))
+    Base.metadata.create_all(engine)
+    # в сессии нет привязки по умолчанию, только к модели
+    Record.dbsession = scoped_session(sessionmaker(binds={Record: engine}))
+    try:
+        ids = Record.bulk_create([dict(name='a'), dict(name='b')]).ids
+        assert Record.bulk_update([dict(id=ids[0], name='c')]).rows == 1
+        assert Record.bulk_delete(ids[1:]).rows == 1
+        assert [(r.id, r.name) for r in Record.dbsession.query(Record)] == [(ids[0], 'c')]
+    finally:
+        Record.dbsession.remove()
+        Record.dbsession = None
+        engine.dispose()
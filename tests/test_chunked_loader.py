@@ -0,0 +1,104 @@
+import uuid
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer, String, event
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.types import TypeDecorator
+
+from my_libs.SQLAlchemyMixns.chunked_loader import load_chunked, unique_keys
+from my_libs.SQLAlchemyMixns.guid_pk import GuidPK
+from my_libs.SQLAlchemyMixns.id_pk import IdPK
+
+Base = declarative_base()
+
+
+class GUID(TypeDecorator):
+    """UUID, который как колонка UUID в PostgreSQL принимает ключи и строками, а возвращает объекты UUID"""
+    impl = String(36)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else str(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else uuid.UUID(value)
+
+
+GUIDS = [uuid.UUID(int=i) for i in range(1, 31)]
+
+
+class Item(IdPK, Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    rank = Column(Integer)
+
+
+class Doc(GuidPK, Base):
+    __tablename__ = 'docs'
+    guid = Column(GUID, primary_key=True)
+    name = Column(String)
+
+
+@pytest.fixture
+def items(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    dbsession.add_all([Item(id=i, rank=None if i % 5 == 0 else (i * 7) % 11) for i in range(1, 51)])
+    dbsession.add_all([Doc(guid=guid, name=str(i)) for i, guid in enumerate(GUIDS)])
+    dbsession.commit()
+    return dbsession
+
+
+@pytest.fixture
+def selects(items):
+    """Количество SELECT запросов к базе"""
+    statements = list()
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    engine = items.get_bind()
+    event.listen(engine, 'before_cursor_execute', count)
+    yield statements
+    event.remove(engine, 'before_cursor_execute', count)
+
+
+def test_unique_keys():
+    assert unique_keys([3, None, 1, 3, 2, 1, None]) == [3, 1, 2]
+
+
+def test_get_list_keeps_order_skips_missing_and_duplicates(items, selects):
+    ids = [40, 3, 3, 99, 17, None, 1, 40, 25] + list(range(30, 5, -1))
+    result = Item.get_list(ids, chunk_size=7)
+    expected = [i for i in unique_keys(ids) if i <= 50]
+    assert [item.id for item in result] == expected
+    # 29 уникальных ключей по 7 в запросе
+    assert len(selects) == 5
+
+
+def test_get_list_as_dict_and_order_by(items):
+    ids = [10, 4, 7, 5, 2, 70]
+    result = Item.get_list(ids, as_dict=True, chunk_size=2)
+    assert list(result) == [10, 4, 7, 5, 2]
+    assert all(result[key].id == key for key in result)
+    ordered = Item.get_list(ids, order_by='rank', chunk_size=2)
+    ranks = [item.rank for item in ordered]
+    # None в конце, как NULLS LAST
+    assert ranks == sorted(rank for rank in ranks if rank is not None) + [None, None]
+    assert len(Item.get_list()) == 50
+
+
+def test_guid_get_list_accepts_strings(items):
+    keys = [str(GUIDS[5]), GUIDS[2], str(GUIDS[5]), str(uuid.UUID(int=999))]
+    result = Doc.get_list(keys, as_dict=True, chunk_size=2)
+    assert list(result) == [str(GUIDS[5]), GUIDS[2]]
+    assert [doc.guid for doc in result.values()] == [GUIDS[5], GUIDS[2]]
+    assert len(Doc.get_list()) == len(GUIDS)
+
+
+def test_load_chunked_unknown_strategy(items):
+    with pytest.raises(ValueError):
+        load_chunked(items.query(Item), Item.id, [1], strategy='unknown')
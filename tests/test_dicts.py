@@ -0,0 +1,62 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('dateutil')
+
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, Interval, String
+from sqlalchemy.orm import declarative_base
+
+from my_libs.SQLAlchemyMixns.main_mixin import GeneralMethodMixin
+from my_libs.trees import tree_constructor
+from my_libs.utils import row2dict
+
+Base = declarative_base()
+
+
+class Node(GeneralMethodMixin, Base):
+    __tablename__ = 'nodes'
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, ForeignKey('nodes.id'))
+    name = Column(String)
+    started = Column(DateTime)
+    duration = Column(Interval)
+
+
+@pytest.fixture
+def nodes(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    Node.dbsession = dbsession
+    dbsession.add_all([Node(id=i, parent_id=i // 3 or None, name='n%s' % i,
+                            started=datetime.datetime(2020, 1, i, 3, 4, 5) if i % 2 else None,
+                            duration=datetime.timedelta(minutes=i) if i % 3 else None) for i in range(1, 20)])
+    dbsession.commit()
+    yield dbsession
+    Node.dbsession = None
+
+
+@pytest.mark.parametrize('b', [None, ['name', 'duration']])
+def test_dicts_match_row2dict(nodes, b):
+    expected = [row2dict(node, b) for node in nodes.query(Node).order_by(Node.id)]
+    nodes.expunge_all()
+    result = list(Node.dicts(nodes.query(Node).order_by(Node.id), b=b, batch_size=4))
+    assert result == expected
+    # строки не загружаются в сессию как объекты ORM
+    assert not list(nodes.identity_map.values())
+
+
+def test_dicts_whole_table_and_filter(nodes):
+    assert sorted(item['id'] for item in Node.dicts()) == list(range(1, 20))
+    assert [item['id'] for item in Node.dicts(nodes.query(Node).filter(Node.parent_id == 2).order_by(Node.id))] == \
+        [6, 7, 8]
+
+
+def test_dicts_feed_tree_constructor(nodes):
+    expected = tree_constructor(nodes.query(Node).order_by(Node.id).all())
+    assert tree_constructor(Node.dicts(nodes.query(Node).order_by(Node.id))) == expected
+
+
+def test_dicts_without_session():
+    with pytest.raises(AttributeError):
+        list(Node.dicts())
@@ -0,0 +1,94 @@
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from my_libs.SQLAlchemyMixns.id_pk import IdPK
+from my_libs.SQLAlchemyMixns.identity_cache import IdentityCache
+from my_libs.SQLAlchemyMixns.main_mixin import GeneralMethodMixin
+
+Base = declarative_base()
+
+
+class Item(IdPK, GeneralMethodMixin, Base):
+    __tablename__ = 'items'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+
+
+@pytest.fixture
+def items(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    Item.dbsession = dbsession
+    Item.identity_cache = IdentityCache(maxsize=100)
+    dbsession.add_all([Item(id=i, name='n%s' % i) for i in range(1, 21)])
+    dbsession.commit()
+    yield dbsession
+    Item.identity_cache = None
+    Item.dbsession = None
+
+
+def fresh_name(dbsession, item_id):
+    """Значение в БД, прочитанное отдельной сессией"""
+    session = sessionmaker(bind=dbsession.get_bind())()
+    try:
+        return session.get(Item, item_id).name
+    finally:
+        session.close()
+
+
+def test_cache_hits(items):
+    assert Item.get_item(10).name == 'n10'
+    items.remove()
+    assert Item.get_item(10).name == 'n10'
+    assert Item.identity_cache.stats()['hits'] == 1
+
+
+def test_rollback_does_not_leak_uncommitted_data(items):
+    Item.get_item(10)
+    Item.get_item(10).update(dict(name='changed'))
+    assert Item.get_item(10).name == 'changed'
+    items.rollback()
+
+    assert fresh_name(items, 10) == 'n10'
+    items.remove()
+    for _ in range(2):
+        assert Item.get_item(10).name == 'n10'
+        items.remove()
+
+
+def test_no_fill_from_session_with_pending_changes(items):
+    Item.get_item(1).update(dict(name='changed'))
+    items.flush()
+    assert Item.get_item(2).name == 'n2'
+    assert len(Item.identity_cache) == 0
+    items.rollback()
+    items.remove()
+    Item.get_item(2)
+    assert len(Item.identity_cache) == 1
+
+
+def test_commit_refreshes_entry(items):
+    Item.get_item(10)
+    items.remove()
+    Item.get_item(10).update(dict(name='changed'))
+    items.flush()
+
+    # другая сессия до commit видит старое значение и не заполняет кеш им после commit
+    other = sessionmaker(bind=items.get_bind())()
+    assert Item.identity_cache.get(Item, 'id', 10, lambda: other.get(Item, 10), other).name == 'n10'
+    other.close()
+    items.commit()
+    items.remove()
+    assert Item.get_item(10).name == 'changed'
+
+
+def test_bulk_update_defers_model(items):
+    Item.get_item(3)
+    Item.bulk_update([dict(id=3, name='bulk')])
+    assert len(Item.identity_cache) == 0
+    items.rollback()
+    items.remove()
+    assert Item.get_item(3).name == 'n3'
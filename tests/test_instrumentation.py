@@ -0,0 +1,81 @@
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, Integer
+from sqlalchemy.exc import NoResultFound
+from sqlalchemy.orm import declarative_base
+
+from my_libs.SQLAlchemyMixns.id_pk import IdPK
+from my_libs.SQLAlchemyMixns.instrumentation import Instrumentation, metrics
+
+Base = declarative_base()
+
+
+class Unit(IdPK, Base):
+    __tablename__ = 'units'
+    id = Column(Integer, primary_key=True)
+
+
+@pytest.fixture
+def units(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    dbsession.add_all([Unit(id=i) for i in range(1, 11)])
+    dbsession.commit()
+    metrics.reset()
+    metrics.enable(dbsession.get_bind())
+    yield dbsession
+    metrics.disable()
+    metrics.reset()
+
+
+def test_record_histogram_and_errors():
+    instrumentation = Instrumentation(bounds=(0.01, 0.1))
+    for elapsed in (0.001, 0.01, 0.05, 0.5):
+        instrumentation.record('Model.method', elapsed)
+    instrumentation.record('Model.method', 0.2, error=True)
+    stats = instrumentation.snapshot()['methods']['Model.method']
+    assert stats['count'] == 5 and stats['errors'] == 1
+    assert stats['histogram'] == {'<=0.01': 2, '<=0.1': 1, '+Inf': 2}
+    assert stats['max'] == 0.5
+    assert stats['avg'] == pytest.approx(0.761 / 5)
+    instrumentation.reset()
+    assert instrumentation.snapshot() == {'queries': 0, 'methods': {}, 'n_plus_one': {}}
+
+
+def test_n_plus_one_only_inside_scope():
+    instrumentation = Instrumentation(n_plus_one_threshold=3)
+    for i in range(5):
+        instrumentation.record('Model.get_item', 0.0, single_row=True)
+    assert instrumentation.snapshot()['n_plus_one'] == {}
+    with instrumentation.request_scope() as scope:
+        for i in range(5):
+            instrumentation.record('Model.get_item', 0.0, single_row=True)
+        instrumentation.record('Model.aliased_item', 0.0, single_row=True)
+    assert scope.lookups == {'Model.get_item': 5, 'Model.aliased_item': 1}
+    assert scope.n_plus_one == {'Model.get_item': 5}
+    # кандидат учитывается один раз на область, а не на каждую выборку сверх порога
+    assert instrumentation.snapshot()['n_plus_one'] == {'Model.get_item': 1}
+
+
+def test_mixin_methods_are_counted(units):
+    with metrics.request_scope() as scope:
+        for i in range(1, 7):
+            Unit.get_item(i)
+        Unit.get_list([1, 2, 3])
+        with pytest.raises(NoResultFound):
+            Unit.get_item(100)
+    snapshot = metrics.snapshot()
+    get_item = snapshot['methods']['Unit.get_item']
+    assert get_item['count'] == 7 and get_item['errors'] == 1 and get_item['queries'] == 7
+    assert sum(get_item['histogram'].values()) == 7
+    assert snapshot['methods']['Unit.get_list']['queries'] == 1
+    assert snapshot['queries'] == scope.queries == 8
+    assert scope.n_plus_one == {'Unit.get_item': 7}
+    assert snapshot['n_plus_one'] == {'Unit.get_item': 1}
+
+
+def test_disabled_metrics_are_not_collected(units):
+    metrics.disable()
+    Unit.get_item(1)
+    assert metrics.snapshot() == {'queries': 0, 'methods': {}, 'n_plus_one': {}}
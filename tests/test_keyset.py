@@ -0,0 +1,71 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy import Column, DateTime, Integer
+from sqlalchemy.orm import declarative_base
+
+from my_libs.SQLAlchemyMixns import keyset
+from my_libs.SQLAlchemyMixns.id_pk import IdPK
+
+Base = declarative_base()
+START = datetime.datetime(2020, 1, 1)
+
+
+class Row(IdPK, Base):
+    __tablename__ = 'rows'
+    id = Column(Integer, primary_key=True)
+    score = Column(Integer, nullable=False)
+    created = Column(DateTime, nullable=False)
+
+
+@pytest.fixture
+def rows(dbsession):
+    Base.metadata.create_all(dbsession.get_bind())
+    dbsession.add_all([Row(id=i, score=i % 7, created=START + datetime.timedelta(hours=i % 5))
+                       for i in range(1, 251)])
+    dbsession.commit()
+    return dbsession
+
+
+def expected_ids(dbsession, order_by):
+    key = {None: lambda r: r.id, 'score': lambda r: (r.score, r.id), '-score': lambda r: (-r.score, -r.id),
+           'created': lambda r: (r.created, r.id)}[order_by]
+    return [r.id for r in sorted(dbsession.query(Row).all(), key=key)]
+
+
+@pytest.mark.parametrize('order_by', [None, 'score', '-score', 'created'])
+def test_iter_pages_and_rows_cover_table(rows, order_by):
+    expected = expected_ids(rows, order_by)
+    pages = list(Row.iter_pages(page_size=40, order_by=order_by))
+    assert [len(page) for page in pages] == [40] * 6 + [10]
+    assert [r.id for page in pages for r in page] == expected
+    assert [r.id for r in Row.iter_rows(page_size=40, order_by=order_by, yield_per=7)] == expected
+
+
+def test_page_after_cursor(rows):
+    items, cursor = Row.page_after(page_size=100, order_by='-score')
+    assert len(items) == 100 and cursor is not None
+    items, cursor = Row.page_after(cursor, page_size=100, order_by='-score')
+    items, cursor = Row.page_after(cursor, page_size=100, order_by='-score')
+    assert len(items) == 50 and cursor is None
+    with pytest.raises(ValueError):
+        Row.page_after(Row.page_after(page_size=10)[1], order_by='score')
+    with pytest.raises(ValueError):
+        Row.page_after('not a cursor')
+
+
+def test_iter_rows_streams_page(rows):
+    rows.expunge_all()
+    stream = Row.iter_rows(page_size=1000, yield_per=10)
+    assert next(stream).id == 1
+    assert len(rows.identity_map) <= 10
+    assert sum(1 for _ in stream) == 249
+
+
+def test_cursor_round_trip_types():
+    order = ['created', 'id']
+    values = [START, 5]
+    assert keyset.decode_cursor(keyset.encode_cursor(order, values), order) == values
@@ -0,0 +1,238 @@
+import io
+import os
+import re
+
+import pytest
+
+reportlab = pytest.importorskip('reportlab')
+
+from reportlab import rl_config
+from reportlab.lib import colors
+from reportlab.pdfbase import pdfmetrics, ttfonts
+
+from my_libs import pdf_creator
+from my_libs.pdf_creator import DEFAULT_FONTS, PdfCreator, PStyle, build_batch
+
+# шрифты Times New Roman не входят в репозиторий, в тестах под их именами регистрируются шрифты reportlab
+_TEST_FONTS = ('Vera.ttf', 'VeraBd.ttf', 'VeraIt.ttf')
+
+
+@pytest.fixture(scope='module', autouse=True)
+def fonts():
+    path = os.path.join(os.path.dirname(reportlab.__file__), 'fonts')
+    for font_name, test_font in zip(DEFAULT_FONTS, _TEST_FONTS):
+        name = font_name.split('.')[0]
+        if name not in pdf_creator._registered_fonts:
+            pdfmetrics.registerFont(ttfonts.TTFont(name, os.path.join(path, test_font)))
+            pdf_creator._registered_fonts.add(name)
+
+
+def test_creator_styles_are_independent():
+    creator = PdfCreator()
+    creator.pstyles.default_regular.fontSize = 30
+    assert PdfCreator().pstyles.default_regular.fontSize == 12
+    assert PStyle.default().default_regular.fontSize == 12
+
+
+def test_add_style_on_creator():
+    creator = PdfCreator()
+    creator.pstyles.add_style('TimesNewRomanBold', 'title', alignment=1, font_size=16)
+    assert creator.pstyles.title.fontSize == 16
+    assert not hasattr(PdfCreator().pstyles, 'title')
+    creator.content.append(pdf_creator.Paragraph('Title', creator.pstyles.title))
+    assert creator.build().startswith(b'%PDF')
+
+
+def test_default_styles_are_frozen():
+    with pytest.raises(AttributeError):
+        PStyle.default().add_style('TimesNewRomanBold', 'title')
+    with pytest.raises(AttributeError):
+        PStyle.default().default_regular.fontSize = 30
+
+
+class KillWorker:
+    """Значение спецификации, при распаковке которого процесс пула аварийно завершается"""
+
+    def __reduce__(self):
+        return os._exit, (1,)
+
+
+def batch_spec(number):
+    return {'header': {'document_header_1': 'Акт {}'.format(number), 'content': ['Утверждаю']},
+            'tables': [{'content': [[str(number), 'Позиция']]}]}
+
+
+def test_build_batch_in_process():
+    specs = [batch_spec(i) for i in range(3)] + [{'tables': [{'content': None}]}]
+    results = sorted(build_batch(specs, workers=1), key=lambda r: r.index)
+    assert [r.ok for r in results] == [True, True, True, False]
+    assert results[0].data.startswith(b'%PDF')
+
+
+def test_build_batch_unpicklable_spec():
+    specs = [batch_spec(0), {'creator': {'title': lambda: None}}, batch_spec(2)]
+    results = sorted(build_batch(specs, workers=2), key=lambda r: r.index)
+    assert [r.index for r in results] == [0, 1, 2]
+    assert [r.ok for r in results] == [True, False, True]
+
+
+def test_build_batch_survives_broken_pool():
+    specs = [batch_spec(i) for i in range(3)] + [{'tables': [{'content': KillWorker()}]}] + \
+        [batch_spec(i) for i in range(4, 10)]
+    progress = list()
+    results = sorted(build_batch(specs, workers=2, max_pending=2, progress=lambda *a: progress.append(a)),
+                     key=lambda r: r.index)
+    assert [r.index for r in results] == list(range(10))
+    assert not results[3].ok
+    assert results[-1].ok and results[-1].data.startswith(b'%PDF')
+    assert progress[-1][0] == 10
+
+
+def page_count(data):
+    return len(re.findall(rb'/Type /Page\b', data))
+
+
+@pytest.mark.parametrize('rows', [
+    [[str(i), 'Позиция {}'.format(i % 100), '{:.2f}'.format(i * 1.5)] for i in range(1500)],
+    [[str(i), 'длинный текст ' * (i % 7) or '-', str(i)] for i in range(1500)],
+])
+def test_large_table_pages_match_add_table(rows):
+    headers = [['№', 'Наименование', 'Сумма']]
+    pages = list()
+    for name, extra in (('add_table', dict(repeatRows=1)), ('add_large_table', dict(chunk_rows=50))):
+        creator = PdfCreator()
+        getattr(creator, name)(rows, headers=headers, colWidths=[60, 250, 100], **extra)
+        pages.append(page_count(creator.build()))
+    assert pages[0] == pages[1]
+
+
+def table_positions(monkeypatch, name, rows, **table_args):
+    """Абсолютные x таблиц (частей таблицы) на страницах документа"""
+    positions = list()
+    draw = pdf_creator.Table.draw
+
+    def recording_draw(table):
+        positions.append(round(table.canv._currentMatrix[4], 3))
+        return draw(table)
+
+    monkeypatch.setattr(pdf_creator.Table, 'draw', recording_draw)
+    creator = PdfCreator()
+    getattr(creator, name)(rows, headers=[['№', 'Имя', 'Сумма']], colWidths=[40, 40, 40], **table_args)
+    creator.build()
+    monkeypatch.undo()
+    return positions
+
+
+@pytest.mark.parametrize('size', [5, 400])
+def test_large_table_alignment_matches_add_table(monkeypatch, size):
+    rows = [[str(i), 'r', str(i * 2)] for i in range(size)]
+    expected = table_positions(monkeypatch, 'add_table', rows, repeatRows=1)
+    result = table_positions(monkeypatch, 'add_large_table', rows, chunk_rows=50)
+    assert len(result) == len(expected) and len(set(expected)) == 1
+    assert result == expected
+    left = table_positions(monkeypatch, 'add_large_table', rows, chunk_rows=50, hAlign='LEFT')
+    assert left == table_positions(monkeypatch, 'add_table', rows, repeatRows=1, hAlign='LEFT')
+    assert left[0] < expected[0]
+
+
+def split_pages(table, height=700):
+    """Части LazyTable по страницам, как при верстке"""
+    parts = list()
+    while True:
+        width, needed = table.wrap(410, height)
+        if needed <= height and table._table is not None:
+            return parts + [table._table]
+        split = table.split(410, height)
+        parts.append(split[0])
+        if len(split) == 1:
+            return parts
+        table = split[1]
+
+
+def test_large_table_style_rows_are_absolute():
+    rows = [[str(i), 'row'] for i in range(300)]
+    creator = PdfCreator()
+    table = creator.add_large_table(rows, headers=[['№', 'Имя']], add_table=False, chunk_rows=40,
+                                    style=[('BACKGROUND', (0, 100), (-1, 100), colors.red),
+                                           ('BACKGROUND', (0, 0), (-1, 0), colors.grey)])
+    marked = list()
+    parts = split_pages(table)
+    assert len(parts) > 2
+    for part in parts:
+        header_marked = False
+        for command in part._bkgrndcmds:
+            row = command[1][1]
+            if command[3] == colors.red:
+                marked.append(part._cellvalues[row][0])
+            elif row == 0:
+                header_marked = True
+        assert header_marked
+    assert marked == ['99']
+
+
+@pytest.fixture
+def invariant(monkeypatch):
+    """Одинаковые байты документа при повторной сборке: без даты создания и случайного идентификатора"""
+    monkeypatch.setattr(rl_config, 'invariant', 1)
+
+
+def make_document():
+    creator = PdfCreator()
+    creator.add_header('Акт', ['Утверждаю', 'Директор'], sign='Подпись')
+    creator.add_table([[str(i), 'Позиция {}'.format(i)] for i in range(300)], headers=[['№', 'Имя']])
+    creator.add_bottom(['Итого'])
+    return creator
+
+
+def test_build_to_matches_build(invariant, tmp_path):
+    expected = make_document().build()
+    buffer = io.BytesIO()
+    creator = make_document()
+    assert creator.build_to(buffer) is buffer
+    assert buffer.getvalue() == expected
+    # буфер документа не используется
+    assert creator.buf.getvalue() == b''
+    path = str(tmp_path / 'doc.pdf')
+    make_document().build_to(path)
+    with open(path, 'rb') as f:
+        assert f.read() == expected
+
+
+@pytest.mark.parametrize('max_size', [0, 1024 * 1024])
+def test_iter_build_matches_build(invariant, max_size):
+    expected = make_document().build()
+    chunks = list(make_document().iter_build(chunk_size=4096, max_size=max_size))
+    assert b''.join(chunks) == expected
+    assert all(len(chunk) == 4096 for chunk in chunks[:-1]) and len(chunks) > 1
+
+
+def header_args(number):
+    return dict(document_header_1='Акт {}'.format(number), content=['Утверждаю', 'Директор'],
+                document_header_2='от 01.01.2020', sign='Подпись', timestamp='01.01.2020')
+
+
+def test_templates_match_add_header_and_bottom(invariant):
+    template_creator = PdfCreator()
+    header = template_creator.header_template(**dict(header_args('{number}'), document_header_2='от {date}'))
+    bottom = template_creator.bottom_template(['Итого: {total}', 'Без полей'], sign='Подпись')
+    assert header.fields == {'number', 'date'} and bottom.fields == {'total'}
+
+    for number in (1, 2):
+        expected = PdfCreator()
+        expected.add_header(**header_args(number))
+        expected.add_bottom(['Итого: {}'.format(number * 10), 'Без полей'], sign='Подпись')
+        creator = PdfCreator()
+        creator.add_template(header, number=number, date='01.01.2020')
+        creator.add_template(bottom, total=number * 10)
+        assert creator.build() == expected.build()
+
+
+def test_template_reuses_static_parts():
+    template = PdfCreator().header_template(**header_args('{number}'))
+    first, second = template.fill(number=1), template.fill(number=2)
+    shared = [a for a, b in zip(first, second) if a is b]
+    # меняется только заголовок с полем, остальные части переиспользуются
+    assert len(shared) == len(first) - 1
+    assert all(isinstance(part, pdf_creator.CachedFlowable) for part in shared)
+    with pytest.raises(KeyError):
+        template.fill()
@@ -0,0 +1,676 @@
+import copy
+import io
+import json
+import random
+from collections import OrderedDict
+from types import SimpleNamespace
+
+import pytest
+
+from my_libs.trees import (BREADTH_FIRST, POST_ORDER, PRE_ORDER, SKIP_CHILDREN, SKIP_SIBLINGS, CompactTree,
+                           JsonTreeStream, TreeIndex, branches_lenght, broken_tree, broken_tree_old, checked_branches,
+                           find_in_forest, find_tree_node, find_tree_nodes, gis_tree_constructor,
+                           gis_tree_constructor_old, iter_find, iter_find_nodes, iter_flatten, iter_nodes, iter_values,
+                           make_matcher, merge_tree, tree_aggregate, tree_constructor, tree_to_list, tree_value_setter,
+                           tree_walker, value_collector, walk_tree)
+
+
+def make_forest(size=60, seed=1, roots=3):
+    """Случайный лес из словарей с полями id, parent_id, value, group"""
+    rnd = random.Random(seed)
+    rows = list()
+    for i in range(1, size + 1):
+        parent_id = None if i <= roots else rnd.randint(1, i - 1)
+        rows.append(dict(id=i, parent_id=parent_id, value=rnd.randint(0, 9), group=i % 4))
+    return tree_constructor(rows)
+
+
+def walk_parents(forest, parent=None, depth=0, result=None):
+    """Эталон: рекурсивный обход, {id: (id родителя, глубина)} в порядке прямого обхода"""
+    if result is None:
+        result = dict()
+    for node in forest:
+        result[node['id']] = (parent, depth)
+        walk_parents(node.get('children') or (), node['id'], depth + 1, result)
+    return result
+
+
+def test_tree_index_lookup_and_relations():
+    forest = make_forest()
+    index = TreeIndex(forest)
+    expected = walk_parents(forest)
+
+    assert len(index) == len(expected)
+    assert [node['id'] for node in index.order] == list(expected)
+    for node_id, (parent_id, depth) in expected.items():
+        assert index[node_id]['id'] == node_id
+        assert index.parents[node_id] == parent_id
+        assert index.depth(node_id) == depth
+        subtree = [node['id'] for node in iter_nodes([index[node_id]])]
+        assert [node['id'] for node in index.subtree(node_id)] == subtree
+        ancestors = list()
+        while parent_id is not None:
+            ancestors.insert(0, parent_id)
+            parent_id = expected[parent_id][0]
+        assert [node['id'] for node in index.ancestors(node_id)] == ancestors
+        for other_id in ancestors:
+            assert index.is_descendant(node_id, other_id)
+        assert not index.is_descendant(node_id, node_id)
+
+
+def test_tree_index_duplicate_id():
+    with pytest.raises(ValueError):
+        TreeIndex([dict(id=1, children=[dict(id=1)])])
+
+
+def test_tree_index_lookup_by_field():
+    forest = make_forest()
+    index = TreeIndex(forest)
+    expected = [node for node in iter_nodes(forest) if node['group'] in (1, 2)]
+    assert index.lookup({1, 2}, 'group') == expected
+    assert index.get(-1) is None and -1 not in index
+
+
+MAPPED_FIELDS = ('parent_id', 'group', 'total', 'size', 'key')
+
+
+def make_index(forest):
+    index = TreeIndex(forest, parent_field='parent_id')
+    index.add_aggregate('total', 'value')
+    index.add_aggregate('size', how='count')
+    index.add_derived('key', lambda node, parent, depth: '%s_%s' % (depth, node['value']))
+    return index
+
+
+def assert_same_as_rebuilt(index):
+    """Инкрементально измененный индекс совпадает с построенным заново по тому же лесу"""
+    rebuilt = make_index(copy.deepcopy(index.forest))
+    assert [node['id'] for node in index.order] == [node['id'] for node in rebuilt.order]
+    assert index.parents == rebuilt.parents
+    assert index.depths == rebuilt.depths
+    assert index.tin == rebuilt.tin and index.tout == rebuilt.tout
+    for node_id, node in index.nodes.items():
+        expected = {k: v for k, v in rebuilt[node_id].items() if k != 'children'}
+        assert {k: v for k, v in node.items() if k != 'children'} == expected
+    for field in MAPPED_FIELDS:
+        mapped = {value: sorted(node['id'] for node in nodes)
+                  for value, nodes in index.field_map(field).items() if nodes}
+        expected = {value: sorted(node['id'] for node in nodes)
+                    for value, nodes in rebuilt.field_map(field).items()}
+        assert mapped == expected, field
+        for value in expected:
+            assert [node['id'] for node in index.lookup([value], field)] == \
+                [node['id'] for node in rebuilt.lookup([value], field)]
+
+
+def test_tree_index_incremental_changes_match_rebuild():
+    rnd = random.Random(7)
+    index = make_index(make_forest(size=40))
+    next_id = 1000
+    for step in range(200):
+        for field in MAPPED_FIELDS:
+            index.field_map(field)
+        ids = list(index.nodes)
+        node_id = rnd.choice(ids)
+        operation = rnd.choice(('add', 'remove', 'move', 'update', 'reparent'))
+        if operation == 'add':
+            next_id += 1
+            node = dict(id=next_id, value=rnd.randint(0, 9), group=next_id % 4,
+                        children=[dict(id=-next_id, value=1, group=0)])
+            index.add(node, rnd.choice(ids + [None]))
+        elif operation == 'remove' and len(ids) > 10:
+            index.remove(node_id)
+        elif operation == 'move':
+            targets = [i for i in ids if i != node_id and not index.is_descendant(i, node_id)]
+            index.move(node_id, rnd.choice(targets + [None]))
+        elif operation == 'update':
+            index.update(node_id, dict(value=rnd.randint(0, 9), group=rnd.randint(0, 3)))
+        elif operation == 'reparent':
+            targets = [i for i in ids if i != node_id and not index.is_descendant(i, node_id)]
+            index.update(node_id, dict(parent_id=rnd.choice(targets + [None]), value=rnd.randint(0, 9)))
+        assert_same_as_rebuilt(index)
+
+
+def ids(nodes):
+    return [node['id'] for node in nodes]
+
+
+def paths(pairs):
+    return [(node['id'], ids(path)) for node, path in pairs]
+
+
+def test_tree_index_lookups_after_change_do_not_rebuild_order():
+    rnd = random.Random(3)
+    index = make_index(make_forest(size=80))
+    forest = index.forest
+    for step in range(60):
+        node_ids = list(index.nodes)
+        node_id = rnd.choice(node_ids)
+        targets = [i for i in node_ids if i != node_id and not index.is_descendant(i, node_id)]
+        if step % 3 == 0:
+            index.move(node_id, rnd.choice(targets + [None]))
+        elif step % 3 == 1:
+            index.update(node_id, dict(group=rnd.randint(0, 3)))
+        else:
+            index.add(dict(id=1000 + step, value=1, group=step % 4), rnd.choice(node_ids + [None]))
+
+        def fail():
+            raise AssertionError('order rebuilt')
+
+        index._build_order = fail
+        root = rnd.choice([node for node in forest if node.get('children')] or forest)
+        wrapper = dict(children=forest)
+        values = {rnd.randint(0, 3), rnd.randint(0, 3)}
+        assert find_tree_node(root, node_id, index=index) is find_tree_node(root, node_id)
+        assert find_tree_node(wrapper, node_id, index=index) is index[node_id]
+        assert ids(index.lookup(values, 'group')) == [n['id'] for n in iter_nodes(forest) if n['group'] in values]
+        assert ids(index.lookup([node_id, -1, node_id], 'id')) == [node_id]
+        for tree in (root, wrapper):
+            assert paths(find_tree_nodes(tree, values, 'group', index=index, with_path=True)) == \
+                paths(find_tree_nodes(tree, values, 'group', with_path=True))
+        for nodes in (forest, root['children']):
+            assert paths(find_in_forest(nodes, values, 'group', 'children', index=index, with_path=True)) == \
+                paths(find_in_forest(nodes, values, 'group', 'children', with_path=True))
+            for action in (None, 'break', 'continue'):
+                def func(item, siblings, args):
+                    return item['id'], ids(siblings)
+                assert tree_walker(nodes, 'group', 1, func=func, action=action, index=index) == \
+                    tree_walker(nodes, 'group', 1, func=func, action=action)
+        assert value_collector(root, index=index) == value_collector(root)
+        del index._build_order
+    assert_same_as_rebuilt(index)
+
+
+def test_tree_index_update_parent_field_updates_map():
+    forest = tree_constructor([dict(id=1, parent_id=None), dict(id=2, parent_id=1), dict(id=3, parent_id=1),
+                               dict(id=4, parent_id=3), dict(id=5, parent_id=None)])
+    index = TreeIndex(forest, parent_field='parent_id')
+    assert [node['id'] for node in index.lookup([3], 'parent_id')] == [4]
+    index.update(4, {'parent_id': 5})
+    assert index.lookup([3], 'parent_id') == []
+    assert [node['id'] for node in index.lookup([5], 'parent_id')] == [4]
+    index.move(2, 5)
+    assert [node['id'] for node in index.lookup([1], 'parent_id')] == [3]
+
+
+def test_tree_index_derived_field_can_not_replace_id():
+    index = TreeIndex(make_forest())
+    with pytest.raises(ValueError):
+        index.add_derived('id', lambda node, parent, depth: depth)
+
+
+def subtree_ids(node):
+    return [child['id'] for child in iter_nodes([node])]
+
+
+@pytest.mark.parametrize('how', ['sum', 'count', 'min', 'max'])
+def test_tree_aggregate_subtree(how):
+    forest = make_forest()
+    functions = {'sum': sum, 'count': len, 'min': min, 'max': max}
+    result = tree_aggregate(forest, 'value', how=how)
+    index = TreeIndex(forest)
+    for node_id, node in index.nodes.items():
+        assert result[node_id] == functions[how]([index[i]['value'] for i in subtree_ids(node)])
+
+
+def test_tree_aggregate_path():
+    forest = make_forest()
+    index = TreeIndex(forest)
+    result = tree_aggregate(forest, 'value', how='sum', scope='path')
+    for node_id, node in index.nodes.items():
+        assert result[node_id] == node['value'] + sum(a['value'] for a in index.ancestors(node_id))
+
+
+def test_tree_aggregate_count_by_id_field():
+    forest = make_forest()
+    index = TreeIndex(forest)
+    result = tree_aggregate(forest, 'id', how='count')
+    assert result == {node_id: len(subtree_ids(node)) for node_id, node in index.nodes.items()}
+
+
+def test_compact_tree_ignores_duplicate_columns():
+    tree = CompactTree.from_forest(make_forest(), columns=['id', 'value', 'id'])
+    assert list(tree.columns) == ['id', 'value']
+    assert len(tree.columns['id']) == len(tree)
+
+
+class GisRow:
+    """Объект с интерфейсом, который ожидает gis_tree_constructor"""
+
+    def __init__(self, id, parent_id):
+        self.id = id
+        self.parent_id = parent_id
+        self.text = 'node %s' % id
+        self.tag = id % 3
+
+    def row2dict(self, add_prop=None):
+        result = dict(id=self.id, parent_id=self.parent_id)
+        for prop in add_prop or ():
+            result[prop] = self.id * 10
+        return result
+
+
+def make_gis_rows(size=80, seed=3):
+    rnd = random.Random(seed)
+    rows = [GisRow(i, None if i <= 3 else rnd.randint(1, i - 1)) for i in range(1, size + 1)]
+    # строки с несуществующим родителем не попадают в дерево ни в одной из версий
+    rows.append(GisRow(size + 1, -1))
+    rnd.shuffle(rows)
+    return rows
+
+
+@pytest.mark.parametrize('parent', [None, 1, 2])
+@pytest.mark.parametrize('del_epmty_children', [False, True])
+def test_gis_tree_constructor_matches_recursive_version(parent, del_epmty_children):
+    rows = make_gis_rows()
+    calls, old_calls = list(), list()
+    result = gis_tree_constructor(rows, parent=parent, del_epmty_children=del_epmty_children,
+                                  func=lambda item, args: args.append(item['id']), func_args=calls)
+    expected = gis_tree_constructor_old(rows, parent=parent, del_epmty_children=del_epmty_children,
+                                        func=lambda item, args: args.append(item['id']), func_args=old_calls)
+    assert result == expected
+    assert calls == old_calls
+
+
+def recursive_walk(forest, order, prune=None, parent=None, depth=0):
+    """Эталон: рекурсивный обход в прямом или обратном порядке, [(id, id родителя, глубина), ...]"""
+    result = list()
+    for node in forest:
+        action = prune(node, parent, depth) if prune else None
+        item = (node['id'], parent and parent['id'], depth)
+        if order == PRE_ORDER:
+            result.append(item)
+        if not action:
+            result.extend(recursive_walk(node.get('children') or (), order, prune, node, depth + 1))
+        if order == POST_ORDER:
+            result.append(item)
+        if action == SKIP_SIBLINGS:
+            break
+    return result
+
+
+def level_walk(forest):
+    """Эталон обхода в ширину: уровни дерева по порядку"""
+    result = list()
+    level = [(node, None) for node in forest]
+    depth = 0
+    while level:
+        result.extend((node['id'], parent and parent['id'], depth) for node, parent in level)
+        level = [(child, node) for node, parent in level for child in node.get('children') or ()]
+        depth += 1
+    return result
+
+
+def walked(forest, order, prune=None):
+    return [(node['id'], parent and parent['id'], depth) for node, parent, depth in walk_tree(forest, order=order,
+                                                                                             prune=prune)]
+
+
+def test_walk_tree_matches_recursive_walk():
+    forest = make_forest(size=120)
+    assert walked(forest, PRE_ORDER) == recursive_walk(forest, PRE_ORDER)
+    assert walked(forest, POST_ORDER) == recursive_walk(forest, POST_ORDER)
+    assert walked(forest, BREADTH_FIRST) == level_walk(forest)
+    with pytest.raises(ValueError):
+        walk_tree(forest, order='unknown')
+
+
+@pytest.mark.parametrize('order', [PRE_ORDER, POST_ORDER])
+def test_walk_tree_prune(order):
+    forest = make_forest(size=120)
+
+    def prune(node, parent, depth):
+        if node['value'] == 9:
+            return SKIP_SIBLINGS
+        if node['group'] == 0:
+            return SKIP_CHILDREN
+
+    assert walked(forest, order, prune) == recursive_walk(forest, order, prune)
+
+
+def test_walk_tree_is_not_limited_by_recursion_depth():
+    depth = 5000
+    forest = tree_constructor([dict(id=i, parent_id=i - 1 if i else None) for i in range(depth)])
+    assert [d for node, parent, d in walk_tree(forest)] == list(range(depth))
+    assert len(list(walk_tree(forest, order=POST_ORDER))) == depth
+    assert [node['id'] for node in tree_to_list(forest)] == list(range(depth))
+
+
+def recursive_tree_walker(tree, target_field, target_value, children, func, func_args, func_result, action):
+    """Эталон: рекурсивный tree_walker"""
+    for item in tree:
+        if item.get(target_field) == target_value:
+            func_result.append(func(item, tree, func_args))
+            if action == 'break':
+                break
+            elif action == 'continue':
+                continue
+        if item.get(children):
+            recursive_tree_walker(item[children], target_field, target_value, children, func, func_args,
+                                  func_result, action)
+    return func_result
+
+
+@pytest.mark.parametrize('action', [None, 'break', 'continue'])
+@pytest.mark.parametrize('with_index', [False, True])
+def test_tree_walker_matches_recursive_version(action, with_index):
+    forest = make_forest(size=120)
+    index = TreeIndex(forest) if with_index else None
+
+    def func(item, tree, args):
+        return item['id'], [node['id'] for node in tree], args
+
+    result = tree_walker(forest, 'group', 1, func=func, func_args='x', action=action, index=index)
+    assert result == recursive_tree_walker(forest, 'group', 1, 'children', func, 'x', list(), action)
+
+
+def make_branches(size=40, seed=5):
+    """Дерево в формате branches_lenght: OrderedDict {id: объект}, дети - список таких же OrderedDict"""
+    rnd = random.Random(seed)
+    objects = {1: SimpleNamespace(length=rnd.randint(1, 9))}
+    for i in range(2, size + 1):
+        objects[i] = SimpleNamespace(length=rnd.randint(1, 9))
+        parent = objects[rnd.randint(1, i - 1)]
+        if getattr(parent, 'children', None) is None:
+            parent.children = list()
+        parent.children.append(OrderedDict([(i, objects[i])]))
+    return OrderedDict([(1, objects[1])])
+
+
+def recursive_branches_lenght(tree, branch_lenght=0, result=None):
+    """Эталон: рекурсивный branches_lenght"""
+    if result is None:
+        result = []
+    for key in tree:
+        branch = tree[key]
+        current_lenght = branch_lenght + branch.length
+        if getattr(branch, 'children', None):
+            for child in branch.children:
+                recursive_branches_lenght(child, current_lenght, result)
+        else:
+            result.append(current_lenght)
+    return result
+
+
+def test_branches_lenght_matches_recursive_version():
+    tree = make_branches()
+    assert branches_lenght(tree, 'length') == recursive_branches_lenght(tree)
+    assert branches_lenght(tree, 'length', branch_lenght=5) == recursive_branches_lenght(tree, 5)
+
+
+def test_iter_variants_match_list_versions():
+    forest = make_forest(size=120)
+    root = dict(children=forest)
+    assert list(iter_find_nodes(root, [1, 2], 'group')) == find_tree_nodes(root, [1, 2], 'group')
+    assert list(iter_find_nodes(root, [1], 'group', with_children=False)) == \
+        find_tree_nodes(root, [1], 'group', with_children=False)
+    assert list(iter_find(forest, [0], 'group')) == find_in_forest(forest, [0], 'group', 'children')
+    assert list(iter_values(forest[0], 'value')) == value_collector(forest[0], 'value')
+    assert list(iter_flatten(copy.deepcopy(forest))) == tree_to_list(copy.deepcopy(forest))
+
+
+def test_iter_flatten_is_lazy():
+    forest = make_forest(size=30, roots=1)
+    inner = [node for node in iter_nodes(forest) if node.get('children')][1:]
+    nodes = iter_flatten(forest)
+    first = next(nodes)
+    assert first is forest[0] and 'children' not in first
+    # глубже лежащие узлы разбираются только по мере итерации
+    assert inner and all(node.get('children') for node in inner)
+    rest = list(nodes)
+    assert len(rest) == 29 and not any('children' in node for node in rest)
+
+
+def test_iter_find_stops_early():
+    visited = list()
+    forest = make_forest(size=120)
+
+    def predicate(node):
+        visited.append(node['id'])
+        return True
+
+    assert next(iter_find(forest, None, 'id', predicate=predicate)) is forest[0]
+    assert visited == [forest[0]['id']]
+
+
+def make_checked_forest(size=80, seed=11):
+    forest = make_forest(size=size, seed=seed)
+    for node in iter_nodes(forest):
+        node['checked'] = node['value'] == 0
+    return forest
+
+
+def make_items_tree(width=3, depth=3, prefix=''):
+    """Дерево в формате merge_tree: узлы с полями value и items"""
+    if not depth:
+        return []
+    return [dict(value=prefix + str(i), items=make_items_tree(width, depth - 1, prefix + str(i)))
+            for i in range(width)]
+
+
+def assert_non_destructive(func, tree, *args, **kwargs):
+    """Вызов с inplace=False не меняет исходное дерево и дает тот же результат, что и inplace=True"""
+    original = copy.deepcopy(tree)
+    result = func(tree, *args, inplace=False, **kwargs)
+    assert tree == original
+    assert result == func(copy.deepcopy(tree), *args, **kwargs)
+    return result
+
+
+def test_tree_to_list_not_inplace():
+    forest = make_forest()
+    result = assert_non_destructive(tree_to_list, forest)
+    leaves = {id(node) for node in iter_nodes(forest) if not node.get('children')}
+    assert any(id(node) in leaves for node in result)
+
+
+def test_checked_branches_not_inplace():
+    assert_non_destructive(checked_branches, make_checked_forest())
+
+
+def test_tree_value_setter_not_inplace():
+    assert_non_destructive(tree_value_setter, make_items_tree(), 'checked', value=True)
+
+
+def test_merge_tree_not_inplace():
+    tree = make_items_tree()
+    branches = [dict(value='0', checked=True),
+                dict(value='1', items=[dict(value='11', checked=True),
+                                       dict(value='12', items=[dict(value='120', checked=True)])])]
+    result = assert_non_destructive(merge_tree, tree, branches)
+    assert result[2] is tree[2]
+    with pytest.raises(Exception):
+        merge_tree(tree, [dict(value='missing')], inplace=False)
+
+
+def test_make_matcher():
+    matcher = make_matcher([1, 2], 'group', fields={'value': range(5)}, predicate=lambda node: node['id'] > 3)
+    assert matcher(dict(id=4, group=1, value=4))
+    assert not matcher(dict(id=4, group=3, value=4))
+    assert not matcher(dict(id=4, group=1, value=5))
+    assert not matcher(dict(id=3, group=1, value=4))
+    assert make_matcher()(dict())
+    # нехешируемые значения поля и искомые значения
+    assert not make_matcher([1])(dict(id=[1]))
+    assert make_matcher([[1], [2]])(dict(id=[2]))
+
+
+@pytest.mark.parametrize('with_index', [False, True])
+def test_find_tree_nodes_fields_and_path(with_index):
+    forest = make_forest(size=120)
+    root = forest[0]
+    index = TreeIndex(forest) if with_index else None
+    parents = walk_parents(forest)
+
+    def path(node):
+        result = list()
+        parent_id = parents[node['id']][0]
+        while parent_id != root['id']:
+            result.insert(0, parent_id)
+            parent_id = parents[parent_id][0]
+        return result
+
+    expected = [node for node in iter_nodes(root['children']) if node['group'] in (1, 2) and node['value'] < 5]
+    result = find_tree_nodes(root, [1, 2], 'group', fields={'value': range(5)}, index=index, with_path=True)
+    assert [node for node, node_path in result] == expected
+    assert [[a['id'] for a in node_path] for node, node_path in result] == [path(node) for node in expected]
+    odd = find_tree_nodes(root, {1, 2}, 'group', predicate=lambda node: node['id'] % 2, index=index)
+    assert odd == [node for node in iter_nodes(root['children']) if node['group'] in (1, 2) and node['id'] % 2]
+
+
+@pytest.mark.parametrize('with_index', [False, True])
+def test_find_in_forest_fields_and_path(with_index):
+    forest = make_forest(size=120)
+    index = TreeIndex(forest) if with_index else None
+    result = find_in_forest(forest, [1], 'group', 'children', index=index, fields={'value': range(5, 10)},
+                            with_path=True)
+    expected = list()
+
+    def collect(nodes, path):
+        for node in nodes:
+            if node['group'] == 1 and node['value'] >= 5:
+                expected.append((node, path))
+            else:
+                collect(node.get('children') or (), path + [node])
+
+    collect(forest, [])
+    assert result == expected
+
+
+class DictRow:
+    """Строка источника JsonTreeStream"""
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def row2dict(self):
+        return dict(self.fields)
+
+
+class StreamQuery(list):
+    """Источник с yield_per, как у запроса SQLAlchemy"""
+    batch_size = None
+
+    def yield_per(self, batch_size):
+        self.batch_size = batch_size
+        return iter(self)
+
+
+def make_rows(size=150, seed=13):
+    rnd = random.Random(seed)
+    return [dict(id=i, parent_id=None if i <= 3 else rnd.randint(1, i - 1), name='узел "%s"' % i)
+            for i in range(1, size + 1)]
+
+
+@pytest.mark.parametrize('chunk_size', [1, 100, 64 * 1024])
+def test_json_tree_stream_matches_tree_constructor(chunk_size):
+    rows = make_rows()
+    source = StreamQuery(DictRow(**row) for row in rows)
+    stream = JsonTreeStream(source, batch_size=50)
+    assert source.batch_size == 50 and len(stream) == len(rows)
+    result = ''.join(stream.iter_json(chunk_size))
+    assert json.loads(result) == tree_constructor(copy.deepcopy(rows))
+    assert b''.join(stream.iter_json(chunk_size, encoding='utf-8')) == result.encode('utf-8')
+
+
+def test_json_tree_stream_orphans_become_roots():
+    rows = make_rows()
+    rows = [row for row in rows if row['id'] % 10]
+    stream = JsonTreeStream([DictRow(**row) for row in rows])
+    assert json.loads(''.join(stream.iter_json())) == broken_tree(copy.deepcopy(rows))
+
+
+def test_json_tree_stream_dump(tmp_path):
+    rows = make_rows(size=20)
+    stream = JsonTreeStream([DictRow(**row) for row in rows],
+                            func=lambda item, args: item.update(tag=args), func_args='x', children='items')
+    expected = tree_constructor(copy.deepcopy(rows), func=lambda item, args: item.update(tag=args),
+                                func_args='x', children='items')
+    path = str(tmp_path / 'tree.json')
+    stream.dump(path)
+    with open(path, encoding='utf-8') as f:
+        assert json.load(f) == expected
+    buffer = io.BytesIO()
+    stream.dump(buffer, chunk_size=10, encoding='utf-8')
+    assert json.loads(buffer.getvalue().decode('utf-8')) == expected
+    assert ''.join(JsonTreeStream([]).iter_json()) == '[]'
+
+
+def test_compact_tree_round_trip():
+    forest = make_forest(size=120)
+    tree = CompactTree.from_forest(forest, typecodes={'value': 'i'})
+    assert len(tree) == 120 and tree.columns['value'].typecode == 'i'
+    assert tree.to_forest() == forest
+    assert [tree.node(root)['id'] for root in tree.roots()] == [node['id'] for node in forest]
+    index = TreeIndex(forest)
+    for node_id, node in index.nodes.items():
+        position = tree.position(node_id)
+        assert tree.to_forest(position) == [node]
+        assert [tree.node(child)['id'] for child in tree.iter_children(position)] == \
+            [child['id'] for child in node.get('children') or ()]
+        assert tree.depth[position] == index.depth(node_id)
+    assert tree.position(-1) is None
+    assert CompactTree.from_forest([]).to_forest() == []
+
+
+def test_compact_tree_queries_match_dict_versions():
+    forest = make_checked_forest(size=120)
+    tree = CompactTree.from_forest(forest)
+    ids = tree.columns['id']
+    assert [ids[i] for i in tree.find({1, 2}, 'group')] == \
+        [node['id'] for node in iter_nodes(forest) if node['group'] in (1, 2)]
+    assert [ids[i] for i in tree.find([0], 'group', descend=False)] == \
+        [node['id'] for node in find_in_forest(forest, [0], 'group', 'children')]
+    root = tree.position(forest[0]['id'])
+    assert [ids[i] for i in tree.find([3], 'group', position=root)] == \
+        [node['id'] for node in iter_nodes([forest[0]]) if node['group'] == 3]
+    assert tree.collect('value', root) == value_collector(forest[0], 'value')
+    assert tree.checked_branches().to_forest() == checked_branches(copy.deepcopy(forest))
+
+    def leaf_paths(nodes, total=0):
+        for node in nodes:
+            if node.get('children'):
+                yield from leaf_paths(node['children'], total + node['value'])
+            else:
+                yield total + node['value']
+
+    assert tree.branches_length('value') == list(leaf_paths(forest))
+
+
+def make_broken_tree_old(size=60, seed=17):
+    """Результат broken_tree_old: OrderedDict объектов, дети - список OrderedDict([(id, объект)])"""
+    rnd = random.Random(seed)
+    items = OrderedDict()
+    for i in range(1, size + 1):
+        parent_id = None if i <= 2 else rnd.randint(1, i - 1)
+        items[i] = SimpleNamespace(id=i, parent_id=parent_id, length=rnd.randint(1, 9))
+    return broken_tree_old(items)
+
+
+def test_branches_lenght_over_broken_tree_old():
+    items = make_broken_tree_old()
+    roots = OrderedDict((key, item) for key, item in items.items() if item.parent_id is None)
+    assert branches_lenght(roots, 'length') == recursive_branches_lenght(roots)
+    assert branches_lenght(roots, 'length', branch_lenght=2.5) == recursive_branches_lenght(roots, 2.5)
+    items[5].length = None
+    with pytest.raises(Exception):
+        branches_lenght(roots, 'length')
+
+
+def test_tree_aggregate_over_broken_tree_old():
+    items = make_broken_tree_old()
+    roots = [item for item in items.values() if item.parent_id is None]
+
+    def children(item):
+        return [child[key] for child in getattr(item, 'children', None) or () for key in child]
+
+    def subtree_total(item):
+        return item.length + sum(subtree_total(child) for child in children(item))
+
+    result = tree_aggregate(roots, 'length', children=children, getter=getattr)
+    assert result == {key: subtree_total(item) for key, item in items.items()}
+    compact = CompactTree.from_forest(roots, children, columns=['id', 'length'], getter=getattr)
+    assert compact.branches_length('length') == \
+        branches_lenght(OrderedDict((item.id, item) for item in roots), 'length')
+    with pytest.raises(ValueError):
+        CompactTree.from_forest(roots, children, getter=getattr)
@@ -0,0 +1,160 @@
+import datetime
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+pytest.importorskip('dateutil')
+
+from dateutil.parser import parse
+
+from sqlalchemy import Column, DateTime, Integer, Interval, String
+from sqlalchemy.orm import declarative_base
+
+from my_libs.utils import (datetime2str, datetime_list2str, iso2datetime, iso2roundedDT, iso_list2datetime,
+                           isostr2datetime, local_timezone, mass_row2dict, row2dict)
+
+Base = declarative_base()
+
+
+class Event(Base):
+    __tablename__ = 'events'
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    started = Column(DateTime)
+    duration = Column(Interval)
+
+    @property
+    def label(self):
+        return '%s:%s' % (self.id, self.name)
+
+
+def baseline_row2dict(row, b=None, add_prop=None, strict_mode=True):
+    """row2dict до RowSerializer"""
+    d = {}
+    b = b or []
+    for c in row.__table__.columns:
+        if c.name not in b:
+            value = getattr(row, c.name)
+            if isinstance(value, datetime.datetime):
+                value = datetime2str(date_time=value)
+            elif isinstance(value, datetime.timedelta):
+                value = str(value)
+            d[c.name] = value
+    for k in add_prop or ():
+        try:
+            value = getattr(row, k)
+        except AttributeError:
+            if strict_mode:
+                raise
+            continue
+        d[k] = value
+    return d
+
+
+def make_events():
+    return [Event(id=i, name='e%s' % i, started=datetime.datetime(2020, 1, 2, 3, 4, 5, 600) if i % 2 else None,
+                  duration=datetime.timedelta(hours=i) if i % 3 else None) for i in range(6)]
+
+
+@pytest.mark.parametrize('b', [None, [], ['name'], ('id', 'started'), 'name', 'id,name', 'started duration'])
+def test_row2dict_matches_baseline(b):
+    for event in make_events():
+        assert row2dict(event, b) == baseline_row2dict(event, b)
+    assert mass_row2dict(make_events(), b) == [baseline_row2dict(e, b) for e in make_events()]
+
+
+def test_mass_row2dict_passes_non_datetime_values():
+    # у еще не сохраненного объекта в колонке DateTime может лежать date или строка
+    events = [Event(id=1, started=datetime.date(2020, 1, 2)), Event(id=2, started='2020-01-02 10:00'),
+              Event(id=3, started=datetime.datetime(2020, 1, 2, 10, 0, 30)), Event(id=4)]
+    expected = [baseline_row2dict(event) for event in events]
+    assert [row2dict(event) for event in events] == expected
+    assert mass_row2dict(events) == expected
+    assert datetime_list2str([datetime.date(2020, 1, 2), 'x', datetime.timedelta(hours=1)], False) == \
+        [datetime.date(2020, 1, 2), 'x', '1:00:00']
+
+
+def test_row2dict_string_exclude_is_substring_match():
+    assert row2dict(make_events()[1], 'id,name') == {'started': '2020-01-02T03:04:00', 'duration': '1:00:00'}
+
+
+def test_row2dict_add_prop():
+    event = make_events()[1]
+    assert row2dict(event, add_prop=['label'])['label'] == '1:e1'
+    assert 'missing' not in row2dict(event, add_prop=['missing'], strict_mode=False)
+    with pytest.raises(AttributeError):
+        row2dict(event, add_prop=['missing'])
+
+
+def baseline_datetime2str(date_time, set_seconds_null=True):
+    """datetime2str до isoformat(timespec)"""
+    date_time = date_time.replace(microsecond=0)
+    if set_seconds_null:
+        date_time = date_time.replace(second=0)
+    return date_time.isoformat()
+
+
+DATETIMES = [
+    datetime.datetime(2020, 1, 2, 3, 4, 5, 600),
+    datetime.datetime(2020, 1, 2, 3, 4),
+    datetime.datetime(1999, 12, 31, 23, 59, 59, 999999),
+    datetime.datetime(2020, 6, 1, 12, 30, 15, tzinfo=datetime.timezone.utc),
+    datetime.datetime(2020, 6, 1, 12, 30, 15, 7, tzinfo=datetime.timezone(datetime.timedelta(hours=5, minutes=30))),
+    datetime.datetime(2020, 6, 1, 12, 30, 15, tzinfo=datetime.timezone(-datetime.timedelta(hours=3))),
+]
+
+
+@pytest.mark.parametrize('set_seconds_null', [True, False])
+def test_datetime2str_matches_baseline(set_seconds_null):
+    for value in DATETIMES:
+        assert datetime2str(value, set_seconds_null=set_seconds_null) == \
+            baseline_datetime2str(value, set_seconds_null)
+    delta = datetime.timedelta(days=1, seconds=30)
+    assert datetime2str(DATETIMES[0], delta, set_seconds_null) == \
+        baseline_datetime2str(DATETIMES[0] + delta, set_seconds_null)
+    assert datetime_list2str(DATETIMES + [None], set_seconds_null) == \
+        [baseline_datetime2str(value, set_seconds_null) for value in DATETIMES] + [None]
+
+
+def test_datetime2str_now_uses_local_timezone():
+    assert local_timezone() is local_timezone()
+    now = datetime.datetime.fromisoformat(datetime2str())
+    assert now.utcoffset() == datetime.datetime.now(local_timezone()).utcoffset()
+    assert now.second == 0 and now.microsecond == 0
+
+
+ISO_STRINGS = [
+    '2020-01-02T03:04:00',
+    '2020-01-02T03:04:05.123456',
+    '2020-01-02 03:04:05',
+    '2020-01-02',
+    '2020-06-01T12:30:00+05:30',
+    '2020-06-01T12:30:15-03:00',
+    '2020-06-01T12:30:15Z',
+    # не ISO формат разбирается dateutil
+    '02.01.2020 03:04',
+    'Jan 2 2020 3:04 PM',
+]
+
+
+def assert_same_datetime(value, expected):
+    assert value == expected
+    assert value.utcoffset() == expected.utcoffset()
+
+
+def test_iso2datetime_matches_dateutil():
+    for value in ISO_STRINGS + [datetime2str(dt) for dt in DATETIMES]:
+        assert_same_datetime(iso2datetime(value), parse(value))
+        assert_same_datetime(iso2roundedDT(value), parse(value).replace(second=0, microsecond=0))
+        assert isostr2datetime(value) == parse(value).strftime('%H:%M %d-%m-%Y')
+    with pytest.raises(ValueError):
+        iso2datetime('not a date')
+
+
+@pytest.mark.parametrize('rounded', [False, True])
+def test_iso_list2datetime_matches_dateutil(rounded):
+    result = iso_list2datetime(ISO_STRINGS + [None], rounded=rounded)
+    assert result[-1] is None
+    for value, expected in zip(result, ISO_STRINGS):
+        expected = parse(expected)
+        assert_same_datetime(value, expected.replace(second=0, microsecond=0) if rounded else expected)
@@ -1,10 +1,135 @@
-from collections import OrderedDict
+import json
+from array import array
+from collections import OrderedDict, deque
+from operator import methodcaller
+
+PRE_ORDER = 'pre'
+POST_ORDER = 'post'
+BREADTH_FIRST = 'bfs'
+
+SKIP_CHILDREN = 1
+SKIP_SIBLINGS = 2
+
+_END = object()
+
+
+def walk_tree(forest, children='children', order=PRE_ORDER, prune=None):
+    """
+    Обход массива деревьев с явным стеком (очередью при обходе в ширину), глубина дерева не ограничена
+    глубиной рекурсии. Генератор возвращает кортежи (узел, родитель, глубина), у корней родитель None и глубина 0.
+    Для досрочного выхода достаточно прекратить итерацию. Дети узла извлекаются до того, как узел будет отдан,
+    поэтому поле с детьми можно удалять из узла во время обхода.
+    :param forest: [<dict>, ...] - массив деревьев
+    :param children: <str> поле массив с подчиненными объектами, кортеж таких полей или функция node -> [<node>, ...]
+    :param order: PRE_ORDER - прямой обход, POST_ORDER - обратный, BREADTH_FIRST - в ширину
+    :param prune: функция (узел, родитель, глубина), вызывается при входе в узел. Если возвращает SKIP_CHILDREN,
+    то потомки узла не обходятся, если SKIP_SIBLINGS - не обходятся также оставшиеся соседи узла
+    :return: генератор (<tree_node>, <tree_node> / None, <int>)
+    """
+    get_children = _children_getter(children)
+    if order == PRE_ORDER:
+        return _pre_order(forest, get_children, prune)
+    elif order == POST_ORDER:
+        return _post_order(forest, get_children, prune)
+    elif order == BREADTH_FIRST:
+        return _breadth_first(forest, get_children, prune)
+    raise ValueError('Unknown traversal order {!r}'.format(order))
+
+
+def _children_getter(children):
+    """Функция извлечения детей узла по имени поля, кортежу имен или готовой функции"""
+    if callable(children):
+        return children
+    if isinstance(children, str):
+        return methodcaller('get', children)
+    keys = tuple(children)
+
+    def getter(node):
+        result = list()
+        for key in keys:
+            if node.get(key):
+                result.extend(node[key])
+        return result
+    return getter
+
+
+def _pre_order(forest, get_children, prune):
+    # элементы стека: (итератор по соседям, их родитель, их глубина)
+    stack = [(iter(forest), None, 0)]
+    push = stack.append
+    pop = stack.pop
+    if prune is None:
+        while stack:
+            nodes, parent, depth = pop()
+            for node in nodes:
+                node_children = get_children(node)
+                if node_children:
+                    push((nodes, parent, depth))
+                    push((iter(node_children), node, depth + 1))
+                    yield node, parent, depth
+                    break
+                yield node, parent, depth
+        return
+
+    while stack:
+        nodes, parent, depth = pop()
+        for node in nodes:
+            action = prune(node, parent, depth)
+            if not action:
+                node_children = get_children(node)
+                if node_children:
+                    push((nodes, parent, depth))
+                    push((iter(node_children), node, depth + 1))
+                    yield node, parent, depth
+                    break
+            yield node, parent, depth
+            if action == SKIP_SIBLINGS:
+                break
+
+
+def _post_order(forest, get_children, prune):
+    # элементы стека: (итератор по соседям, их родитель, родитель родителя, глубина соседей)
+    stack = [(iter(forest), _END, None, 0)]
+    while stack:
+        nodes, owner, owner_parent, depth = stack.pop()
+        parent = None if owner is _END else owner
+        descended = False
+        for node in nodes:
+            action = None if prune is None else prune(node, parent, depth)
+            if not action:
+                node_children = get_children(node)
+                if node_children:
+                    stack.append((nodes, owner, owner_parent, depth))
+                    stack.append((iter(node_children), node, parent, depth + 1))
+                    descended = True
+                    break
+            yield node, parent, depth
+            if action == SKIP_SIBLINGS:
+                break
+        if not descended and owner is not _END:
+            yield owner, owner_parent, depth - 1
+
+
+def _breadth_first(forest, get_children, prune):
+    queue = deque([(forest, None, 0)])
+    while queue:
+        nodes, parent, depth = queue.popleft()
+        for node in nodes:
+            action = None if prune is None else prune(node, parent, depth)
+            if not action:
+                node_children = get_children(node)
+                if node_children:
+                    queue.append((node_children, node, depth + 1))
+            yield node, parent, depth
+            if action == SKIP_SIBLINGS:
+                break
 
 
 def tree_constructor(source, parent_field='parent_id', id_field='id', func=None, func_args=None,
                      children='children', del_epmty_children=False):
     """
-    Строит дерево из массива объектов SQLAlchemy, конвертируя объект в dict(). У объектов должен быть метод row2dict
+    Строит дерево из массива объектов SQLAlchemy, конвертируя объект в dict(). У объектов должен быть метод row2dict,
+    готовые словари (например, из GeneralMethodMixin.dicts) используются как есть
     :param del_epmty_children <Bool> - если стоит true, то удаляет пустой ключ children
     :param func: функция, которая принимает первым аргуметом dict_item, а остальными func_args
     :param func_args: дополнительные аргументы функции
@@ -14,7 +139,7 @@ def tree_constructor(source, parent_field='parent_id', id_field='id', func=None,
     :return: Массив
     """
     result = list()
-    source = [item.row2dict() for item in source]
+    source = [item if isinstance(item, dict) else item.row2dict() for item in source]
     map_source = {item[id_field]: item for item in source}
 
     for item in source:
@@ -36,154 +161,346 @@ def tree_constructor(source, parent_field='parent_id', id_field='id', func=None,
     return result
 
 
-def find_tree_node(tree, target_id, id_field='id', children='children'):
+def iter_nodes(forest, children='children', order=PRE_ORDER):
+    """
+    Ленивый обход узлов массива деревьев
+    :param forest: [<dict>, ...] - массив деревьев
+    :param children: <str> поле массив с подчиненными объектами
+    :param order: порядок обхода PRE_ORDER / POST_ORDER / BREADTH_FIRST
+    :return: генератор <tree_node>
+    """
+    for node, parent, depth in walk_tree(forest, children, order):
+        yield node
+
+
+def find_tree_node(tree, target_id, id_field='id', children='children', index=None):
     """
     Поиск элемента в дереве
     :param tree: <dict> - дерево
     :param target_id: искомое значение
     :param id_field: <str> поле идентификатор объекта
     :param children: <str> поле массив с подчиненными объектами
+    :param index: <TreeIndex> - индекс дерева, при наличии поиск выполняется без обхода
     :return: <tree_node> / None
     """
-    result = None
-    for node in tree.get(children):
+    if index is not None and index.id_field == id_field:
+        found = index.subtree_lookup([target_id], id_field, tree)
+        if found is not None:
+            return found[0] if found else None
+
+    for node, parent, depth in walk_tree(tree.get(children), children):
         if node.get(id_field) == target_id:
-            result = node
-            break
-        else:
-            if node.get(children):
-                result = find_tree_node(node, target_id, id_field, children)
-            if result:
-                break
-    return result
+            return node
+    return None
 
 
-def find_tree_nodes(tree, values, target_field='id', children='children', with_children=True, result=None):
+def make_matcher(values=None, target_field='id', fields=None, predicate=None):
+    """
+    Строит условие поиска node -> bool. Искомые значения один раз приводятся к множеству, поэтому проверка
+    каждого узла выполняется за O(1) независимо от количества значений. Все условия объединяются через "и".
+    :param values: искомые значения поля target_field, None - без условия на target_field
+    :param target_field: <str> поле по которому ищется значение
+    :param fields: {<str>: [<значение>, ...]} - дополнительные поля и их допустимые значения
+    :param predicate: функция node -> bool
+    :return: функция node -> bool
+    """
+    conditions = list()
+    if values is not None:
+        conditions.append((target_field, _as_lookup(values)))
+    if fields:
+        conditions.extend((field, _as_lookup(field_values)) for field, field_values in fields.items())
+
+    def matcher(node):
+        for field, lookup in conditions:
+            try:
+                if node.get(field) not in lookup:
+                    return False
+            except TypeError:
+                # нехешируемое значение поля не может совпасть с элементом множества
+                return False
+        return predicate is None or bool(predicate(node))
+    return matcher
+
+
+def _as_lookup(values):
+    """Приведение искомых значений к множеству, если значения хешируемы"""
+    if isinstance(values, (set, frozenset, dict, str, bytes)):
+        return values
+    values = values if isinstance(values, (list, tuple)) else list(values)
+    try:
+        return frozenset(values)
+    except TypeError:
+        return values
+
+
+def find_tree_nodes(tree, values, target_field='id', children='children', with_children=True, result=None,
+                    index=None, fields=None, predicate=None, with_path=False):
     """
     Поиск элементов в дереве по target_field in values
     :param tree: <dict> - дерево
-    :param values: искомые значения
+    :param values: искомые значения, None - без условия на target_field
     :param target_field: <str> поле по которому ищется значение
     :param children: <str> поле массив с подчиненными объектами
     :param with_children: <bool> параметр отвечает за добавление в результат ноды, которые имеют подчиненные ноды
+    :param index: <TreeIndex> - индекс дерева, при наличии поиск выполняется без обхода
+    :param fields: {<str>: [<значение>, ...]} - дополнительные условия на поля
+    :param predicate: функция node -> bool, дополнительное условие
+    :param with_path: <bool> вместо узлов возвращать пары (узел, [предки узла внутри tree начиная с верхнего])
     :return: [<tree_node>, ...]
     """
     if result is None:
         result = list()
-
-    for node in tree.get(children):
-        if node.get(target_field) in values:
-            if with_children or not node.get(children):
-                result.append(node)
-        if node.get(children):
-            find_tree_nodes(node, values, target_field, children, with_children, result)
+    result.extend(iter_find_nodes(tree, values, target_field, children, with_children, index, fields, predicate,
+                                  with_path))
     return result
 
 
-def find_in_forest(forest, values, target_field, children):
+def iter_find_nodes(tree, values, target_field='id', children='children', with_children=True, index=None,
+                    fields=None, predicate=None, with_path=False):
+    """
+    Ленивый вариант find_tree_nodes, узлы отдаются в порядке прямого обхода
+    :return: генератор <tree_node> / (<tree_node>, [<tree_node>, ...])
+    """
+    matcher = make_matcher(values, target_field, fields, predicate)
+
+    if index is not None and values is not None:
+        nodes = index.subtree_lookup(_as_lookup(values), target_field, tree)
+        if nodes is not None:
+            for node in nodes:
+                if matcher(node) and (with_children or not node.get(children)):
+                    yield (node, _index_path(index, node, tree[children])) if with_path else node
+            return
+
+    path = list()
+    for node, parent, depth in walk_tree(tree.get(children), children):
+        if with_path:
+            del path[depth:]
+        if matcher(node) and (with_children or not node.get(children)):
+            yield (node, list(path)) if with_path else node
+        if with_path:
+            path.append(node)
+
+
+def find_in_forest(forest, values, target_field, children, index=None, fields=None, predicate=None,
+                   with_path=False):
     """
     Поиск элемента в массиве деревьев
     :param forest: [<dict>, ...] - массив деревьев
-    :param values: искомые значения
+    :param values: искомые значения, None - без условия на target_field
     :param target_field: <str> поле по которому ищется значение
     :param children: <str> поле массив с подчиненными объектами
+    :param index: <TreeIndex> - индекс дерева, при наличии поиск выполняется без обхода
+    :param fields: {<str>: [<значение>, ...]} - дополнительные условия на поля
+    :param predicate: функция node -> bool, дополнительное условие
+    :param with_path: <bool> вместо узлов возвращать пары (узел, [предки узла начиная с корня])
     :return: [<tree_node>, ...]
     :return:
     """
-    result = list()
+    return list(iter_find(forest, values, target_field, children, index, fields, predicate, with_path))
 
-    for tree in forest:
-        if tree.get(target_field) in values:
-            result.append(tree)
-        else:
-            if tree.get(children):
-                result.extend(find_in_forest(forest=tree[children], values=values, target_field=target_field, children=children))
 
-    return result
+def iter_find(forest, values, target_field, children='children', index=None, fields=None, predicate=None,
+              with_path=False):
+    """
+    Ленивый вариант find_in_forest, потомки найденного элемента не просматриваются
+    :return: генератор <tree_node> / (<tree_node>, [<tree_node>, ...])
+    """
+    matcher = make_matcher(values, target_field, fields, predicate)
+
+    if index is not None and values is not None:
+        nodes = index.forest_lookup(_as_lookup(values), target_field, forest)
+        if nodes is not None:
+            # потомки найденных узлов пропускаются
+            found = set()
+            for node in nodes:
+                node_id = node[index.id_field]
+                if not _under_any(index, node_id, found) and matcher(node):
+                    yield (node, _index_path(index, node, forest)) if with_path else node
+                    found.add(node_id)
+            return
 
+    matched = False
 
-def checked_branches(tree, check_field='checked', children='children'):
+    def prune(node, parent, depth):
+        nonlocal matched
+        matched = matcher(node)
+        if matched:
+            return SKIP_CHILDREN
+
+    path = list()
+    for node, parent, depth in walk_tree(forest, children, prune=prune):
+        if with_path:
+            del path[depth:]
+        if matched:
+            yield (node, list(path)) if with_path else node
+        elif with_path:
+            path.append(node)
+
+
+def _index_path(index, node, forest):
+    """Предки узла из индекса, лежащие внутри массива деревьев forest"""
+    path = index.ancestors(node[index.id_field])
+    owner_id = index.parents[forest[0][index.id_field]]
+    if owner_id is None:
+        return path
+    return path[index.depths[owner_id] + 1:]
+
+
+def _under_any(index, node_id, ancestor_ids):
+    """Проверка, что один из предков узла входит в ancestor_ids"""
+    if not ancestor_ids:
+        return False
+    parent_id = index.parents[node_id]
+    while parent_id is not None:
+        if parent_id in ancestor_ids:
+            return True
+        parent_id = index.parents[parent_id]
+    return False
+
+
+def checked_branches(tree, check_field='checked', children='children', inplace=True):
     """
     Сохранения ветвей дерева, в которых выбран хотябы 1 элемент.
     :param tree: массив объектов
+    :param inplace: <bool> если False, то исходное дерево не изменяется: узлы с урезанными детьми копируются,
+    а неизмененные поддеревья попадают в результат без копирования
     :return: массив ветвей
     """
 
-    result = list()
-    for item in tree:
+    def prune(item, parent, depth):
         if item.get(check_field):
+            return SKIP_CHILDREN
+
+    result = list()
+    # сохраненные дети узлов, id(узел) -> [<node>, ...]
+    kept = dict()
+    for item, parent, depth in walk_tree(tree, children, POST_ORDER, prune):
+        if not item.get(check_field):
+            item_result = kept.pop(id(item), None)
+            if not item_result:
+                continue
+            if inplace:
+                item[children] = item_result
+            elif not _same_items(item_result, item[children]):
+                item = dict(item)
+                item[children] = item_result
+        if parent is None:
             result.append(item)
-        elif item.get(children):
-            _result = checked_branches(item[children], check_field, children)
-            if _result:
-                item[children] = _result
-                result.append(item)
+        else:
+            kept.setdefault(id(parent), list()).append(item)
     return result
 
 
-def merge_tree(tree, branches):
+def _same_items(left, right):
+    """Проверка, что массивы состоят из одних и тех же объектов"""
+    return len(left) == len(right) and all(a is b for a, b in zip(left, right))
+
+
+def merge_tree(tree, branches, inplace=True):
     """
     Слияние дерева - пустышки с выбранными ветвями этого же дерева
+    :param inplace: <bool> если False, то исходное дерево не изменяется, а возвращается новое,
+    в котором копируются только затронутые слиянием узлы
+    :return: дерево
     """
     mapped_tree = {v['value']: v for v in tree}
+    if inplace:
+        result = tree
+    else:
+        result = list(tree)
+        positions = {v['value']: i for i, v in enumerate(tree)}
 
     for branch in branches:
         if branch['value'] in mapped_tree:
             item = mapped_tree[branch['value']]
             if branch.get('checked'):
+                if not inplace:
+                    item = dict(item)
                 item['checked'] = True
                 if item.get('items'):
                     # рекурсивная простановка checked = True
-                    tree_value_setter(item['items'], 'checked', value=True)
-            else:
-                if branch.get('items') and item.get('items'):
-                    merge_tree(item['items'], branch['items'])
+                    items = tree_value_setter(item['items'], 'checked', value=True, inplace=inplace)
+                    if not inplace:
+                        item['items'] = items
+            elif branch.get('items') and item.get('items'):
+                items = merge_tree(item['items'], branch['items'], inplace=inplace)
+                if not inplace:
+                    item = dict(item)
+                    item['items'] = items
+            if not inplace:
+                mapped_tree[branch['value']] = result[positions[branch['value']]] = item
         else:
             raise Exception('There is no branch in original tree')
+    return result
 
 
-def tree_value_setter(tree, key_field='checked', value=None, children='items'):
+def tree_value_setter(tree, key_field='checked', value=None, children='items', inplace=True):
     """
     Обход дерева и простановка значения value в поле key_field
     :param tree: древовидная структура данных
     :param key_field: <str>
     :param value:
     :param children: <str>
+    :param inplace: <bool> если False, то исходное дерево не изменяется, а возвращается его копия
+    с проставленным значением
+    :return: дерево
     """
-    for item in tree:
-        item[key_field] = value
-        if item.get(children):
-            tree_value_setter(item[children], key_field=key_field, value=value, children=children)
+    if inplace:
+        for item, parent, depth in walk_tree(tree, children):
+            item[key_field] = value
+        return tree
+
+    result = list()
+    # копии узлов, имеющих детей, id(узел) -> копия
+    copies = dict()
+    for item, parent, depth in walk_tree(tree, children):
+        new_item = dict(item)
+        new_item[key_field] = value
+        if children in item:
+            new_item[children] = list()
+            copies[id(item)] = new_item
+        if parent is None:
+            result.append(new_item)
+        else:
+            copies[id(parent)][children].append(new_item)
+    return result
 
 
 def identify_tree_items(tree, level):
-    for item in tree:
-        item['id'] = str(level)+'_'+str(item.get('value'))
-        if item.get('items'):
-            identify_tree_items(item['items'], level+1)
+    for item, parent, depth in walk_tree(tree, 'items'):
+        item['id'] = str(level + depth)+'_'+str(item.get('value'))
 
 
-def value_collector(tree, target_field='id', children='children'):
+def value_collector(tree, target_field='id', children='children', index=None):
     """
     Функция обходит дерево и собирает значения из полей target_field в список
     :param tree: <dict>
     :param target_field: <str>
     :param children: <str>
+    :param index: <TreeIndex> - индекс дерева, при наличии значения берутся из интервала прямого обхода
     :return: [ <значение>, ...]
     """
-    result = list()
-    if tree.get(target_field) is not None:
-        result.append(tree[target_field])
+    return list(iter_values(tree, target_field, children, index))
 
-    if tree.get(children):
-        for node in tree[children]:
-            result.extend(value_collector(node, target_field, children))
 
-    return result
+def iter_values(tree, target_field='id', children='children', index=None):
+    """
+    Ленивый вариант value_collector, значения отдаются в порядке прямого обхода
+    :return: генератор <значение>
+    """
+    if index is not None and index.nodes.get(tree.get(index.id_field)) is tree:
+        nodes = index.subtree(tree[index.id_field])
+    else:
+        nodes = iter_nodes([tree], children)
+
+    for node in nodes:
+        value = node.get(target_field)
+        if value is not None:
+            yield value
 
 
 def tree_walker(tree, target_field=None, target_value=None, children='children',
-                func=None, func_args=None, func_result=None, action=None):
+                func=None, func_args=None, func_result=None, action=None, index=None):
     """
     :param tree: начальное дерево
     :param target_field: поле, в котором находится интересуещее нас значение
@@ -192,42 +509,70 @@ def tree_walker(tree, target_field=None, target_value=None, children='children',
     :param func: функция для выполнения действий над элементом
     :param func_args: дополнительные аргументы
     :param action: действия после функции (continue , break , None)
+    :param index: <TreeIndex> - индекс дерева, при наличии обходятся только подходящие элементы
     :return:
     """
     if func_result is None:
         func_result = list()
-    for item in tree:
+
+    if index is not None:
+        items = index.forest_lookup([target_value], target_field, tree)
+        if items is not None:
+            # элементы, поддеревья которых пропускаются
+            skipped = set()
+            for item in items:
+                item_id = item[index.id_field]
+                if _under_any(index, item_id, skipped):
+                    continue
+                func_result.append(func(item, index.siblings(item_id), func_args))
+                if action == 'break':
+                    # пропускаются потомки и оставшиеся соседи элемента: все, что дальше в поддереве родителя
+                    parent_id = index.parents[item_id]
+                    if parent_id is None:
+                        break
+                    skipped.add(parent_id)
+                elif action == 'continue':
+                    skipped.add(item_id)
+            return func_result
+
+    def prune(item, parent, depth):
         if item.get(target_field) == target_value:
-            func_result.append(func(item, tree, func_args))
+            func_result.append(func(item, tree if parent is None else parent[children], func_args))
             if action == 'break':
-                break
+                return SKIP_SIBLINGS
             elif action == 'continue':
-                continue
-        if item.get(children):
-            tree_walker(item[children], target_field, target_value, children, func, func_args, func_result, action)
+                return SKIP_CHILDREN
+
+    deque(walk_tree(tree, children, prune=prune), maxlen=0)
     return func_result
 
 
-def tree_to_list(tree, children='children',  del_epmty_children=False):
+def tree_to_list(tree, children='children',  del_epmty_children=False, inplace=True):
     """
     Перестраивает дерево в список объектов
     :param tree:
     :param del_epmty_children - если стоит true, то удаляет пустой ключ children
     :param children: имя ключа отвечающего за детей
+    :param inplace: <bool> если False, то исходное дерево не изменяется, а в результат попадают копии узлов без
+    поля children (узлы, из которых удалять нечего, не копируются)
     :return:
     """
-    result = []
-    for item in tree:
-        if item.get(children):
-            item_children = item.pop(children)
-            result.append(item)
-            if len(item_children) > 0:
-                result.extend(tree_to_list(item_children, children,  del_epmty_children))
-        else:
-            if del_epmty_children:
+    return list(iter_flatten(tree, children, del_epmty_children, inplace))
+
+
+def iter_flatten(tree, children='children', del_epmty_children=False, inplace=True):
+    """
+    Ленивый вариант tree_to_list. Поле children удаляется из узла непосредственно перед тем,
+    как узел будет отдан, поэтому обработанная часть дерева уже разобрана.
+    :return: генератор <tree_node>
+    """
+    for item, parent, depth in walk_tree(tree, children):
+        if item.get(children) or (del_epmty_children and children in item):
+            if inplace:
                 item.pop(children)
-            result.append(item)
-    return result
+            else:
+                item = {k: v for k, v in item.items() if k != children}
+        yield item
 
 
 def broken_tree_old(items, id_field='id', parent_id_field='parent_id', children_field='children'):
@@ -282,7 +627,11 @@ def broken_tree(elements, id_field='id', parent_id_field='parent_id', children_f
 
 def branches_lenght(tree, lenght_field, children_field='children', branch_lenght=0, result=None):
     """
-    Функция рекурсивно определяет длинну ветвей дерева, получая "длинну" из поля lenght_field
+    Функция определяет длинну ветвей дерева, получая "длинну" из поля lenght_field. Дерево - результат
+    broken_tree_old: узлы - объекты, дети - список OrderedDict([(id, объект)]). Дерево обходится один раз,
+    для разового расчета это быстрее, чем строить CompactTree. Если по одному дереву считается несколько
+    агрегатов, выгоднее один раз построить CompactTree.from_forest(..., children=..., getter=getattr)
+    и вызывать branches_length / path_aggregate / subtree_aggregate
     :param tree: [ ]
     :param lenght_field: <str>  из которого извлекается длинна
     :param children_field: <str>
@@ -292,14 +641,16 @@ def branches_lenght(tree, lenght_field, children_field='children', branch_lenght
     """
     if result is None:
         result = []
+
+    branch_children = _wrapped_children(children_field)
+    # длинны ветвей от корня до текущего узла, индекс - глубина
+    path = []
     try:
-        for key in tree:
-            branch = tree[key]
-            current_lenght = branch_lenght + getattr(branch, lenght_field)
-            children = getattr(branch, children_field, None)
-            if children:
-                for child in children:
-                    branches_lenght(child, lenght_field, children_field, current_lenght, result=result)
+        for branch, parent, depth in walk_tree([tree[key] for key in tree], branch_children):
+            del path[depth:]
+            current_lenght = (path[-1] if path else branch_lenght) + getattr(branch, lenght_field)
+            if getattr(branch, children_field, None):
+                path.append(current_lenght)
             else:
                 result.append(current_lenght)
     except TypeError:
@@ -307,10 +658,63 @@ def branches_lenght(tree, lenght_field, children_field='children', branch_lenght
     return result
 
 
+def _wrapped_children(children_field):
+    """Функция извлечения детей узла broken_tree_old: объекты из списка OrderedDict([(id, объект)])"""
+    def children(branch):
+        return [child[key] for child in getattr(branch, children_field, None) or () for key in child]
+    return children
+
+
 def gis_tree_constructor(source, parent=None, parent_field='parent_id', id_field='id', func=None, func_args=None,
                          children='children', del_epmty_children=False):
     """
     Функция кастомизирована для отображения гис элементов в дереве.
+    Строит дерево из массива объектов SQLAlchemy, конвертируя объект в массив. У объектов должен быть метод row2dict.
+    Объекты раскладываются по идентификатору родителя за один проход по source, после чего дерево собирается
+    прямым обходом с явным стеком, поэтому время построения линейно от количества объектов.
+    :param del_epmty_children - если стоит true, то удаляет пустой ключ children
+    :param func: функция, которая принимает первым аргуметом dict_item, а остальными func_args
+    :param func_args: дополнительные аргументы функции
+    :param source: массив объектов
+    :param parent: id родительского элемента
+    :param parent_field: имя поля, указывающее на идентификатор родителя
+    :param id_field: имя поля содержащее  идентификатор объекта
+    :return: Массив
+    """
+    buckets = dict()
+    for item in source:
+        buckets.setdefault(getattr(item, parent_field), list()).append(item)
+
+    result = []
+    # прямой обход, чтобы func вызывалась в том же порядке, что и в рекурсивной версии
+    stack = [(iter(buckets.get(parent, ())), result)]
+    while stack:
+        items, level = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            continue
+        dict_item = item.row2dict(add_prop=['factors_count'])
+        dict_item['text'] = item.text
+        dict_item['tag'] = item.tag
+        if func is not None:
+            func(dict_item, func_args)
+        item_children = buckets.get(dict_item[id_field])
+        if item_children:
+            dict_item[children] = list()
+            stack.append((iter(item_children), dict_item[children]))
+        elif del_epmty_children:
+            dict_item.pop(children, None)
+        else:
+            dict_item[children] = list()
+        level.append(dict_item)
+    return result
+
+
+def gis_tree_constructor_old(source, parent=None, parent_field='parent_id', id_field='id', func=None, func_args=None,
+                             children='children', del_epmty_children=False):
+    """
+    Функция кастомизирована для отображения гис элементов в дереве.
     Строит дерево из массива объектов SQLAlchemy, конвертируя объект в массив. У объектов должен быть метод row2dict
     :param del_epmty_children - если стоит true, то удаляет пустой ключ children
     :param func: функция, которая принимает первым аргуметом dict_item, а остальными func_args
@@ -329,19 +733,1113 @@ def gis_tree_constructor(source, parent=None, parent_field='parent_id', id_field
             dict_item['tag'] = item.tag
             if func is not None:
                 func(dict_item, func_args)
-            dict_item.update({children: gis_tree_constructor(source=source,
-                                                             parent=dict_item[id_field],
-                                                             parent_field=parent_field,
-                                                             id_field=id_field,
-                                                             func=func,
-                                                             func_args=func_args,
-                                                             children=children,
-                                                             del_epmty_children=del_epmty_children)})
+            dict_item.update({children: gis_tree_constructor_old(source=source,
+                                                                 parent=dict_item[id_field],
+                                                                 parent_field=parent_field,
+                                                                 id_field=id_field,
+                                                                 func=func,
+                                                                 func_args=func_args,
+                                                                 children=children,
+                                                                 del_epmty_children=del_epmty_children)})
             if del_epmty_children and len(dict_item[children]) == 0:
                 dict_item.pop(children)
             result.append(dict_item)
     return result
 
+
+class TreeIndex:
+    """
+    Индекс дерева, построенного tree_constructor или broken_tree. Строится один раз за O(n) и хранит
+    id -> узел, id -> id родителя, глубину узла и интервалы прямого обхода [tin, tout].
+    Поиск по id - O(1), предки и потомки - O(размер ответа), проверка "X находится под Y" - O(1).
+    Идентификаторы узлов должны быть уникальны в пределах всего леса.
+    Индекс можно изменять через add / remove / move / update: связи с родителями, глубины, производные поля
+    и агрегаты поддерживаются инкрементально, а интервалы прямого обхода перестраиваются лениво.
+    Пока интервалы не перестроены, lookup без start/stop, subtree_lookup и forest_lookup (на них построены
+    find_tree_node, find_tree_nodes, find_in_forest, tree_walker с index) отвечают по nodes / field_map и
+    ссылкам на родителей: найденные узлы упорядочиваются обходом только вдоль путей от корня к ним.
+    Позиционные order, tin, tout, subtree_bounds, forest_bounds и lookup с start/stop перестраивают
+    интервалы за O(n) при первом обращении после изменения.
+    """
+
+    def __init__(self, forest, id_field='id', children='children', parent_field=None):
+        """
+        :param forest: [<dict>, ...] - массив деревьев
+        :param id_field: <str> поле идентификатор объекта
+        :param children: <str> поле массив с подчиненными объектами
+        :param parent_field: <str> поле с идентификатором родителя, обновляется при add / move
+        """
+        self.forest = forest
+        self.id_field = id_field
+        self.children = children
+        self.parent_field = parent_field
+        self.nodes = dict()
+        self.parents = dict()
+        self.depths = dict()
+        self._tin = dict()
+        self._tout = dict()
+        self._order = list()
+        self._order_valid = False
+        self._field_maps = dict()
+        self._derived = list()
+        self._aggregates = list()
+        self._build()
+
+    def _build(self):
+        """Прямой обход леса"""
+        for node, parent, depth in walk_tree(self.forest, self.children):
+            node_id = node.get(self.id_field)
+            if node_id in self.nodes:
+                raise ValueError('Duplicate node id {!r}'.format(node_id))
+            self.nodes[node_id] = node
+            self.parents[node_id] = None if parent is None else parent[self.id_field]
+            self.depths[node_id] = depth
+        self._build_order()
+
+    def _build_order(self):
+        """Интервалы прямого обхода"""
+        self._order = [node for node, parent, depth in walk_tree(self.forest, self.children)]
+        self._tin = {node[self.id_field]: position for position, node in enumerate(self._order)}
+        self._tout = dict()
+        # потомки идут в прямом обходе после родителя, поэтому tout считается обратным проходом
+        for position in range(len(self._order) - 1, -1, -1):
+            node_id = self._order[position][self.id_field]
+            tout = self._tout.setdefault(node_id, position)
+            parent_id = self.parents[node_id]
+            if parent_id is not None and self._tout.get(parent_id, -1) < tout:
+                self._tout[parent_id] = tout
+        self._order_valid = True
+
+    @property
+    def order(self):
+        """Узлы в порядке прямого обхода"""
+        if not self._order_valid:
+            self._build_order()
+        return self._order
+
+    @property
+    def tin(self):
+        """id -> позиция узла в прямом обходе"""
+        if not self._order_valid:
+            self._build_order()
+        return self._tin
+
+    @property
+    def tout(self):
+        """id -> позиция последнего потомка узла в прямом обходе"""
+        if not self._order_valid:
+            self._build_order()
+        return self._tout
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node_id):
+        return node_id in self.nodes
+
+    def __getitem__(self, node_id):
+        return self.nodes[node_id]
+
+    def get(self, node_id, default=None):
+        """
+        Получение узла по идентификатору
+        :param node_id: идентификатор узла
+        :param default: значение, если узла нет
+        :return: <tree_node>
+        """
+        return self.nodes.get(node_id, default)
+
+    def parent(self, node_id):
+        """
+        Родитель узла
+        :return: <tree_node> / None
+        """
+        parent_id = self.parents[node_id]
+        return None if parent_id is None else self.nodes[parent_id]
+
+    def siblings(self, node_id):
+        """
+        Массив, в котором лежит узел (дети его родителя или корни леса)
+        :return: [<tree_node>, ...]
+        """
+        parent_id = self.parents[node_id]
+        if parent_id is None:
+            return self.forest
+        return self.nodes[parent_id][self.children]
+
+    def depth(self, node_id):
+        """Глубина узла, у корней 0"""
+        return self.depths[node_id]
+
+    def ancestors(self, node_id):
+        """
+        Предки узла, начиная с корня
+        :return: [<tree_node>, ...]
+        """
+        result = list()
+        parent_id = self.parents[node_id]
+        while parent_id is not None:
+            result.append(self.nodes[parent_id])
+            parent_id = self.parents[parent_id]
+        result.reverse()
+        return result
+
+    def descendants(self, node_id):
+        """
+        Все потомки узла в порядке прямого обхода
+        :return: [<tree_node>, ...]
+        """
+        return self.subtree(node_id)[1:]
+
+    def subtree(self, node_id):
+        """
+        Узел вместе со всеми потомками в порядке прямого обхода
+        :return: [<tree_node>, ...]
+        """
+        if not self._order_valid:
+            return list(iter_nodes([self.nodes[node_id]], self.children))
+        return self._order[self._tin[node_id]:self._tout[node_id] + 1]
+
+    def is_descendant(self, node_id, ancestor_id):
+        """
+        Проверяет, что узел node_id находится в поддереве ancestor_id (сам узел потомком не считается)
+        :return: <bool>
+        """
+        if node_id not in self.nodes or ancestor_id not in self.nodes:
+            return False
+        if not self._order_valid:
+            return self._is_under(node_id, ancestor_id)
+        return self._tin[ancestor_id] < self._tin[node_id] <= self._tout[ancestor_id]
+
+    def field_map(self, field):
+        """
+        Отображение значение поля -> [<tree_node>, ...]. Строится лениво и кешируется, изменения через
+        add / remove / update в нем учитываются, а при изменении узлов в обход индекса его нужно перестроить.
+        :param field: <str>
+        :return: {<значение>: [<tree_node>, ...]}
+        """
+        if field == self.id_field:
+            return {node_id: [node] for node_id, node in self.nodes.items()}
+        result = self._field_maps.get(field)
+        if result is None:
+            result = dict()
+            for node in iter_nodes(self.forest, self.children):
+                try:
+                    result.setdefault(node.get(field), list()).append(node)
+                except TypeError:
+                    # нехешируемые значения в индекс не попадают
+                    continue
+            self._field_maps[field] = result
+        return result
+
+    def lookup(self, values, field, start=0, stop=None):
+        """
+        Узлы, у которых значение поля field входит в values, в порядке прямого обхода
+        :param values: искомые значения
+        :param field: <str> поле, по которому ищется значение
+        :param start: <int> начало интервала прямого обхода
+        :param stop: <int> конец интервала прямого обхода (включительно)
+        :return: [<tree_node>, ...]
+        """
+        if not self._order_valid and start == 0 and stop is None:
+            return self._preorder(self._matches(values, field), self.forest)
+        if stop is None:
+            stop = len(self.order) - 1
+
+        positions = set()
+        if field == self.id_field:
+            for value in values:
+                try:
+                    position = self.tin.get(value)
+                except TypeError:
+                    continue
+                if position is not None and start <= position <= stop:
+                    positions.add(position)
+        else:
+            mapped = self.field_map(field)
+            for value in values:
+                try:
+                    nodes = mapped.get(value, ())
+                except TypeError:
+                    continue
+                for node in nodes:
+                    position = self.tin[node[self.id_field]]
+                    if start <= position <= stop:
+                        positions.add(position)
+        return [self.order[position] for position in sorted(positions)]
+
+    def subtree_lookup(self, values, field, tree):
+        """
+        Как lookup, но только среди потомков tree. tree - узел индекса или словарь-обертка, у которого в поле
+        children лежит лес индекса или дети одного из узлов
+        :param values: искомые значения
+        :param field: <str> поле, по которому ищется значение
+        :param tree: <dict>
+        :return: [<tree_node>, ...] / None, если дерево не покрыто индексом
+        """
+        tree_id = tree.get(self.id_field)
+        try:
+            indexed = self.nodes.get(tree_id) is tree
+        except TypeError:
+            indexed = False
+        if not indexed:
+            return self.forest_lookup(values, field, tree.get(self.children))
+        if self._order_valid:
+            return self.lookup(values, field, self._tin[tree_id] + 1, self._tout[tree_id])
+        nodes = [node for node in self._matches(values, field) if self._is_under(node[self.id_field], tree_id)]
+        return self._preorder(nodes, tree.get(self.children) or ())
+
+    def forest_lookup(self, values, field, forest):
+        """
+        Как lookup, но только среди узлов массива деревьев forest (лес индекса или дети одного из узлов)
+        :param values: искомые значения
+        :param field: <str> поле, по которому ищется значение
+        :param forest: [<dict>, ...]
+        :return: [<tree_node>, ...] / None, если массив не покрыт индексом
+        """
+        covered, owner_id = self._forest_owner(forest)
+        if not covered:
+            return None
+        if self._order_valid:
+            return self.lookup(values, field, *self.forest_bounds(forest))
+        nodes = self._matches(values, field)
+        if owner_id is not None:
+            nodes = [node for node in nodes if self._is_under(node[self.id_field], owner_id)]
+        return self._preorder(nodes, forest)
+
+    def subtree_bounds(self, tree):
+        """
+        Интервал прямого обхода, занимаемый потомками tree. tree - узел индекса или словарь-обертка,
+        у которого в поле children лежит весь проиндексированный лес.
+        :param tree: <dict>
+        :return: (<int>, <int>) / None, если дерево не покрыто индексом
+        """
+        tree_id = tree.get(self.id_field)
+        try:
+            indexed = self.nodes.get(tree_id) is tree
+        except TypeError:
+            indexed = False
+        if indexed:
+            return self.tin[tree_id] + 1, self.tout[tree_id]
+        return self.forest_bounds(tree.get(self.children))
+
+    def forest_bounds(self, forest):
+        """
+        Интервал прямого обхода, занимаемый массивом деревьев. Массив должен быть лесом индекса
+        или списком детей одного из узлов.
+        :param forest: [<dict>, ...]
+        :return: (<int>, <int>) / None, если массив не покрыт индексом
+        """
+        if forest is self.forest:
+            return 0, len(self.order) - 1
+        covered, owner_id = self._forest_owner(forest)
+        if not covered:
+            return None
+        return self.tin[forest[0][self.id_field]], self.tout[forest[-1][self.id_field]]
+
+    def _forest_owner(self, forest):
+        """
+        Узел, детьми которого является массив деревьев
+        :return: (True, <id> / None для леса индекса) или (False, None), если массив не покрыт индексом
+        """
+        if forest is self.forest:
+            return True, None
+        if not forest:
+            return False, None
+        first_id = forest[0].get(self.id_field)
+        try:
+            indexed = self.nodes.get(first_id) is forest[0]
+        except TypeError:
+            indexed = False
+        if not indexed or self.siblings(first_id) is not forest:
+            return False, None
+        return True, self.parents[first_id]
+
+    def add(self, node, parent_id=None):
+        """
+        Добавление узла вместе с его поддеревом последним ребенком parent_id (или последним корнем леса).
+        Производные поля и агрегаты пересчитываются для нового поддерева и его предков.
+        :param node: <dict>
+        :param parent_id: идентификатор родителя, None - корень
+        :return: node
+        """
+        parent = None if parent_id is None else self.nodes[parent_id]
+        new_nodes = list(walk_tree([node], self.children))
+        for new_node, new_parent, depth in new_nodes:
+            if new_node.get(self.id_field) in self.nodes:
+                raise ValueError('Duplicate node id {!r}'.format(new_node.get(self.id_field)))
+
+        affected = self._mapped_path(parent_id)
+        for mapped_node in affected:
+            self._map_discard(mapped_node)
+        if parent is None:
+            self.forest.append(node)
+        else:
+            if not parent.get(self.children):
+                parent[self.children] = list()
+            parent[self.children].append(node)
+
+        base_depth = 0 if parent_id is None else self.depths[parent_id] + 1
+        for new_node, new_parent, depth in new_nodes:
+            node_id = new_node[self.id_field]
+            self.nodes[node_id] = new_node
+            self.parents[node_id] = parent_id if new_parent is None else new_parent[self.id_field]
+            self.depths[node_id] = base_depth + depth
+            if self.parent_field is not None:
+                new_node[self.parent_field] = self.parents[node_id]
+
+        self._apply_derived(node)
+        self._apply_aggregates([node])
+        self._propagate(parent_id, node, 1)
+        for new_node, new_parent, depth in new_nodes:
+            self._map_add(new_node)
+        for mapped_node in affected:
+            self._map_add(mapped_node)
+        self._changed()
+        return node
+
+    def remove(self, node_id):
+        """
+        Удаление узла вместе с поддеревом. Агрегаты предков уменьшаются на значения удаленного поддерева.
+        :param node_id: идентификатор узла
+        :return: удаленный узел
+        """
+        node = self.nodes[node_id]
+        parent_id = self.parents[node_id]
+        affected = self._mapped_path(parent_id)
+        for mapped_node in affected:
+            self._map_discard(mapped_node)
+        self._propagate(parent_id, node, -1)
+        self._detach(node_id)
+        for old_node, old_parent, depth in walk_tree([node], self.children):
+            old_id = old_node[self.id_field]
+            self._map_discard(old_node)
+            del self.nodes[old_id]
+            del self.parents[old_id]
+            del self.depths[old_id]
+        for mapped_node in affected:
+            self._map_add(mapped_node)
+        self._changed()
+        return node
+
+    def move(self, node_id, parent_id=None):
+        """
+        Перенос узла вместе с поддеревом последним ребенком parent_id (или последним корнем леса)
+        :param node_id: идентификатор узла
+        :param parent_id: идентификатор нового родителя, None - корень
+        :return: узел
+        """
+        node = self.nodes[node_id]
+        if parent_id is not None:
+            if parent_id == node_id or self._is_under(parent_id, node_id):
+                raise ValueError('Node {!r} can not be moved into its own subtree'.format(node_id))
+            parent = self.nodes[parent_id]
+        else:
+            parent = None
+
+        # parent_field узла и агрегаты старых и новых предков меняются
+        affected = self._mapped_path(node_id, parent_id)
+        for mapped_node in affected:
+            self._map_discard(mapped_node)
+        self._propagate(self.parents[node_id], node, -1)
+        self._detach(node_id)
+        if parent is None:
+            self.forest.append(node)
+        else:
+            if not parent.get(self.children):
+                parent[self.children] = list()
+            parent[self.children].append(node)
+        if self.parent_field is not None:
+            node[self.parent_field] = parent_id
+        self.parents[node_id] = parent_id
+
+        shift = (0 if parent_id is None else self.depths[parent_id] + 1) - self.depths[node_id]
+        if shift:
+            for moved, moved_parent, depth in walk_tree([node], self.children):
+                self.depths[moved[self.id_field]] += shift
+        self._apply_derived(node)
+        self._propagate(parent_id, node, 1)
+        for mapped_node in affected:
+            self._map_add(mapped_node)
+        self._changed()
+        return node
+
+    def update(self, node_id, fields):
+        """
+        Изменение полей узла. Идентификатор менять нельзя, изменение parent_field выполняется как move.
+        Агрегаты предков меняются на разницу значений, то есть за O(глубина).
+        :param node_id: идентификатор узла
+        :param fields: <dict> новые значения полей
+        :return: узел
+        """
+        node = self.nodes[node_id]
+        if self.id_field in fields and fields[self.id_field] != node_id:
+            raise ValueError('Node id can not be changed, remove and add the node instead')
+        if self.parent_field is not None and self.parent_field in fields \
+                and fields[self.parent_field] != self.parents[node_id]:
+            self.move(node_id, fields[self.parent_field])
+
+        old_values = [(target, _aggregate_value(node, field, how)) for target, field, how in self._aggregates
+                      if field in fields]
+        affected = self._mapped_path(node_id) if old_values else [node]
+        for mapped_node in affected:
+            self._map_discard(mapped_node)
+        node.update(fields)
+
+        if any(inherited for field, func, inherited in self._derived):
+            self._apply_derived(node)
+        else:
+            self._apply_derived(node, subtree=False)
+
+        ancestors = None
+        for target, old_value in old_values:
+            field, how = next((f, h) for t, f, h in self._aggregates if t == target)
+            delta = _aggregate_value(node, field, how) - old_value
+            if not delta:
+                continue
+            node[target] += delta
+            if ancestors is None:
+                ancestors = self.ancestors(node_id)
+            for ancestor in ancestors:
+                ancestor[target] += delta
+        for mapped_node in affected:
+            self._map_add(mapped_node)
+        self._changed()
+        return node
+
+    def add_derived(self, field, func, inherited=False):
+        """
+        Регистрирует производное поле node[field] = func(node, parent, depth), которое пересчитывается при изменениях
+        через add / move / update. Например, ключи в стиле identify_tree_items:
+        index.add_derived('key', lambda node, parent, depth: '%s_%s' % (level + depth, node.get('value'))).
+        Поле id_field производным быть не может.
+        :param field: <str>
+        :param func: функция (узел, родитель / None, глубина)
+        :param inherited: <bool> значение зависит от родителя (например, checked наследуется от выбранного родителя),
+        поэтому при изменении узла пересчитывается все его поддерево
+        """
+        if field == self.id_field:
+            raise ValueError('Derived field can not replace node id {!r}'.format(field))
+        self._derived.append((field, func, inherited))
+        for node, parent, depth in walk_tree(self.forest, self.children):
+            node[field] = func(node, parent, depth)
+        self._field_maps.pop(field, None)
+
+    def add_aggregate(self, target_field, field=None, how='sum'):
+        """
+        Регистрирует агрегат по поддереву node[target_field], который поддерживается при изменениях за O(глубина).
+        :param target_field: <str> поле, в которое записывается агрегат
+        :param field: <str> поле со значением, для 'count' None - считаются все узлы
+        :param how: <str> 'sum' / 'count' (min и max нельзя поддерживать инкрементально)
+        """
+        if how not in ('sum', 'count'):
+            raise ValueError('Only sum and count aggregates can be maintained incrementally')
+        self._aggregates.append((target_field, field, how))
+        self._apply_aggregates(self.forest, [(target_field, field, how)])
+
+    def _apply_derived(self, node, subtree=True):
+        """Пересчет производных полей узла (и его поддерева)"""
+        if not self._derived:
+            return
+        node_id = node[self.id_field]
+        base_parent = self.parent(node_id)
+        base_depth = self.depths[node_id]
+        nodes = walk_tree([node], self.children) if subtree else [(node, None, 0)]
+        for current, parent, depth in nodes:
+            if parent is None:
+                parent = base_parent
+            for field, func, inherited in self._derived:
+                current[field] = func(current, parent, base_depth + depth)
+        for field, func, inherited in self._derived:
+            self._field_maps.pop(field, None)
+
+    def _apply_aggregates(self, forest, aggregates=None):
+        """Расчет агрегатов поддеревьев обратным обходом"""
+        if aggregates is None:
+            aggregates = self._aggregates
+        for node, parent, depth in walk_tree(forest, self.children, POST_ORDER):
+            node_children = node.get(self.children) or ()
+            for target, field, how in aggregates:
+                total = _aggregate_value(node, field, how)
+                for child in node_children:
+                    total += child[target]
+                node[target] = total
+        for target, field, how in aggregates:
+            self._field_maps.pop(target, None)
+
+    def _propagate(self, parent_id, node, sign):
+        """Добавление (sign=1) или вычитание (sign=-1) агрегатов поддерева node у предков начиная с parent_id"""
+        if not self._aggregates:
+            return
+        deltas = [(target, sign * node[target]) for target, field, how in self._aggregates]
+        while parent_id is not None:
+            ancestor = self.nodes[parent_id]
+            for target, delta in deltas:
+                ancestor[target] += delta
+            parent_id = self.parents[parent_id]
+
+    def _detach(self, node_id):
+        """Удаление узла из массива соседей"""
+        node = self.nodes[node_id]
+        siblings = self.siblings(node_id)
+        for position, sibling in enumerate(siblings):
+            if sibling is node:
+                del siblings[position]
+                break
+
+    def _is_under(self, node_id, ancestor_id):
+        """Проверка "node_id находится под ancestor_id" подъемом по родителям, без интервалов обхода"""
+        parent_id = self.parents[node_id]
+        while parent_id is not None:
+            if parent_id == ancestor_id:
+                return True
+            parent_id = self.parents[parent_id]
+        return False
+
+    def _matches(self, values, field):
+        """Узлы, у которых значение поля field входит в values, по nodes / field_map, без порядка"""
+        result = list()
+        if field == self.id_field:
+            for value in values:
+                try:
+                    node = self.nodes.get(value)
+                except TypeError:
+                    continue
+                if node is not None:
+                    result.append(node)
+        else:
+            mapped = self.field_map(field)
+            for value in values:
+                try:
+                    result.extend(mapped.get(value, ()))
+                except TypeError:
+                    continue
+        return result
+
+    def _preorder(self, nodes, forest):
+        """
+        Узлы без повторов в порядке прямого обхода forest. Обходятся только дети узлов, лежащих на путях
+        от корня к nodes, поэтому интервалы прямого обхода не нужны
+        :param nodes: [<tree_node>, ...] узлы из forest и его поддеревьев
+        :param forest: [<dict>, ...]
+        :return: [<tree_node>, ...]
+        """
+        wanted = {id(node) for node in nodes}
+        if len(wanted) < 2:
+            return nodes[:1]
+        on_path = set()
+        for node in nodes:
+            parent_id = self.parents[node[self.id_field]]
+            while parent_id is not None and parent_id not in on_path:
+                on_path.add(parent_id)
+                parent_id = self.parents[parent_id]
+
+        def prune(node, parent, depth):
+            if node.get(self.id_field) not in on_path:
+                return SKIP_CHILDREN
+
+        result = list()
+        for node, parent, depth in walk_tree(forest, self.children, prune=prune):
+            if id(node) in wanted:
+                result.append(node)
+                if len(result) == len(wanted):
+                    break
+        return result
+
+    def _mapped_path(self, *node_ids):
+        """
+        Узлы node_ids вместе с предками без повторов: у них меняются parent_field и агрегаты, поэтому перед
+        изменением они убираются из кешированных field_map, а после - добавляются обратно
+        :return: [<tree_node>, ...], пустой, если field_map не строились
+        """
+        if not self._field_maps:
+            return []
+        result = OrderedDict()
+        for node_id in node_ids:
+            while node_id is not None and node_id not in result:
+                result[node_id] = self.nodes[node_id]
+                node_id = self.parents[node_id]
+        return list(result.values())
+
+    def _map_add(self, node):
+        for field, mapped in self._field_maps.items():
+            try:
+                mapped.setdefault(node.get(field), list()).append(node)
+            except TypeError:
+                continue
+
+    def _map_discard(self, node):
+        for field, mapped in self._field_maps.items():
+            try:
+                nodes = mapped.get(node.get(field), ())
+            except TypeError:
+                continue
+            for position, mapped_node in enumerate(nodes):
+                if mapped_node is node:
+                    del nodes[position]
+                    break
+
+    def _changed(self):
+        """Интервалы прямого обхода перестраиваются лениво при следующем обращении"""
+        self._order_valid = False
+
+
+def _aggregate_value(node, field, how):
+    """Вклад узла в агрегат по поддереву"""
+    if how == 'count':
+        return 1 if field is None or node.get(field) is not None else 0
+    value = node.get(field)
+    return 0 if value is None else value
+
+
+class JsonTreeStream:
+    """
+    Потоковый вариант tree_constructor для больших иерархий. Источник (запрос SQLAlchemy или любой итератор объектов
+    с методом row2dict) читается один раз, при наличии у него yield_per - порциями с серверного курсора.
+    Для каждого узла хранится только JSON строка его полей и ссылки на первого ребенка и следующего соседа,
+    сами объекты и словари после кодирования не удерживаются. Дерево отдается в виде JSON по частям.
+    Элементы, ссылающиеся на несуществующего родителя, становятся корнями, как в broken_tree.
+    """
+
+    def __init__(self, source, parent_field='parent_id', id_field='id', func=None, func_args=None,
+                 children='children', batch_size=1000, default=str):
+        """
+        :param source: запрос SQLAlchemy / итератор объектов
+        :param parent_field: имя поля, указывающее на идентификатор родителя
+        :param id_field: имя поля содержащее  идентификатор объекта
+        :param func: функция, которая принимает первым аргуметом dict_item, а остальными func_args
+        :param func_args: дополнительные аргументы функции
+        :param children: <str> имя ключа с детьми в результирующем JSON
+        :param batch_size: <int> размер порции для yield_per
+        :param default: функция сериализации значений, которые не поддерживает json (UUID, Decimal, ...)
+        """
+        if hasattr(source, 'yield_per'):
+            source = source.yield_per(batch_size)
+        self.children = children
+        self._children_key = json.dumps(children)
+        self._encoded = list()
+        encoder = json.JSONEncoder(ensure_ascii=False, default=default)
+
+        positions = dict()
+        parent_ids = list()
+        for item in source:
+            dict_item = item.row2dict()
+            if func is not None:
+                func(dict_item, func_args)
+            dict_item.pop(children, None)
+            positions[dict_item[id_field]] = len(self._encoded)
+            parent_ids.append(dict_item.get(parent_field))
+            self._encoded.append(encoder.encode(dict_item))
+
+        size = len(self._encoded)
+        self._first_child = array('i', [-1]) * size
+        self._next_sibling = array('i', [-1]) * size
+        last_child = array('i', [-1]) * size
+        self._first_root = -1
+        last_root = -1
+        for position, parent_id in enumerate(parent_ids):
+            parent = positions.get(parent_id)
+            if parent is None:
+                if last_root == -1:
+                    self._first_root = position
+                else:
+                    self._next_sibling[last_root] = position
+                last_root = position
+            else:
+                if last_child[parent] == -1:
+                    self._first_child[parent] = position
+                else:
+                    self._next_sibling[last_child[parent]] = position
+                last_child[parent] = position
+
+    def __len__(self):
+        return len(self._encoded)
+
+    def iter_json(self, chunk_size=64 * 1024, encoding=None):
+        """
+        Отдает дерево в виде JSON массива частями примерно по chunk_size символов
+        :param chunk_size: <int>
+        :param encoding: <str> если указана, то части отдаются в виде bytes
+        :return: генератор <str> / <bytes>
+        """
+        buf = ['[']
+        buf_size = 1
+        stack = list()
+        current = self._first_root
+        while True:
+            if current == -1:
+                if not stack:
+                    buf.append(']')
+                    break
+                current = self._next_sibling[stack.pop()]
+                piece = ']}' if current == -1 else ']}, '
+            else:
+                encoded = self._encoded[current]
+                if self._first_child[current] == -1:
+                    current = self._next_sibling[current]
+                    piece = encoded if current == -1 else encoded + ', '
+                else:
+                    stack.append(current)
+                    separator = ', ' if len(encoded) > 2 else ''
+                    piece = encoded[:-1] + separator + self._children_key + ': ['
+                    current = self._first_child[current]
+            buf.append(piece)
+            buf_size += len(piece)
+            if buf_size >= chunk_size:
+                chunk = ''.join(buf)
+                yield chunk if encoding is None else chunk.encode(encoding)
+                buf = list()
+                buf_size = 0
+        chunk = ''.join(buf)
+        yield chunk if encoding is None else chunk.encode(encoding)
+
+    def dump(self, fp, chunk_size=64 * 1024, encoding=None):
+        """
+        Запись дерева в файл или сокет
+        :param fp: путь к файлу или объект с методом write (для бинарных потоков нужно указать encoding)
+        :param chunk_size: <int>
+        :param encoding: <str>
+        """
+        if isinstance(fp, str):
+            with open(fp, 'w', encoding='utf-8') as f:
+                self.dump(f, chunk_size)
+            return
+        for chunk in self.iter_json(chunk_size, encoding):
+            fp.write(chunk)
+
+
+class CompactTree:
+    """
+    Компактное представление леса для очень больших иерархий. Узлы хранятся в порядке прямого обхода,
+    структура - в массивах array('i'): индекс родителя, первого ребенка, следующего соседа, глубина и размер
+    поддерева (поддерево узла i занимает позиции [i, i + size[i])). Поля узлов хранятся по столбцам.
+    На узел приходится 20 байт структуры плюс по одной ссылке на каждое поле вместо отдельного dict и list.
+    """
+
+    def __init__(self, parent, columns, children='children'):
+        """
+        :param parent: [<int>, ...] - индексы родителей в порядке прямого обхода, -1 у корней
+        :param columns: {<str>: [<значение>, ...]} - столбцы полей узлов
+        :param children: <str> поле массив с подчиненными объектами при конвертации в словари
+        """
+        size = len(parent)
+        self.children = children
+        self.columns = columns
+        self.parent = array('i', parent)
+        self.depth = array('i', [0]) * size
+        self.size = array('i', [1]) * size
+        self.first_child = array('i', [-1]) * size
+        self.next_sibling = array('i', [-1]) * size
+        self._maps = dict()
+
+        for position in range(size):
+            parent_position = self.parent[position]
+            if parent_position != -1:
+                self.depth[position] = self.depth[parent_position] + 1
+        for position in range(size - 1, -1, -1):
+            parent_position = self.parent[position]
+            if parent_position != -1:
+                self.size[parent_position] += self.size[position]
+        for position in range(size):
+            if self.size[position] > 1:
+                self.first_child[position] = position + 1
+            parent_position = self.parent[position]
+            end = size if parent_position == -1 else parent_position + self.size[parent_position]
+            if position + self.size[position] < end:
+                self.next_sibling[position] = position + self.size[position]
+
+    @classmethod
+    def from_forest(cls, forest, children='children', columns=None, typecodes=None, getter=None):
+        """
+        Конвертация массива деревьев из словарей (результат tree_constructor, broken_tree) или других объектов
+        (например, узлов broken_tree_old: children - функция, getter - getattr)
+        :param forest: [<dict>, ...]
+        :param children: <str> поле массив с подчиненными объектами или функция node -> [<node>, ...]
+        :param columns: [<str>, ...] сохраняемые поля (повторы игнорируются), по умолчанию все поля узлов.
+        Обязательны, если указан getter
+        :param typecodes: {<str>: <str>} - поля, которые хранятся в array с указанным типом (например 'd', 'i').
+        У таких полей значение должно быть у каждого узла.
+        :param getter: функция (узел, поле) -> значение, по умолчанию node.get(поле)
+        :return: <CompactTree>
+        """
+        if columns is None:
+            if getter is not None:
+                raise ValueError('columns are required when getter is given')
+            names = dict()
+            for node in iter_nodes(forest, children):
+                names.update(dict.fromkeys(node))
+            names.pop(children, None)
+            columns = list(names)
+        else:
+            columns = list(OrderedDict.fromkeys(columns))
+        typecodes = typecodes or dict()
+        data = {name: array(typecodes[name]) if name in typecodes else list() for name in columns}
+        appenders = [(name, data[name].append) for name in columns]
+
+        parent = list()
+        # позиции узлов текущего пути, индекс - глубина
+        path = list()
+        for node, node_parent, depth in walk_tree(forest, children):
+            del path[depth:]
+            parent.append(path[-1] if path else -1)
+            path.append(len(parent) - 1)
+            if getter is None:
+                for name, append in appenders:
+                    append(node.get(name))
+            else:
+                for name, append in appenders:
+                    append(getter(node, name))
+        return cls(parent, data, children if isinstance(children, str) else 'children')
+
+    def to_forest(self, position=None):
+        """
+        Конвертация в массив деревьев из словарей. Поле children добавляется только узлам, у которых есть дети.
+        :param position: <int> корень выгружаемого поддерева, по умолчанию весь лес
+        :return: [<dict>, ...]
+        """
+        start, stop = self._bounds(position)
+        names = list(self.columns)
+        values = [self.columns[name] for name in names]
+        result = list()
+        nodes = dict()
+        for i in range(start, stop):
+            node = {name: column[i] for name, column in zip(names, values)}
+            nodes[i] = node
+            parent_position = self.parent[i]
+            if i == start or parent_position not in nodes:
+                result.append(node)
+            else:
+                nodes[parent_position].setdefault(self.children, list()).append(node)
+            if self.first_child[i] == -1:
+                # листья больше не понадобятся как родители
+                del nodes[i]
+        return result
+
+    def __len__(self):
+        return len(self.parent)
+
+    def node(self, position):
+        """
+        Поля узла без детей
+        :param position: <int>
+        :return: <dict>
+        """
+        return {name: column[position] for name, column in self.columns.items()}
+
+    def iter_children(self, position):
+        """Позиции детей узла"""
+        child = self.first_child[position]
+        while child != -1:
+            yield child
+            child = self.next_sibling[child]
+
+    def roots(self):
+        """Позиции корней"""
+        root = 0 if len(self) else -1
+        while root != -1:
+            yield root
+            root = self.next_sibling[root]
+
+    def position(self, value, field='id'):
+        """
+        Позиция узла по значению уникального поля. Отображение строится при первом обращении к полю.
+        :return: <int> / None
+        """
+        mapped = self._maps.get(field)
+        if mapped is None:
+            mapped = self._maps[field] = {v: i for i, v in enumerate(self.columns[field])}
+        return mapped.get(value)
+
+    def _bounds(self, position):
+        if position is None:
+            return 0, len(self)
+        return position, position + self.size[position]
+
+    def find(self, values, target_field='id', position=None, descend=True):
+        """
+        Поиск узлов по target_field in values
+        :param values: искомые значения
+        :param target_field: <str>
+        :param position: <int> искать только в поддереве узла (включая его самого)
+        :param descend: <bool> если False, то потомки найденного узла не просматриваются (как в find_in_forest)
+        :return: [<int>, ...] позиции в порядке прямого обхода
+        """
+        lookup = _as_lookup(values)
+        column = self.columns[target_field]
+        start, stop = self._bounds(position)
+        result = list()
+        i = start
+        while i < stop:
+            if column[i] in lookup:
+                result.append(i)
+                if not descend:
+                    i += self.size[i]
+                    continue
+            i += 1
+        return result
+
+    def collect(self, target_field='id', position=None):
+        """
+        Значения поля target_field, не равные None, в порядке прямого обхода (как value_collector)
+        :param target_field: <str>
+        :param position: <int> корень поддерева, по умолчанию весь лес
+        :return: [<значение>, ...]
+        """
+        start, stop = self._bounds(position)
+        return [value for value in self.columns[target_field][start:stop] if value is not None]
+
+    def checked_branches(self, check_field='checked'):
+        """
+        Сохранение ветвей, в которых выбран хотя бы 1 элемент (как checked_branches). Исходное дерево не изменяется.
+        :param check_field: <str>
+        :return: <CompactTree>
+        """
+        checked = self.columns[check_field]
+        size = len(self)
+        has_checked = bytearray(size)
+        for i in range(size - 1, -1, -1):
+            if checked[i] or has_checked[i]:
+                has_checked[i] = 1
+                if self.parent[i] != -1:
+                    has_checked[self.parent[i]] = 1
+
+        positions = list()
+        i = 0
+        while i < size:
+            if checked[i]:
+                positions.extend(range(i, i + self.size[i]))
+                i += self.size[i]
+            elif has_checked[i] and self.first_child[i] != -1:
+                positions.append(i)
+                i += 1
+            else:
+                i += self.size[i]
+        return self.subset(positions)
+
+    def subset(self, positions):
+        """
+        Новое дерево из узлов positions. Позиции должны идти в порядке прямого обхода и вместе с каждым узлом
+        содержать всех его предков.
+        :param positions: [<int>, ...]
+        :return: <CompactTree>
+        """
+        new_positions = {old: new for new, old in enumerate(positions)}
+        parent = [new_positions.get(self.parent[old], -1) for old in positions]
+        columns = dict()
+        for name, column in self.columns.items():
+            if isinstance(column, array):
+                columns[name] = array(column.typecode, (column[old] for old in positions))
+            else:
+                columns[name] = [column[old] for old in positions]
+        return type(self)(parent, columns, self.children)
+
+    def branches_length(self, length_field):
+        """
+        Длины ветвей от корня до каждого листа в порядке прямого обхода (как branches_lenght)
+        :param length_field: <str>
+        :return: [<число>, ...]
+        """
+        path = self.path_aggregate(length_field)
+        return [path[i] for i in range(len(self)) if self.first_child[i] == -1]
+
+    def path_aggregate(self, field, how='sum'):
+        """
+        Агрегат значений поля на пути от корня до узла (включительно) сразу для всех узлов.
+        Родитель в прямом обходе всегда раньше потомка, поэтому достаточно одного прохода вперед.
+        Значения None пропускаются.
+        :param field: <str>
+        :param how: <str> 'sum', 'min', 'max', 'count'
+        :return: [<значение>, ...] по позициям узлов
+        """
+        result = _aggregate_start(self.columns[field], how)
+        parent = self.parent
+        if how in ('sum', 'count'):
+            for i in range(len(result)):
+                if parent[i] != -1:
+                    result[i] += result[parent[i]]
+        else:
+            combine = _AGGREGATES[how]
+            for i in range(len(result)):
+                if parent[i] != -1:
+                    result[i] = combine(result[parent[i]], result[i])
+        return result
+
+    def subtree_aggregate(self, field, how='sum'):
+        """
+        Агрегат значений поля по поддереву узла (включительно) сразу для всех узлов за один обратный проход.
+        Значения None пропускаются.
+        :param field: <str>
+        :param how: <str> 'sum', 'min', 'max', 'count'
+        :return: [<значение>, ...] по позициям узлов
+        """
+        result = _aggregate_start(self.columns[field], how)
+        parent = self.parent
+        if how in ('sum', 'count'):
+            for i in range(len(result) - 1, -1, -1):
+                if parent[i] != -1:
+                    result[parent[i]] += result[i]
+        else:
+            combine = _AGGREGATES[how]
+            for i in range(len(result) - 1, -1, -1):
+                if parent[i] != -1:
+                    result[parent[i]] = combine(result[parent[i]], result[i])
+        return result
+
+
+def _combine_min(a, b):
+    if a is None:
+        return b
+    if b is None or a <= b:
+        return a
+    return b
+
+
+def _combine_max(a, b):
+    if a is None:
+        return b
+    if b is None or a >= b:
+        return a
+    return b
+
+
+_AGGREGATES = {'min': _combine_min, 'max': _combine_max}
+
+
+def _aggregate_start(column, how):
+    """Начальные значения агрегата для каждого узла"""
+    if how == 'sum':
+        return [0 if value is None else value for value in column]
+    elif how == 'count':
+        return [0 if value is None else 1 for value in column]
+    elif how in _AGGREGATES:
+        return list(column)
+    raise ValueError('Unknown aggregate {!r}'.format(how))
+
+
+def tree_aggregate(forest, target_field, how='sum', scope='subtree', id_field='id', children='children',
+                   getter=None):
+    """
+    Агрегат значений поля для всех узлов массива деревьев за один проход
+    :param forest: [<dict>, ...]
+    :param target_field: <str> поле со значением
+    :param how: <str> 'sum', 'min', 'max', 'count'
+    :param scope: <str> 'subtree' - по поддереву узла, 'path' - по пути от корня до узла
+    :param id_field: <str> поле идентификатор объекта
+    :param children: <str> поле массив с подчиненными объектами или функция node -> [<node>, ...]
+    :param getter: функция (узел, поле) -> значение для узлов, которые не являются словарями (getattr)
+    :return: {<id>: <значение>}
+    """
+    columns = [id_field] if target_field == id_field else [id_field, target_field]
+    tree = CompactTree.from_forest(forest, children, columns=columns, getter=getter)
+    if scope == 'subtree':
+        result = tree.subtree_aggregate(target_field, how)
+    elif scope == 'path':
+        result = tree.path_aggregate(target_field, how)
+    else:
+        raise ValueError('Unknown aggregate scope {!r}'.format(scope))
+    return dict(zip(tree.columns[id_field], result))
+
+
 if __name__ == '__main__':
     test_tree = [
         dict(c=False, children=list(), n=1),
@@ -388,4 +1886,4 @@ if __name__ == '__main__':
             n=4)
     ]
 
-    r = checked_branches(test_tree, check_field='c', children='children')
\ No newline at end of file
+    r = checked_branches(test_tree, check_field='c', children='children')
@@ -1,11 +1,30 @@
 from hashlib import md5
 import datetime
 import re
+import decimal
+import uuid
 from collections import OrderedDict
+from itertools import islice
+from operator import attrgetter
 from dateutil.parser import parse
 from dateutil.tz import tzlocal
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.sql import compiler
+from sqlalchemy.types import TypeDecorator
+
+
+_local_tz = None
+
+
+def local_timezone():
+    """
+    Локальный часовой пояс. Объект tzlocal создается один раз на процесс, смена TZ во время работы не учитывается
+    :return: <tzlocal>
+    """
+    global _local_tz
+    if _local_tz is None:
+        _local_tz = tzlocal()
+    return _local_tz
 
 
 def datetime_now(to_string=False, set_seconds_null=True):
@@ -14,7 +33,7 @@ def datetime_now(to_string=False, set_seconds_null=True):
     :param to_string: <Bool>
     :return: <datetime>
     """
-    dt = datetime.datetime.now(tzlocal())
+    dt = datetime.datetime.now(local_timezone())
     if to_string:
         dt = datetime2str(dt, set_seconds_null=set_seconds_null)
     return dt
@@ -31,16 +50,39 @@ def datetime2str(date_time=None, delta=None, set_seconds_null=True):
     if date_time and delta:
         date_time = (date_time + delta)
     elif date_time == None and delta:
-        date_time = (datetime.datetime.now(tzlocal()) + delta)
+        date_time = (datetime.datetime.now(local_timezone()) + delta)
     elif delta == None and date_time:
         pass
     else:
-        date_time = datetime.datetime.now(tzlocal())
+        date_time = datetime.datetime.now(local_timezone())
 
-    date_time = date_time.replace(microsecond=0)
     if set_seconds_null:
-        date_time = date_time.replace(second=0)
-    return date_time.isoformat()
+        # isoformat без секунд и дописанные нули вместо replace(): строка та же, но без создания нового объекта
+        iso = date_time.isoformat('T', 'minutes')
+        return iso[:16] + ':00' + iso[16:]
+    return date_time.isoformat('T', 'seconds')
+
+
+def datetime_list2str(values, set_seconds_null=True):
+    """
+    Пакетный вариант datetime2str для списка значений с той же обрезкой секунд и микросекунд. Значения, которые
+    не являются datetime (None, date, строка у еще не сохраненного объекта), преобразуются как в convert_value
+    :param values: [<datetime>, ...]
+    :param set_seconds_null: <bool>
+    :return: [<str>, ...]
+    """
+    datetime_type = datetime.datetime
+    if not set_seconds_null:
+        return [v.isoformat('T', 'seconds') if isinstance(v, datetime_type) else convert_value(v) for v in values]
+    result = []
+    append = result.append
+    for v in values:
+        if isinstance(v, datetime_type):
+            s = v.isoformat('T', 'minutes')
+            append(s[:16] + ':00' + s[16:])
+        else:
+            append(convert_value(v))
+    return result
 
 
 def delta_iso(timedelta, round_down=False):
@@ -56,13 +98,50 @@ def delta_iso(timedelta, round_down=False):
         return int(hours)
 
 
+def iso2datetime(str_datetime):
+    """
+    Парсит строковое datetime. Строки ISO формата (в том числе результат datetime2str) разбираются
+    datetime.fromisoformat, dateutil.parser используется только для остальных форматов
+    :param str_datetime: <str>
+    :return: <datetime>
+    """
+    try:
+        return datetime.datetime.fromisoformat(str_datetime)
+    except ValueError:
+        return parse(str_datetime)
+
+
+def iso_list2datetime(values, rounded=False):
+    """
+    Пакетный вариант iso2datetime для списка строк. None остаются None
+    :param values: [<str>, ...]
+    :param rounded: <bool> обнулять секунды и микросекунды, как iso2roundedDT
+    :return: [<datetime>, ...]
+    """
+    fromisoformat = datetime.datetime.fromisoformat
+    result = []
+    append = result.append
+    for value in values:
+        if value is None:
+            append(None)
+            continue
+        try:
+            dt = fromisoformat(value)
+        except ValueError:
+            dt = parse(value)
+        if rounded:
+            dt = dt.replace(second=0, microsecond=0)
+        append(dt)
+    return result
+
+
 def iso2roundedDT(str_datetime):
     """
     Парсит строковое datetime и обнуляет секунды и микросекунды
     :param str_datetime:
     :return:
     """
-    t = parse(str_datetime)
+    t = iso2datetime(str_datetime)
     return t.replace(second=0, microsecond=0)
 
 
@@ -94,7 +173,7 @@ def isostr2datetime(str_dt, dt_format='%H:%M %d-%m-%Y'):
     :param dt_format: новый формат
     :return:
     """
-    new_dt = parse(str_dt)
+    new_dt = iso2datetime(str_dt)
     new_dt = new_dt.strftime(dt_format)
     return new_dt
 
@@ -218,45 +297,192 @@ def sign(initials=None, surname=None, display_name=None):
     return result
 
 
-def row2dict(row, b=None, add_prop=None, strict_mode=True):
+def convert_value(value):
     """
-    :param row: Объект строки таблицы
-    :param b: список колонок, которые не должны добавляться в словарь
-    :return: словарь
+    Преобразование значения для row2dict: datetime в строку ISO формата, timedelta в строку
     """
-    d = {}
-    if not b:
-        b = []
+    if isinstance(value, datetime.datetime):
+        value = datetime2str(date_time=value)
+    elif isinstance(value, datetime.timedelta):
+        value = str(value)
+    return value
+
+
+# типы колонок, значения которых row2dict не преобразует
+_PLAIN_TYPES = (bool, int, float, str, bytes, decimal.Decimal, uuid.UUID, dict, list)
+
 
-    for c in row.__table__.columns:
-        if c.name not in b:
-            value = getattr(row, c.name)
-            if isinstance(value, datetime.datetime):
-                value = datetime2str(date_time=value)
-            elif isinstance(value, datetime.timedelta):
-                value = str(value)
-            d[c.name] = value
+def convert_values(values):
+    """Пакетный вариант convert_value для списка значений"""
+    return [convert_value(value) for value in values]
 
-    if add_prop:
 
-        for k in add_prop:
+def _column_converter(column):
+    """
+    Функции преобразования значений колонки: для одного значения и для списка значений.
+    None, если по типу колонки преобразование не требуется
+    :return: (<function>, <function>) или None
+    """
+    if isinstance(column.type, TypeDecorator):
+        return convert_value, convert_values
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return convert_value, convert_values
+    if issubclass(python_type, _PLAIN_TYPES) or python_type is datetime.date:
+        return None
+    if python_type is datetime.datetime:
+        return convert_value, datetime_list2str
+    return convert_value, convert_values
+
+
+class RowSerializer:
+    """
+    Конвертер объектов модели SQLAlchemy в словарь (row2dict), собранный один раз для модели и набора параметров:
+    список колонок и функции преобразования значений вычисляются при создании. Экземпляры кешируются в классе
+    модели, получать их нужно через RowSerializer.for_class.
+    """
+
+    def __init__(self, model, b=None, add_prop=None, strict_mode=True):
+        """
+        :param model: класс модели SQLAlchemy
+        :param b: список колонок, которые не должны добавляться в словарь
+        :param add_prop: список дополнительных аттрибутов
+        :param strict_mode: <bool> ошибка, если дополнительного аттрибута нет
+        """
+        exclude = _exclude_set(b)
+        columns = [c for c in model.__table__.columns if c.name not in exclude]
+        self.names = tuple(c.name for c in columns)
+        self.add_prop = tuple(add_prop or ())
+        self.strict_mode = strict_mode
+        converters = [(c.name, _column_converter(c)) for c in columns]
+        converters = [(name, funcs) for name, funcs in converters if funcs is not None]
+        self.converters = tuple((name, funcs[0]) for name, funcs in converters)
+        self.batch_converters = tuple((name, funcs[1]) for name, funcs in converters)
+        if len(self.names) == 1:
+            name = self.names[0]
+            self._values = lambda row: (getattr(row, name),)
+        elif self.names:
+            self._values = attrgetter(*self.names)
+        else:
+            self._values = lambda row: ()
+
+    @classmethod
+    def for_class(cls, model, b=None, add_prop=None, strict_mode=True):
+        """
+        Конвертер из кеша класса модели
+        :return: <RowSerializer>
+        """
+        cache = model.__dict__.get('_row2dict_serializers')
+        if cache is None:
+            cache = dict()
+            setattr(model, '_row2dict_serializers', cache)
+        key = (_exclude_set(b), tuple(add_prop or ()), strict_mode)
+        serializer = cache.get(key)
+        if serializer is None:
+            serializer = cache[key] = cls(model, b, add_prop, strict_mode)
+        return serializer
+
+    def __call__(self, row):
+        d = dict(zip(self.names, self._values(row)))
+        for name, converter in self.converters:
+            d[name] = converter(d[name])
+        if self.add_prop:
+            self._add_props(row, d)
+        return d
+
+    def _add_props(self, row, d):
+        for k in self.add_prop:
             try:
                 value = getattr(row, k)
-                if isinstance(value, datetime.datetime):
-                    value = datetime2str(date_time=value)
-                elif isinstance(value, datetime.timedelta):
-                    value = str(value)
-                d[k] = value
             except AttributeError:
-                if strict_mode:
+                if self.strict_mode:
                     raise AttributeError('Аттрибут %s неопределен' % k)
-    return d
+                continue
+            d[k] = convert_value(value)
+
+    def convert_rows(self, rows):
+        """
+        Пакетное преобразование строк результата запроса по колонкам (без объектов ORM): значения преобразуются
+        по колонкам, а не по строкам. Дополнительные аттрибуты add_prop здесь не используются
+        :param rows: [<tuple>, ...] значения колонок в порядке self.names
+        :return: [<dict>, ...]
+        """
+        names = self.names
+        result = [dict(zip(names, row)) for row in rows]
+        self._convert_columns(result)
+        return result
+
+    def convert_items(self, items):
+        """
+        Пакетный вариант __call__ для списка объектов модели: колонки с датами преобразуются списком
+        :param items: [<SQLAlchemy>, ...]
+        :return: [<dict>, ...]
+        """
+        names = self.names
+        values = self._values
+        result = [dict(zip(names, values(item))) for item in items]
+        self._convert_columns(result)
+        if self.add_prop:
+            for item, d in zip(items, result):
+                self._add_props(item, d)
+        return result
+
+    def _convert_columns(self, dicts):
+        for name, converter in self.batch_converters:
+            converted = converter([d[name] for d in dicts])
+            for d, value in zip(dicts, converted):
+                d[name] = value
+
+    def iter_rows(self, rows, batch_size=1000):
+        """
+        Потоковое преобразование строк результата запроса пачками по batch_size
+        :param rows: итерируемый результат запроса, строки содержат колонки в порядке self.names
+        :param batch_size: <int> размер пачки
+        :return: генератор словарей
+        """
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return
+            yield from self.convert_rows(batch)
+
+
+def _exclude_set(b):
+    """
+    Список исключаемых колонок в виде множества. Строка остается строкой: как и в прежнем row2dict, исключается
+    колонка, имя которой входит в строку (b='id,name' исключает id и name)
+    """
+    if not b:
+        return frozenset()
+    if isinstance(b, str):
+        return b
+    return frozenset(b)
+
+
+def row2dict(row, b=None, add_prop=None, strict_mode=True):
+    """
+    :param row: Объект строки таблицы
+    :param b: список колонок, которые не должны добавляться в словарь
+    :return: словарь
+    """
+    return RowSerializer.for_class(type(row), b, add_prop, strict_mode)(row)
 
 
 def mass_row2dict(rows, block=None, add_prop=None, strict_mode=True):
     result = []
+    group = []
+    model = None
     for row in rows:
-        result.append(row2dict(row, block, add_prop=add_prop, strict_mode=strict_mode))
+        if type(row) is not model:
+            if group:
+                result.extend(RowSerializer.for_class(model, block, add_prop, strict_mode).convert_items(group))
+            model = type(row)
+            group = []
+        group.append(row)
+    if group:
+        result.extend(RowSerializer.for_class(model, block, add_prop, strict_mode).convert_items(group))
     return result
 
 